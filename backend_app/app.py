@@ -1,13 +1,53 @@
 from fastapi import FastAPI, Request, status
-from fastapi.responses import JSONResponse, StreamingResponse, HTMLResponse
+from fastapi.responses import JSONResponse, StreamingResponse, HTMLResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from backend_app.services.chatbot import chat_logic
-#from backend_app.services.auth.auth_routes import auth_router
-import json
+from backend_app.services.chatbot.sse import SSEWriter, ERROR_MESSAGE, HEARTBEAT_SECONDS
+from backend_app.services.chatbot.chat_stream import ChatStream
+from backend_app.services.chatbot.admission_control import admission_controller, AdmittedStreamingResponse, Overloaded, PRIORITY_HEADER, PRIORITIES
+from backend_app.services.upstream.upstream_scheduler import INTERACTIVE, request_priority
+from backend_app.services.document_retrieval.embedding_service import embedding_service
+from backend_app.services.news.news_service import news_service
+from backend_app.services.llm.llm_gateway import llm_gateway
+from backend_app.services.data_access_layer.api_connectors.financialmodelingprep_api_connector import fmp_connector
+from backend_app.services.data_access_layer.database_connection import init_database, close_database
+from backend_app.services.monitoring import metrics
+from backend_app.services.auth.auth import SECRET_KEY
+from backend_app.services.auth.auth_routes import auth_router
+from backend_app.services.auth.user_cache import resolve_user
+from contextlib import asynccontextmanager
+import asyncio
+import os
+import re
+import time
 
-app = FastAPI()
+# Conversation ids come from the client and are stored as the conversations table's key (String(64)), e.g. a UUID
+CONVERSATION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
 
-#app.include_router(auth_router)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the embedding model before we start serving, so the first retrieval request doesn't pay for it
+    if os.getenv("EMBEDDING_WARM_START", "true").lower() == "true":
+        await embedding_service.start()
+    try:
+        await init_database()
+    except Exception as e:
+        print(f"Couldn't initialise the database, conversations will only be kept in memory: {e}")
+    lag_monitor = asyncio.create_task(metrics.monitor_event_loop_lag())
+    yield
+    lag_monitor.cancel()
+    await chat_logic.conversation_store.close() # Finish saving the last turns before the connections go
+    await news_service.close()
+    await llm_gateway.close()
+    await fmp_connector.close()
+    await close_database()
+
+app = FastAPI(lifespan=lifespan)
+
+REQUIRE_AUTH = os.getenv("CHAT_REQUIRE_AUTH", "false").lower() == "true" # Otherwise signed out users can still chat
+
+if SECRET_KEY: # Sign in needs JWT_SECRET_KEY to issue tokens
+    app.include_router(auth_router)
 
 allowed_origins = [
     "http://localhost:3000",  # Development
@@ -19,6 +59,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all HTTP methods (e.g., GET, POST, OPTIONS)
     allow_headers=["*"],  # Allows all headers (e.g., Content-Type)
+    expose_headers=["Retry-After"],  # So the frontend can tell the user when to try again if /chat is busy
 )
 @app.get("/")
 async def root():
@@ -26,21 +67,88 @@ async def root():
 
 @app.post("/chat") # Triggered when handleUserMessage() is called in script.js. The user message is POSTed to this route.
 async def chat(request: Request):
+    started_at = time.perf_counter()
     chat_history = await request.json()  # Asynchronously read the request body, include chat history
     if not chat_history:
         return JSONResponse({"error": "Message is required"}, status_code=status.HTTP_400_BAD_REQUEST)
 
-    response = chat_logic.get_chatgpt_stream(chat_history)
+    user = await resolve_user(request) # From the goose cookie, usually without touching the database
+    if user is None and REQUIRE_AUTH:
+        return JSONResponse({"error": "Sign in to chat"}, status_code=status.HTTP_401_UNAUTHORIZED)
+
+    user_id = user.id if user else None
+    conversation_id = chat_history.get("conversation_id")
+    if conversation_id and not (isinstance(conversation_id, str) and CONVERSATION_ID_PATTERN.match(conversation_id)):
+        # An id the database can't store would fail every save, and its unsaved messages would pile up
+        return JSONResponse({"error": "Invalid conversation_id"}, status_code=status.HTTP_400_BAD_REQUEST)
+    # Only signed in users' streams supersede each other. Anyone can send any conversation_id, so a signed out request
+    # mustn't cancel a stream it can't prove is its own (signed out clients abort the old request themselves)
+    stream_key = (user_id, conversation_id) if conversation_id and user_id is not None else None
+
+    # Wait for a stream slot, or turn the request away if this worker is too busy (see admission_control.py). Any
+    # answer this request replaces is only cancelled once it has a slot (ChatStream.start), so a request that's turned
+    # away doesn't leave the user with nothing
+    priority = PRIORITIES.get(request.headers.get(PRIORITY_HEADER, "").lower(), INTERACTIVE)
+    try:
+        slot = await admission_controller.admit(priority)
+    except Overloaded as e:
+        return JSONResponse({"error": "The assistant is busy, please try again shortly"}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={"Retry-After": str(e.retry_after)})
+
+    response = chat_logic.get_chatgpt_stream(chat_history, user_id)
  
     async def generate_stream():
         print("Generating stream ...")
-        async for chunk in response:
-            if isinstance(chunk, dict):  # If the chunk is a dictionary (i.e., the result of a tool call), convert the chunk into a JSON string and pass it to the frontend.
-                yield json.dumps(chunk)
-            else:
-                yield chunk
+        usage = metrics.start_request_usage() # Totals the tokens used by every LLM call made for this request
+        request_priority.set(priority) # Background answers' upstream requests queue behind interactive ones too
+        # The answer runs in its own task, cancelled if we stop reading it because the client went away
+        chat_stream = ChatStream(response, stream_key)
+        chat_stream.start()
+        writer = SSEWriter()
+        first_token = True
+        status = "error"
+        try:
+            try:
+                async for frame in writer.frames(chat_stream.read(HEARTBEAT_SECONDS)):
+                    if first_token and frame.startswith(b"event: token"):
+                        metrics.TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - started_at)
+                        first_token = False
+                    yield frame
+                status = "superseded" if chat_stream.superseded else "ok" # A newer request for the conversation took over
+            except Exception as e:
+                print(f"Error in chat stream: {e}")
+                yield writer.event("error", {"message": ERROR_MESSAGE})
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            yield writer.event("usage", usage)
+            yield writer.event("done", {"status": status})
+        except BaseException:
+            status = "cancelled" # The client went away
+            raise
+        finally:
+            chat_stream.cancel() # Does nothing if the answer has finished
+            writer.finish()
+            metrics.STREAM_DURATION.observe(time.perf_counter() - started_at)
+            metrics.CHAT_REQUESTS.labels(status).inc()
+            metrics.record_request_usage(usage)
     
-    return StreamingResponse(generate_stream(), media_type="text/event-stream")
+    # No proxy buffering, or the events would arrive in bursts. The slot is released once the response is over
+    return AdmittedStreamingResponse(slot, generate_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/conversations/{conversation_id}/messages")
+async def get_conversation_messages(request: Request, conversation_id: str, before: int = None, limit: int = 50):
+    # A page of history, newest first. Pass next_cursor back as before for the page before it. Only the signed in user
+    # who owns the conversation can read it, so signed out conversations (which nobody owns) aren't readable here
+    repository = chat_logic.conversation_store.repository # None when conversations aren't stored
+    user = await resolve_user(request)
+    if repository is None or user is None or await repository.get_owner(conversation_id) != user.id:
+        return JSONResponse({"error": "Conversation not found"}, status_code=status.HTTP_404_NOT_FOUND)
+    return await repository.get_history(conversation_id, before, limit)
+
+@app.get("/metrics")
+async def get_metrics():
+    # Runs on a worker thread, as reading the component stats touches locks and the summary cache database
+    body, content_type = await asyncio.to_thread(metrics.render_metrics)
+    return Response(content=body, media_type=content_type)
 
 @app.get("/health")
 async def health():
@@ -0,0 +1,238 @@
+""" A local table of company fundamentals for a whole universe (e.g. the S&P 500), stored as columns of NumPy arrays with
+one row per ticker and fiscal period. The screener (screener.py) runs filters and rankings over whole columns at once,
+so a screen over thousands of companies doesn't make any API calls.
+
+The table is built from Financial Modeling Prep (through the FMPConnector, so its disk cache and rate limits apply)
+and saved as a single compressed .npz file, which loads in milliseconds. Build or refresh it with:
+
+    python -m backend_app.services.analytics.fundamentals_table --universe sp500
+
+Figures are as reported. Ratios are fractions (0.05 is 5%), and valuation ratios use the market cap at the end of each
+period (the current market cap for the latest period). """
+
+from backend_app.services.data_access_layer.api_connectors.financialmodelingprep_api_connector import fmp_connector
+from backend_app.services.upstream.upstream_scheduler import background_priority
+import argparse
+import asyncio
+import numpy as np
+import os
+import threading
+import time
+
+TABLE_PATH = os.getenv("FUNDAMENTALS_TABLE_PATH", "./fundamentals/fundamentals.npz")
+TABLE_VERSION = 1 # Bump whenever the columns change, so an old table is rebuilt rather than misread
+BUILD_BATCH_SIZE = 50 # Tickers fetched at once while building
+
+# Columns taken straight from FMP, as (dataset, FMP field)
+reported_columns = {
+    "revenue": ("income-statement", "revenue"),
+    "gross_profit": ("income-statement", "grossProfit"),
+    "operating_income": ("income-statement", "operatingIncome"),
+    "net_income": ("income-statement", "netIncome"),
+    "ebitda": ("income-statement", "ebitda"),
+    "eps": ("income-statement", "eps"),
+    "cash": ("balance-sheet-statement", "cashAndCashEquivalents"),
+    "total_assets": ("balance-sheet-statement", "totalAssets"),
+    "total_liabilities": ("balance-sheet-statement", "totalLiabilities"),
+    "equity": ("balance-sheet-statement", "totalStockholdersEquity"),
+    "total_debt": ("balance-sheet-statement", "totalDebt"),
+    "net_debt": ("balance-sheet-statement", "netDebt"),
+    "operating_cash_flow": ("cash-flow-statement", "operatingCashFlow"),
+    "capex": ("cash-flow-statement", "capitalExpenditure"),
+    "free_cash_flow": ("cash-flow-statement", "freeCashFlow"),
+    "dividends_paid": ("cash-flow-statement", "dividendsPaid"),
+    "market_cap": ("key-metrics", "marketCap"),
+    "enterprise_value": ("key-metrics", "enterpriseValue"),
+}
+
+# Columns that come from the company profile, so are the same for every period
+profile_columns = {
+    "name": "companyName",
+    "sector": "sector",
+    "industry": "industry",
+    "price": "price",
+    "beta": "beta",
+}
+TEXT_COLUMNS = ("ticker", "name", "sector", "industry", "date")
+
+# What each column holds, for the screening agent's prompt
+column_descriptions = {
+    "ticker": "ticker symbol", "name": "company name", "sector": "e.g. 'Technology'", "industry": "e.g. 'Software'",
+    "date": "period end date, YYYY-MM-DD", "fiscal_year": "year of the period end", "latest": "whether this is the company's latest period",
+    "price": "current share price", "beta": "beta against the market",
+    "revenue": "revenue", "gross_profit": "gross profit", "operating_income": "operating income", "net_income": "net income",
+    "ebitda": "EBITDA", "eps": "earnings per share", "cash": "cash and equivalents", "total_assets": "total assets",
+    "total_liabilities": "total liabilities", "equity": "shareholders' equity", "total_debt": "total debt",
+    "net_debt": "total debt less cash", "operating_cash_flow": "operating cash flow", "capex": "capital expenditure (negative)",
+    "free_cash_flow": "free cash flow", "dividends_paid": "dividends paid (negative)", "market_cap": "market capitalisation",
+    "enterprise_value": "enterprise value",
+    "gross_margin": "gross profit / revenue", "operating_margin": "operating income / revenue", "net_margin": "net income / revenue",
+    "fcf_margin": "free cash flow / revenue", "roe": "net income / equity", "roa": "net income / total assets",
+    "pe": "market cap / net income", "earnings_yield": "net income / market cap", "fcf_yield": "free cash flow / market cap",
+    "dividend_yield": "dividends paid / market cap", "ev_to_ebitda": "enterprise value / EBITDA",
+    "net_debt_to_ebitda": "net debt / EBITDA", "debt_to_equity": "total debt / equity",
+    "revenue_growth": "revenue growth on the previous period", "eps_growth": "EPS growth on the previous period",
+}
+
+def ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """ numerator / denominator, with NaN wherever the denominator is zero or missing. """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = numerator / denominator
+    result[~np.isfinite(result)] = np.nan
+    return result
+
+def add_derived_columns(columns: dict):
+    """ Adds the margins, returns, valuation and leverage ratios, computed across the whole table at once. """
+    columns["gross_margin"] = ratio(columns["gross_profit"], columns["revenue"])
+    columns["operating_margin"] = ratio(columns["operating_income"], columns["revenue"])
+    columns["net_margin"] = ratio(columns["net_income"], columns["revenue"])
+    columns["fcf_margin"] = ratio(columns["free_cash_flow"], columns["revenue"])
+    columns["roe"] = ratio(columns["net_income"], columns["equity"])
+    columns["roa"] = ratio(columns["net_income"], columns["total_assets"])
+    columns["pe"] = ratio(columns["market_cap"], columns["net_income"])
+    columns["earnings_yield"] = ratio(columns["net_income"], columns["market_cap"])
+    columns["fcf_yield"] = ratio(columns["free_cash_flow"], columns["market_cap"])
+    columns["dividend_yield"] = ratio(-columns["dividends_paid"], columns["market_cap"])
+    columns["ev_to_ebitda"] = ratio(columns["enterprise_value"], columns["ebitda"])
+    columns["net_debt_to_ebitda"] = ratio(columns["net_debt"], columns["ebitda"])
+    columns["debt_to_equity"] = ratio(columns["total_debt"], columns["equity"])
+
+    # Growth against the previous period for the same ticker. Rows are sorted by ticker then date, so that's the row above
+    previous_revenue = np.roll(columns["revenue"], 1)
+    previous_eps = np.roll(columns["eps"], 1)
+    same_ticker = np.roll(columns["ticker"], 1) == columns["ticker"]
+    same_ticker[:1] = False # The first row has no row above it. A slice, so an empty table (e.g. FMP is down) works too
+    columns["revenue_growth"] = np.where(same_ticker, ratio(columns["revenue"] - previous_revenue, np.abs(previous_revenue)), np.nan)
+    columns["eps_growth"] = np.where(same_ticker, ratio(columns["eps"] - previous_eps, np.abs(previous_eps)), np.nan)
+
+def number(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+class FundamentalsTable:
+    def __init__(self, columns: dict = None, built_at: float = None):
+        self.columns = columns or {} # Column name to a NumPy array, all the same length
+        self.built_at = built_at
+
+    def __len__(self):
+        return len(self.columns["ticker"]) if self.columns else 0
+
+    @classmethod
+    def from_company_data(cls, company_data: dict) -> "FundamentalsTable":
+        """ Builds the table from the connector's {ticker: {dataset: rows}}. Statements are lined up by their period
+        end date, and the profile (and its current market cap) is applied to every period.
+
+        Parameters:
+        - company_data (dict): as returned by FMPConnector.get_company_data.
+
+        Returns:
+        - (FundamentalsTable) """
+
+        records = []
+        for ticker, ticker_datasets in company_data.items():
+            profile = (ticker_datasets.get("profile") or [{}])[0]
+            periods = {} # Period end date to the statement fields for that period
+            for column, (dataset, field) in reported_columns.items():
+                for row in ticker_datasets.get(dataset) or []:
+                    if row.get("date"):
+                        periods.setdefault(row["date"], {})[column] = number(row.get(field))
+
+            for index, date in enumerate(sorted(periods)):
+                record = {"ticker": ticker, "date": date, "fiscal_year": int(date[:4]), **periods[date]}
+                for column, field in profile_columns.items():
+                    record[column] = profile.get(field)
+                record["latest"] = index == len(periods) - 1
+                if record["latest"] and profile.get("mktCap"):
+                    record["market_cap"] = number(profile["mktCap"])
+                records.append(record)
+
+        records.sort(key=lambda record: (record["ticker"], record["date"]))
+        columns = {}
+        for column in TEXT_COLUMNS:
+            columns[column] = np.array([str(record.get(column) or "") for record in records], dtype=str)
+        for column in list(reported_columns) + ["price", "beta"]:
+            columns[column] = np.array([number(record.get(column)) for record in records], dtype=np.float64)
+        columns["fiscal_year"] = np.array([record["fiscal_year"] for record in records], dtype=np.int64)
+        columns["latest"] = np.array([record["latest"] for record in records], dtype=bool)
+        add_derived_columns(columns)
+        return cls(columns, time.time())
+
+    def save(self, path: str = TABLE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(temp_path, __version__=np.array(TABLE_VERSION), __built_at__=np.array(self.built_at), **self.columns)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str = TABLE_PATH) -> "FundamentalsTable":
+        """ Loads a saved table. Returns an empty table if there isn't one (or it's from an older version). """
+        if not os.path.exists(path):
+            print(f"No fundamentals table at {path}, build one with: python -m backend_app.services.analytics.fundamentals_table")
+            return cls()
+        with np.load(path, allow_pickle=False) as saved:
+            if int(saved["__version__"]) != TABLE_VERSION:
+                print(f"Fundamentals table at {path} is out of date, rebuild it")
+                return cls()
+            columns = {name: saved[name] for name in saved.files if not name.startswith("__")}
+            return cls(columns, float(saved["__built_at__"]))
+
+    def numeric_columns(self) -> list:
+        return [name for name, values in self.columns.items() if values.dtype.kind in "fi"]
+
+class FundamentalsStore:
+    """ Holds the table for the app. It's loaded on first use, and reloaded whenever the file on disk changes (e.g. after
+    a rebuild), without restarting. """
+
+    def __init__(self, path: str = TABLE_PATH):
+        self.path = path
+        self.table = None
+        self.modified_at = None
+        self.lock = threading.Lock()
+
+    def get_table(self) -> FundamentalsTable:
+        try:
+            modified_at = os.path.getmtime(self.path)
+        except OSError:
+            modified_at = None
+        with self.lock:
+            if self.table is None or modified_at != self.modified_at:
+                self.table = FundamentalsTable.load(self.path)
+                self.modified_at = modified_at
+            return self.table
+
+fundamentals_store = FundamentalsStore()
+
+async def build_table(tickers: list, period: str = "annual") -> FundamentalsTable:
+    """ Fetches fundamentals for every ticker (in batches, at background priority so chat requests go first) and builds
+    the table. """
+    datasets = ["profile"] + list(dict.fromkeys(dataset for dataset, _ in reported_columns.values()))
+    company_data = {}
+    with background_priority():
+        for i in range(0, len(tickers), BUILD_BATCH_SIZE):
+            batch = tickers[i:i + BUILD_BATCH_SIZE]
+            company_data.update(await fmp_connector.get_company_data(batch, datasets, period))
+            print(f"Fetched fundamentals for {min(i + BUILD_BATCH_SIZE, len(tickers))}/{len(tickers)} tickers")
+    await fmp_connector.close()
+    return FundamentalsTable.from_company_data(company_data)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the local fundamentals table used by the screener.")
+    parser.add_argument("--universe", default="sp500", help="An FMP index (sp500, nasdaq or dowjones) to build the table for.")
+    parser.add_argument("--tickers", nargs="*", help="Build for these tickers instead of an index.")
+    parser.add_argument("--period", default="annual", choices=["annual", "quarter"])
+    parser.add_argument("--path", default=TABLE_PATH)
+    args = parser.parse_args()
+
+    async def build():
+        tickers = args.tickers or await fmp_connector.get_index_constituents(args.universe)
+        print(f"Building the fundamentals table for {len(tickers)} tickers")
+        return await build_table(tickers, args.period)
+
+    table = asyncio.run(build())
+    table.save(args.path)
+    print(f"Saved {len(table)} rows ({int(table.columns['latest'].sum()) if len(table) else 0} companies) to {args.path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+""" Portfolio analytics behind the retrieve_portfolio tool.
+
+Portfolios are parsed once into NumPy arrays (one entry per position) and kept in memory. A user's portfolio comes from
+the database (repositories.PortfolioRepository) and is re-read when its version changes, which every write bumps, so
+imports on any replica are picked up. Without a stored portfolio, the sample file is used, re-read when it changes on
+disk (its mtime or size). invalidate() drops cached copies outright.
+
+Each analysis values every position at its latest price, then computes P&L, sector and currency exposure, and the
+risk figures (returns, volatility, covariance/correlation, beta against a benchmark, historical VaR and expected
+shortfall, max drawdown, and each position's contribution to risk) over a single matrix of daily returns built from the
+cached price histories. The model gets a compact summary of the results, and the UI gets the full breakdown. """
+
+from backend_app.services.market_data.market_data_cache import market_data_cache
+from backend_app.services.data_access_layer.repositories import portfolio_repository
+from datetime import date, timedelta
+import asyncio
+import json
+import numpy as np
+import os
+import threading
+import time
+
+PORTFOLIO_DIRECTORY = os.getenv("PORTFOLIO_DIRECTORY", "./portfolios")
+DEFAULT_BENCHMARK = os.getenv("PORTFOLIO_BENCHMARK", "SPY")
+DEFAULT_LOOKBACK_DAYS = 365
+TRADING_DAYS = 252
+MIN_HISTORY_DAYS = 20 # Positions with fewer days of returns than this are left out of the risk figures
+SUMMARY_POSITIONS = 10 # Largest positions listed in the model's summary
+CORRELATION_POSITIONS = 25 # Largest positions shown in the UI's correlation matrix, which grows with the square of this
+
+class Portfolio:
+    """ A parsed portfolio, as arrays with one entry per position. """
+
+    def __init__(self, user_id: str, base_currency: str, positions: list):
+        self.user_id = user_id
+        self.base_currency = base_currency
+        self.symbols = np.array([str(position.get("symbol", "")).upper() for position in positions], dtype=str)
+        self.names = np.array([str(position.get("name") or position.get("symbol", "")) for position in positions], dtype=str)
+        self.asset_types = np.array([str(position.get("asset_type") or "stock") for position in positions], dtype=str)
+        self.sectors = np.array([str(position.get("sector") or "Unknown") for position in positions], dtype=str)
+        self.currencies = np.array([str(position.get("currency") or base_currency).upper() for position in positions], dtype=str)
+        self.quantities = np.array([float(position.get("quantity") or 0) for position in positions])
+        self.purchase_prices = np.array([float(position.get("purchase_price") or np.nan) for position in positions])
+        self.stored_prices = np.array([float(position.get("current_price") or np.nan) for position in positions])
+
+    def __len__(self):
+        return len(self.symbols)
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Portfolio":
+        return cls(data.get("user_id"), str(data.get("currency") or "USD").upper(), data.get("portfolio") or [])
+
+class PortfolioStore:
+    """ Parsed portfolios, kept in memory until they change. """
+
+    def __init__(self, directory: str = PORTFOLIO_DIRECTORY, repository = portfolio_repository):
+        self.directory = directory
+        self.repository = repository
+        self.portfolios = {} # Path or ("user", user_id) to (version or (mtime, size), Portfolio)
+        self.lock = threading.Lock()
+        self.loads = 0
+
+    def path_for(self, user_id: str = None) -> str:
+        # Every user gets the sample portfolio until portfolios are stored per user
+        return os.path.join(self.directory, "portfolio1.json")
+
+    async def load_portfolio(self, user_id: int = None) -> Portfolio:
+        """ Retrieves the user's portfolio from the database, or the sample portfolio if there's no user or they haven't
+        stored one. The version check is a single indexed lookup, positions are only read when the portfolio changed. """
+        if user_id is not None:
+            try:
+                version = await self.repository.get_portfolio_version(user_id)
+            except Exception as e:
+                print(f"Couldn't check the stored portfolio for user {user_id}, using the sample portfolio: {e}")
+                version = None
+            if version is not None:
+                key = ("user", user_id)
+                with self.lock:
+                    cached = self.portfolios.get(key)
+                if cached and cached[0] == version:
+                    return cached[1]
+                data = await self.repository.get_portfolio(user_id)
+                portfolio = Portfolio.from_json(data)
+                with self.lock:
+                    self.portfolios[key] = (data["version"], portfolio)
+                    self.loads += 1
+                return portfolio
+        return await asyncio.to_thread(self.get_portfolio)
+
+    def get_portfolio(self, user_id: str = None) -> Portfolio:
+        """ Retrieves a portfolio from its file. """
+        path = self.path_for(user_id)
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.portfolios.get(path)
+            if cached and cached[0] == signature:
+                return cached[1]
+
+        with open(path, "r") as file:
+            portfolio = Portfolio.from_json(json.load(file))
+        with self.lock:
+            self.portfolios[path] = (signature, portfolio)
+            self.loads += 1
+        return portfolio
+
+    def invalidate(self, user_id: str = None):
+        """ Drops a cached portfolio (or all of them), so it's re-read on next use. """
+        with self.lock:
+            if user_id is None:
+                self.portfolios.clear()
+            else:
+                self.portfolios.pop(("user", user_id), None)
+
+portfolio_store = PortfolioStore()
+
+def share(values: np.ndarray, labels: np.ndarray) -> dict:
+    """ Sums values by label, e.g. market value by sector. Returns {label: total}, largest first. """
+    unique, inverse = np.unique(labels, return_inverse=True)
+    totals = np.bincount(inverse, weights=values, minlength=len(unique))
+    order = np.argsort(-totals)
+    return {str(unique[i]): float(totals[i]) for i in order}
+
+def fx_rates(currencies: np.ndarray, base_currency: str) -> np.ndarray:
+    """ Returns the rate converting each position's currency to the base currency (1 where a rate isn't available). """
+    rates = np.ones(len(currencies))
+    foreign = sorted(set(currencies.tolist()) - {base_currency})
+    if not foreign:
+        return rates
+    pairs = {currency: f"{currency}{base_currency}=X" for currency in foreign} # Yahoo's FX tickers, e.g. EURUSD=X
+    quotes = market_data_cache.get_quotes(list(pairs.values()))
+    for currency, pair in pairs.items():
+        rate = (quotes.get(pair) or {}).get("regularMarketPrice")
+        if rate:
+            rates[currencies == currency] = rate
+        else:
+            print(f"No FX rate for {pair}, valuing {currency} positions 1:1")
+    return rates
+
+def return_matrix(symbols: list, start: str, end: str):
+    """ Builds a matrix of daily returns (days x symbols) from the cached price histories, with every symbol lined up on
+    the same dates. Gaps are filled with the last close.
+
+    Returns:
+    - (np.ndarray) daily returns, NaN where a symbol has no price yet.
+    - (list) the dates of each row. """
+
+    histories = market_data_cache.get_histories(symbols, start, end)
+    dates = sorted({bar["date"] for bars in histories.values() for bar in bars})
+    date_index = {day: i for i, day in enumerate(dates)}
+    closes = np.full((len(dates), len(symbols)), np.nan)
+    for column, symbol in enumerate(symbols):
+        bars = histories.get(symbol) or []
+        if bars:
+            rows = np.fromiter((date_index[bar["date"]] for bar in bars), dtype=np.int64, count=len(bars))
+            closes[rows, column] = [bar["close"] for bar in bars]
+
+    # Forward fill each column, so a missing day doesn't show up as a return
+    filled = np.where(np.isnan(closes), 0, np.arange(len(dates))[:, None])
+    np.maximum.accumulate(filled, axis=0, out=filled)
+    closes = closes[filled, np.arange(len(symbols))]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        returns = closes[1:] / closes[:-1] - 1
+    return returns, dates[1:]
+
+def risk_metrics(returns: np.ndarray, weights: np.ndarray, benchmark_returns: np.ndarray, value: float) -> dict:
+    """ Portfolio risk figures from a complete matrix of daily returns (days x positions) and the positions' weights. """
+    portfolio_returns = returns @ weights
+    covariance = np.cov(returns, rowvar=False, ddof=1).reshape(len(weights), len(weights)) * TRADING_DAYS
+    with np.errstate(divide="ignore", invalid="ignore"):
+        volatilities = np.sqrt(np.diag(covariance))
+        correlation = covariance / np.outer(volatilities, volatilities)
+    variance = float(weights @ covariance @ weights)
+    risk_contributions = weights * (covariance @ weights) / variance if variance > 0 else np.zeros(len(weights))
+
+    wealth = np.cumprod(1 + portfolio_returns)
+    drawdowns = wealth / np.maximum.accumulate(wealth) - 1
+    sorted_returns = np.sort(portfolio_returns)
+    metrics = {
+        "days": len(portfolio_returns),
+        "period_return": float(wealth[-1] - 1),
+        "annualised_return": float(wealth[-1] ** (TRADING_DAYS / len(portfolio_returns)) - 1),
+        "annualised_volatility": float(np.sqrt(variance)),
+        "max_drawdown": float(drawdowns.min()),
+        "sharpe_ratio_ex_rf": float(portfolio_returns.mean() / portfolio_returns.std(ddof=1) * np.sqrt(TRADING_DAYS)) if portfolio_returns.std(ddof=1) > 0 else None,
+    }
+    for confidence in (0.95, 0.99):
+        tail = sorted_returns[:max(1, int(np.floor(len(sorted_returns) * (1 - confidence))))]
+        label = int(confidence * 100)
+        metrics[f"var_{label}"] = float(-np.quantile(portfolio_returns, 1 - confidence) * value) # One day, historical
+        metrics[f"expected_shortfall_{label}"] = float(-tail.mean() * value)
+
+    betas = None
+    if benchmark_returns is not None:
+        centred_benchmark = benchmark_returns - benchmark_returns.mean()
+        benchmark_variance = centred_benchmark @ centred_benchmark
+        if benchmark_variance > 0:
+            betas = (returns - returns.mean(axis=0)).T @ centred_benchmark / benchmark_variance # Every position at once
+            metrics["beta"] = float(weights @ betas)
+            metrics["correlation_to_benchmark"] = float(np.corrcoef(portfolio_returns, benchmark_returns)[0, 1])
+
+    return {
+        "metrics": metrics,
+        "volatilities": volatilities,
+        "correlation": correlation,
+        "risk_contributions": risk_contributions,
+        "betas": betas,
+        "wealth": wealth,
+    }
+
+def highly_correlated_pairs(symbols: list, correlation: np.ndarray, threshold: float = 0.8, limit: int = 3) -> list:
+    """ The most correlated pairs of positions above the threshold, as (symbol, symbol, correlation). """
+    upper = np.triu_indices(len(correlation), k=1)
+    values = np.nan_to_num(correlation[upper])
+    order = np.argsort(-values)[:limit]
+    return [(symbols[upper[0][i]], symbols[upper[1][i]], float(values[i])) for i in order if values[i] >= threshold]
+
+def analyse_portfolio(portfolio: Portfolio, benchmark: str = DEFAULT_BENCHMARK, lookback_days: int = DEFAULT_LOOKBACK_DAYS) -> dict:
+    """ Values a portfolio and computes its exposures and risk.
+
+    Parameters:
+    - portfolio (Portfolio): the parsed portfolio.
+    - benchmark (str): the ticker to measure beta against.
+    - lookback_days (int): calendar days of price history to use for the risk figures.
+
+    Returns:
+    - (dict) the full breakdown: totals, positions, exposures, risk metrics and correlations. """
+
+    started_at = time.perf_counter()
+    symbols = portfolio.symbols.tolist()
+
+    # Value every position at the latest price, falling back to the price stored with the portfolio
+    quotes = market_data_cache.get_quotes(symbols) if symbols else {}
+    prices = np.array([(quotes.get(symbol) or {}).get("regularMarketPrice") or np.nan for symbol in symbols], dtype=np.float64)
+    prices = np.where(np.isnan(prices), portfolio.stored_prices, prices)
+    rates = fx_rates(portfolio.currencies, portfolio.base_currency)
+
+    market_values = np.nan_to_num(portfolio.quantities * prices * rates)
+    # Positions without a purchase price have no cost basis (NaN) rather than a cost of 0, which would count their whole
+    # value as P&L. They're left out of the cost and P&L totals
+    cost_bases = portfolio.quantities * portfolio.purchase_prices * rates
+    has_cost = ~np.isnan(cost_bases)
+    pnl = np.where(has_cost, market_values - cost_bases, np.nan)
+    total_value = float(market_values.sum())
+    total_cost = float(cost_bases[has_cost].sum())
+    total_pnl = float(pnl[has_cost].sum())
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weights = market_values / total_value if total_value else np.zeros(len(symbols))
+        pnl_percent = np.where(has_cost & (cost_bases > 0), pnl / cost_bases, np.nan)
+
+    # Risk, over the positions with enough price history
+    end = date.today() + timedelta(days=1)
+    start = end - timedelta(days=lookback_days)
+    history_symbols = list(dict.fromkeys(symbols + [benchmark]))
+    returns, dates = return_matrix(history_symbols, start.isoformat(), end.isoformat()) if symbols else (np.empty((0, 0)), [])
+    position_columns = np.array([history_symbols.index(symbol) for symbol in symbols], dtype=np.int64)
+    position_returns = returns[:, position_columns] if len(dates) else np.empty((0, len(symbols)))
+
+    # Use the days every included position has a price for, so the covariance is over one consistent window
+    has_history = (np.sum(~np.isnan(position_returns), axis=0) >= MIN_HISTORY_DAYS) & (weights > 0)
+    included = np.flatnonzero(has_history)
+    risk = None
+    if len(included):
+        window = ~np.isnan(position_returns[:, included]).any(axis=1)
+        benchmark_returns = returns[window, history_symbols.index(benchmark)]
+        if np.isnan(benchmark_returns).any(): # No beta if the benchmark doesn't cover the whole window
+            benchmark_returns = None
+        if window.sum() >= MIN_HISTORY_DAYS:
+            included_weights = weights[included] / weights[included].sum()
+            covered_value = float(market_values[included].sum())
+            risk = risk_metrics(position_returns[window][:, included], included_weights, benchmark_returns, covered_value)
+            risk["dates"] = [day for day, in_window in zip(dates, window) if in_window]
+
+    risk_columns = {int(i): column for column, i in enumerate(included)} if risk is not None else {}
+    positions = []
+    for i in np.argsort(-market_values):
+        position = {
+            "symbol": symbols[i],
+            "name": str(portfolio.names[i]),
+            "sector": str(portfolio.sectors[i]),
+            "currency": str(portfolio.currencies[i]),
+            "quantity": float(portfolio.quantities[i]),
+            "price": None if np.isnan(prices[i]) else float(prices[i]),
+            "market_value": float(market_values[i]),
+            "cost_basis": float(cost_bases[i]) if has_cost[i] else None,
+            "pnl": float(pnl[i]) if has_cost[i] else None,
+            "pnl_percent": None if np.isnan(pnl_percent[i]) else float(pnl_percent[i]),
+            "weight": float(weights[i]),
+        }
+        if int(i) in risk_columns:
+            column = risk_columns[int(i)]
+            position["volatility"] = float(risk["volatilities"][column])
+            position["risk_contribution"] = float(risk["risk_contributions"][column])
+            position["beta"] = None if risk["betas"] is None else float(risk["betas"][column])
+        positions.append(position)
+
+    breakdown = {
+        "base_currency": portfolio.base_currency,
+        "total_value": total_value,
+        "total_cost": total_cost,
+        "total_pnl": total_pnl,
+        "total_pnl_percent": total_pnl / total_cost if total_cost else None,
+        "positions": positions,
+        "sector_exposure": {sector: value / total_value for sector, value in share(market_values, portfolio.sectors).items()} if total_value else {},
+        "currency_exposure": {currency: value / total_value for currency, value in share(market_values, portfolio.currencies).items()} if total_value else {},
+        "benchmark": benchmark,
+        "risk": None,
+    }
+
+    if risk is not None:
+        included_symbols = [symbols[i] for i in included]
+        largest = np.sort(np.argsort(-weights[included], kind="stable")[:CORRELATION_POSITIONS])
+        breakdown["risk"] = {
+            **risk["metrics"],
+            "start_date": risk["dates"][0],
+            "end_date": risk["dates"][-1],
+            "covered_weight": float(weights[included].sum()),
+            "excluded_positions": [symbols[i] for i in np.flatnonzero(~has_history)],
+            "correlated_pairs": highly_correlated_pairs(included_symbols, risk["correlation"]),
+            "correlation": {
+                "symbols": [included_symbols[i] for i in largest],
+                "matrix": np.round(np.nan_to_num(risk["correlation"][np.ix_(largest, largest)]), 4).tolist(),
+            },
+            "performance": [{"date": day, "value": round(float(wealth) * 100, 4)} for day, wealth in zip(risk["dates"], risk["wealth"])],
+        }
+
+    breakdown["elapsed_ms"] = (time.perf_counter() - started_at) * 1000
+    return breakdown
+
+def summarise_breakdown(breakdown: dict) -> str:
+    """ A compact summary of the analysis for the model, a few hundred tokens whatever the size of the portfolio. """
+    currency = breakdown["base_currency"]
+    lines = [
+        f"Portfolio value {currency} {breakdown['total_value']:,.2f}, cost {currency} {breakdown['total_cost']:,.2f}, "
+        f"unrealised P&L {currency} {breakdown['total_pnl']:+,.2f}"
+        + (f" ({breakdown['total_pnl_percent'] * 100:+.2f}%)" if breakdown["total_pnl_percent"] is not None else "")
+        + f", {len(breakdown['positions'])} positions."
+    ]
+
+    top = breakdown["positions"][:SUMMARY_POSITIONS]
+    lines.append(f"Largest positions: " + "; ".join(
+        f"{position['symbol']} {position['weight'] * 100:.1f}% ({currency} {position['market_value']:,.0f}, P&L "
+        + (f"{position['pnl_percent'] * 100:+.1f}%)" if position["pnl_percent"] is not None else "n/a)")
+        for position in top
+    ))
+    lines.append("Sector exposure: " + ", ".join(f"{sector} {weight * 100:.1f}%" for sector, weight in breakdown["sector_exposure"].items()))
+    lines.append("Currency exposure: " + ", ".join(f"{code} {weight * 100:.1f}%" for code, weight in breakdown["currency_exposure"].items()))
+
+    risk = breakdown["risk"]
+    if risk is None:
+        lines.append("Risk figures unavailable: not enough price history.")
+        return "\n".join(lines)
+
+    lines.append(
+        f"Over {risk['start_date']} to {risk['end_date']} ({risk['days']} trading days, {risk['covered_weight'] * 100:.0f}% of the portfolio): "
+        f"return {risk['period_return'] * 100:+.2f}% ({risk['annualised_return'] * 100:+.2f}% annualised), "
+        f"volatility {risk['annualised_volatility'] * 100:.2f}% annualised, max drawdown {risk['max_drawdown'] * 100:.2f}%"
+        + (f", beta {risk['beta']:.2f} vs {breakdown['benchmark']}" if risk.get("beta") is not None else "") + "."
+    )
+    lines.append(
+        f"1-day historical VaR: 95% {currency} {risk['var_95']:,.0f}, 99% {currency} {risk['var_99']:,.0f}; "
+        f"expected shortfall 95% {currency} {risk['expected_shortfall_95']:,.0f}."
+    )
+    contributors = sorted((position for position in breakdown["positions"] if "risk_contribution" in position), key=lambda position: -position["risk_contribution"])[:3]
+    if contributors:
+        lines.append("Largest risk contributors: " + ", ".join(f"{position['symbol']} {position['risk_contribution'] * 100:.1f}%" for position in contributors))
+    if risk["correlated_pairs"]:
+        lines.append("Highly correlated: " + ", ".join(f"{first}/{second} {value:.2f}" for first, second, value in risk["correlated_pairs"]))
+    if risk["excluded_positions"]:
+        lines.append(f"Excluded from risk (not enough history): {', '.join(risk['excluded_positions'][:10])}")
+    return "\n".join(lines)
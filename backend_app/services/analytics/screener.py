@@ -0,0 +1,219 @@
+""" Screens and ranks the whole fundamentals table (fundamentals_table.py) at once.
+
+Filters and sort keys are written as expressions over the table's columns, e.g.
+
+    fcf_yield > 0.05 and net_debt_to_ebitda < 1
+    sector in ['Technology', 'Healthcare'] and revenue_growth >= 0.1
+    fcf_yield / pe
+
+Each expression is parsed once (and cached), then evaluated as NumPy operations over entire columns, so the cost
+barely depends on the number of companies. Only a small, safe subset of Python is accepted: column names, numbers,
+strings, lists, arithmetic, comparisons, and/or/not, and abs/log/min/max. Rows with missing data never pass a
+comparison, and sort last. Text comparisons ignore case. """
+
+from difflib import get_close_matches
+import ast
+import functools
+import numpy as np
+import operator
+import time
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+class ScreenError(ValueError):
+    """ Raised for a filter or sort expression that can't be evaluated, with a message the model can act on. """
+
+arithmetic_operators = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv, ast.Pow: operator.pow}
+comparison_operators = {ast.Gt: operator.gt, ast.GtE: operator.ge, ast.Lt: operator.lt, ast.LtE: operator.le, ast.Eq: operator.eq, ast.NotEq: operator.ne}
+functions = {"abs": (np.abs, 1), "log": (np.log, 1), "min": (np.fmin, 2), "max": (np.fmax, 2)} # Name to (ufunc, number of arguments)
+
+def is_text(value) -> bool:
+    return isinstance(value, str) or (isinstance(value, np.ndarray) and value.dtype.kind == "U")
+
+lowered_columns = {} # id of a text column to (the column, a lowercase copy), as lowering thousands of strings isn't free
+
+def lower(value):
+    if isinstance(value, str):
+        return value.lower()
+    cached = lowered_columns.get(id(value))
+    if cached is None or cached[0] is not value:
+        if len(lowered_columns) >= 32: # Old tables' columns, after a reload
+            lowered_columns.clear()
+        cached = (value, np.char.lower(value))
+        lowered_columns[id(value)] = cached
+    return cached[1]
+
+def compile_node(node, names: set):
+    """ Turns an expression node into a function of the table's columns. Column names used are added to names. """
+
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, str)) and not isinstance(node.value, bool):
+        value = node.value
+        return lambda columns: value
+
+    if isinstance(node, (ast.List, ast.Tuple)):
+        items = [compile_node(item, names) for item in node.elts]
+        return lambda columns: [item(columns) for item in items]
+
+    if isinstance(node, ast.Name):
+        name = node.id
+        names.add(name)
+        def column(columns):
+            if name not in columns:
+                suggestions = get_close_matches(name, columns, n=3)
+                raise ScreenError(f"Unknown column '{name}'." + (f" Did you mean {', '.join(suggestions)}?" if suggestions else ""))
+            return columns[name]
+        return column
+
+    if isinstance(node, ast.BoolOp):
+        operands = [compile_node(value, names) for value in node.values]
+        combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+        return lambda columns: functools.reduce(combine, (operand(columns) for operand in operands))
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.USub, ast.UAdd)):
+        operand = compile_node(node.operand, names)
+        if isinstance(node.op, ast.Not):
+            return lambda columns: np.logical_not(operand(columns))
+        sign = -1 if isinstance(node.op, ast.USub) else 1
+        return lambda columns: sign * operand(columns)
+
+    if isinstance(node, ast.BinOp) and type(node.op) in arithmetic_operators:
+        left, right = compile_node(node.left, names), compile_node(node.right, names)
+        apply = arithmetic_operators[type(node.op)]
+        def arithmetic(columns):
+            with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                result = apply(np.asarray(left(columns), dtype=np.float64), np.asarray(right(columns), dtype=np.float64))
+            return np.where(np.isfinite(result), result, np.nan)
+        return arithmetic
+
+    if isinstance(node, ast.Compare):
+        operands = [compile_node(operand, names) for operand in [node.left] + node.comparators]
+        for comparison in node.ops:
+            if type(comparison) not in comparison_operators and not isinstance(comparison, (ast.In, ast.NotIn)):
+                raise ScreenError(f"Unsupported comparison in '{ast.unparse(node)}'.")
+        def compare(columns):
+            values = [operand(columns) for operand in operands]
+            result = True
+            for comparison, left, right in zip(node.ops, values, values[1:]): # Chained, e.g. 0 < pe < 15
+                if isinstance(comparison, (ast.In, ast.NotIn)):
+                    options = right if isinstance(right, list) else [right]
+                    if is_text(left):
+                        left, options = lower(left), [lower(option) for option in options if isinstance(option, str)]
+                    matched = np.isin(left, options)
+                    result = np.logical_and(result, matched if isinstance(comparison, ast.In) else np.logical_not(matched))
+                    continue
+                if is_text(left) != is_text(right):
+                    raise ScreenError(f"Can't compare text with a number in '{ast.unparse(node)}'.")
+                if is_text(left):
+                    left, right = lower(left), lower(right)
+                    result = np.logical_and(result, comparison_operators[type(comparison)](left, right))
+                    continue
+                left, right = np.asarray(left, dtype=np.float64), np.asarray(right, dtype=np.float64)
+                with np.errstate(invalid="ignore"):
+                    passed = comparison_operators[type(comparison)](left, right) & ~np.isnan(left) & ~np.isnan(right) # Including !=
+                result = np.logical_and(result, passed)
+            return result
+        return compare
+
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in functions and not node.keywords:
+        function, arity = functions[node.func.id]
+        if len(node.args) != arity:
+            raise ScreenError(f"{node.func.id}() takes {arity} argument{'s' if arity > 1 else ''}, got {len(node.args)} in '{ast.unparse(node)}'.")
+        arguments = [compile_node(argument, names) for argument in node.args]
+        def call(columns):
+            with np.errstate(divide="ignore", invalid="ignore"):
+                result = function(*(np.asarray(argument(columns), dtype=np.float64) for argument in arguments))
+            return np.where(np.isfinite(result), result, np.nan)
+        return call
+
+    raise ScreenError(f"Unsupported expression '{ast.unparse(node)}'. Use column names, numbers, quoted text, lists, arithmetic, comparisons, and/or/not, and abs/log/min/max.")
+
+@functools.lru_cache(maxsize=512)
+def compile_expression(expression: str):
+    """ Parses an expression once. Returns (function of the columns, frozenset of the column names it uses). """
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ScreenError(f"Couldn't parse '{expression}': {e.msg}.")
+    names = set()
+    return compile_node(tree.body, names), frozenset(names)
+
+def evaluate(expression: str, columns: dict, rows: int):
+    function, names = compile_expression(expression)
+    try:
+        return np.broadcast_to(function(columns), (rows,)), names
+    except ScreenError:
+        raise
+    except (TypeError, ValueError) as e: # NumPy's errors, e.g. arithmetic on a text column ('sector + 1')
+        raise ScreenError(f"Couldn't evaluate '{expression}', check it only does arithmetic on numeric columns: {e}.")
+
+def screen(table, filters: list = None, sort_by: str = "market_cap", descending: bool = True, limit: int = DEFAULT_LIMIT,
+           latest_only: bool = True) -> dict:
+    """ Runs a screen over the fundamentals table.
+
+    Parameters:
+    - table (FundamentalsTable): the table to screen.
+    - filters (list): filter expressions, which all have to hold, e.g. ['fcf_yield > 0.05', 'net_debt_to_ebitda < 1'].
+    - sort_by (str): the expression to rank by, e.g. 'fcf_yield'.
+    - descending (bool): rank the highest values first.
+    - limit (int): the most rows to return.
+    - latest_only (bool): only screen each company's latest period. Otherwise every period is screened, e.g. to find
+      any year a company passed.
+
+    Returns:
+    - (dict) the matching rows (ranked, up to the limit), the number of matches, the size of the universe, the
+      columns used, and how long the screen took.
+
+    Raises:
+    - ScreenError if an expression can't be evaluated. """
+
+    started_at = time.perf_counter()
+    columns = table.columns
+    rows = len(table)
+    limit = min(max(int(limit or DEFAULT_LIMIT), 1), MAX_LIMIT)
+    if not rows:
+        return {"rows": [], "matches": 0, "universe": 0, "columns": [], "elapsed_ms": 0.0}
+
+    mask = columns["latest"].copy() if latest_only else np.ones(rows, dtype=bool)
+    used_columns = []
+    for expression in filters or []:
+        passed, names = evaluate(expression, columns, rows)
+        if passed.dtype != bool:
+            raise ScreenError(f"The filter '{expression}' isn't a condition, e.g. '{expression} > 0'.")
+        mask &= passed
+        used_columns.extend(names)
+
+    indices = np.flatnonzero(mask)
+    if sort_by:
+        sort_values, names = evaluate(sort_by, columns, rows)
+        if sort_values.dtype.kind not in "fi":
+            raise ScreenError(f"Can't rank by '{sort_by}', it isn't a number.")
+        used_columns.extend(names)
+        keys = sort_values[indices].astype(np.float64)
+        keys = np.where(np.isnan(keys), np.inf, -keys if descending else keys) # Missing values rank last
+        if limit < len(indices):
+            top = np.argpartition(keys, limit - 1)[:limit] # Only the top of the ranking needs sorting
+            indices = indices[top[np.argsort(keys[top], kind="stable")]]
+        else:
+            indices = indices[np.argsort(keys, kind="stable")]
+    matches = int(mask.sum())
+    indices = indices[:limit]
+
+    output_columns = ["ticker", "name", "sector", "fiscal_year"] + [name for name in dict.fromkeys(used_columns) if name not in ("ticker", "name", "sector", "fiscal_year")]
+    results = []
+    for index in indices:
+        row = {}
+        for name in output_columns:
+            value = columns[name][index]
+            row[name] = value.item() if isinstance(value, np.generic) else value
+        if sort_by and sort_by not in output_columns: # A computed ranking, e.g. 'fcf_yield / pe'
+            row[sort_by] = float(sort_values[index])
+        results.append(row)
+
+    return {
+        "rows": results,
+        "matches": matches,
+        "universe": int(columns["latest"].sum()),
+        "columns": output_columns + ([sort_by] if sort_by and sort_by not in output_columns else []),
+        "elapsed_ms": (time.perf_counter() - started_at) * 1000,
+    }
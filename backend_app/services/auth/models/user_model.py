@@ -1,10 +1,8 @@
 from pydantic import BaseModel
 from sqlalchemy import Table, Column, Integer, String, Boolean 
-from sqlalchemy.ext.declarative import declarative_base
 from fastapi_users.db import SQLAlchemyBaseUserTableUUID
 from fastapi_users import schemas
-
-Base = declarative_base()
+from backend_app.services.data_access_layer.models import Base # Shared, so the portfolio and conversation tables can reference users
 
 class UserTable(SQLAlchemyBaseUserTableUUID, Base):
     __tablename__ = "users"
@@ -0,0 +1,111 @@
+""" Resolves the signed in user for /chat without a database query on most requests.
+
+The JWT in the goose cookie is verified in process (the same secret, audience and expiry checks as the fastapi_users
+JWTStrategy in auth.py). The user it names is then looked up in a TTL/LRU cache, and only loaded from the users table on
+a miss. UserManager drops a user's entry whenever they're updated (including deactivation), reset their password, or are
+deleted, so changes made through this process apply straight away. Changes made on another replica apply when the
+entry expires (USER_CACHE_TTL_SECONDS).
+
+Resolved users are read-only snapshots (UserDB), never ORM rows, so they're safe to share between requests. """
+
+from backend_app.services.auth.auth import SECRET_KEY, get_jwt_strategy, cookie_transport
+from backend_app.services.auth.models.user_model import UserTable, UserDB
+from backend_app.services.data_access_layer.database_connection import async_session_maker
+from collections import OrderedDict
+from fastapi import Request
+from fastapi_users.jwt import decode_jwt
+import jwt
+import os
+import threading
+import time
+
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", 60))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", 10000))
+
+class UserCache:
+    def __init__(self, ttl_seconds: float = USER_CACHE_TTL_SECONDS, max_entries: int = USER_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.users = OrderedDict() # User id to (expires_at, UserDB), least recently used first
+        self.lock = threading.Lock() # UserManager hooks can run on other threads
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int) -> UserDB:
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.users.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user: UserDB):
+        with self.lock:
+            self.users[user.id] = (time.monotonic() + self.ttl_seconds, user)
+            self.users.move_to_end(user.id)
+            while len(self.users) > self.max_entries:
+                self.users.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        with self.lock:
+            if self.users.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.users.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.users),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+user_cache = UserCache()
+jwt_strategy = get_jwt_strategy()
+
+def user_id_from_token(token: str) -> int:
+    """ Verifies a JWT issued by the login route. Returns the user id it was issued for, or None if it isn't valid. """
+    try:
+        data = decode_jwt(token, jwt_strategy.decode_key, jwt_strategy.token_audience, algorithms=[jwt_strategy.algorithm])
+        return int(data["sub"])
+    except (jwt.PyJWTError, KeyError, TypeError, ValueError):
+        return None
+
+async def load_user(user_id: int) -> UserDB:
+    async with async_session_maker() as session:
+        user = await session.get(UserTable, user_id)
+        return UserDB.model_validate(user) if user is not None else None
+
+async def resolve_user(request: Request) -> UserDB:
+    """ Returns the signed in, active user for a request, or None if there isn't one (no cookie, or an invalid or expired
+    token, or the user no longer exists or has been deactivated). The same outcome as fastapi_users'
+    current_user(optional=True, active=True), without its per-request session and query. If the users table can't be
+    read, the request is treated as signed out rather than failing. """
+
+    token = request.cookies.get(cookie_transport.cookie_name)
+    if not token or not SECRET_KEY:
+        return None
+    user_id = user_id_from_token(token)
+    if user_id is None:
+        return None
+
+    user = user_cache.get(user_id)
+    if user is None:
+        try:
+            user = await load_user(user_id)
+        except Exception as e:
+            print(f"Couldn't load user {user_id}, treating the request as signed out: {e}")
+            return None
+        if user is None:
+            return None
+        user_cache.put(user) # Inactive users are cached too, so a deactivated account doesn't cost a query per request
+    return user if user.is_active else None
@@ -1,13 +1,24 @@
-from fastapi_users.manager import BaseUserManager, UserManagerDependency
+from fastapi_users.manager import BaseUserManager, IntegerIDMixin, UserManagerDependency
 from backend_app.services.auth.models.user_model import UserDB
 from backend_app.services.auth.user_database import get_user_db
+from backend_app.services.auth.user_cache import user_cache
 from fastapi import Depends
 
-class UserManager(BaseUserManager[UserDB, int]):
+class UserManager(IntegerIDMixin, BaseUserManager[UserDB, int]): # IntegerIDMixin parses the ids in tokens, as users have integer ids
     user_db_model = UserDB
 
     async def on_after_register(self, user: UserDB, request=None):
         print(f"User {user.id} has registered.")
 
+    # Drop the cached copy whenever a user changes, so chat requests see it straight away (see user_cache.py)
+    async def on_after_update(self, user: UserDB, update_dict: dict, request=None):
+        user_cache.invalidate(user.id)
+
+    async def on_after_reset_password(self, user: UserDB, request=None):
+        user_cache.invalidate(user.id)
+
+    async def on_after_delete(self, user: UserDB, request=None):
+        user_cache.invalidate(user.id)
+
 async def get_user_manager(user_db=Depends(get_user_db)):
-    yield UserManager(user_db)
\ No newline at end of file
+    yield UserManager(user_db)
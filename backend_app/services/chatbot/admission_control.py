@@ -0,0 +1,178 @@
+""" Admission control for /chat. Each worker answers at most CHAT_MAX_ACTIVE_STREAMS chats at once, so a burst of users
+can't push hundreds of concurrent LLM, market data and news calls through one event loop and slow every answer down
+together.
+
+Requests over the limit wait in a short queue, in priority order: interactive chat goes ahead of background work (e.g.
+a client prefetching an answer, which it marks with the X-Chat-Priority: background header). Background requests only
+ever take up to CHAT_BACKGROUND_MAX_ACTIVE of the slots, so there's always room kept for interactive ones.
+
+Each queued request has a deadline. A request is turned away with Overloaded (a 503 with a Retry-After, see app.py)
+straight away if the queue is full, or if at the rate chat streams usually finish it wouldn't get a slot before its
+deadline, and otherwise if it's still queued when its deadline passes. Failing fast lets the client try again (or the
+load balancer send it to another pod) rather than holding a connection open for an answer that won't come in time.
+
+Active streams, queue depth and queue wait are exported on /metrics (finllm_chat_*) for autoscaling, see
+k8s/backend.yaml. Only used from the event loop, so it doesn't need a lock. """
+
+from backend_app.services.monitoring.metrics import CHAT_ADMISSIONS, CHAT_ADMISSION_WAIT, expected_seconds
+from backend_app.services.upstream.upstream_scheduler import INTERACTIVE, BACKGROUND
+from starlette.responses import StreamingResponse
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+
+MAX_ACTIVE_STREAMS = int(os.getenv("CHAT_MAX_ACTIVE_STREAMS", 32)) # Each stream can make several LLM calls at once (tools, agents)
+BACKGROUND_MAX_ACTIVE = int(os.getenv("CHAT_BACKGROUND_MAX_ACTIVE", MAX_ACTIVE_STREAMS // 2))
+MAX_QUEUED = int(os.getenv("CHAT_MAX_QUEUED", 64))
+INTERACTIVE_DEADLINE_SECONDS = float(os.getenv("CHAT_QUEUE_DEADLINE_SECONDS", 5))
+BACKGROUND_DEADLINE_SECONDS = float(os.getenv("CHAT_BACKGROUND_QUEUE_DEADLINE_SECONDS", 15))
+
+PRIORITY_HEADER = "X-Chat-Priority"
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+PRIORITIES = {name: priority for priority, name in PRIORITY_NAMES.items()}
+
+class Overloaded(Exception):
+    """ Raised when a chat request can't be admitted. retry_after is when to try again, in seconds. """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+class Slot:
+    """ A chat stream's place in the active streams, given back with release() once it's over. """
+
+    def __init__(self, controller, priority: int):
+        self.controller = controller
+        self.priority = priority
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(self.priority)
+
+class AdmissionController:
+    def __init__(self, max_active: int = MAX_ACTIVE_STREAMS, background_max_active: int = BACKGROUND_MAX_ACTIVE,
+                 max_queued: int = MAX_QUEUED, interactive_deadline: float = INTERACTIVE_DEADLINE_SECONDS,
+                 background_deadline: float = BACKGROUND_DEADLINE_SECONDS):
+        self.max_active = max_active
+        self.background_max_active = background_max_active
+        self.max_queued = max_queued
+        self.deadlines = {INTERACTIVE: interactive_deadline, BACKGROUND: background_deadline}
+
+        self.active = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.queue = [] # Heap of (priority, sequence number, queued_at, future) for the requests waiting on a slot
+        self.sequence = itertools.count()
+
+    def can_start(self, priority: int) -> bool:
+        if sum(self.active.values()) >= self.max_active:
+            return False
+        return priority == INTERACTIVE or self.active[BACKGROUND] < self.background_max_active
+
+    def estimated_wait(self, position: int) -> float:
+        """ Roughly how long until the request at position in the queue gets a slot, going on how long chat streams
+        usually take. 0 until one has finished. """
+        return (position + 1) / self.max_active * (expected_seconds("chat", "stream") or 0.0)
+
+    def reject(self, priority: int, result: str, message: str, retry_after: float):
+        CHAT_ADMISSIONS.labels(PRIORITY_NAMES[priority], result).inc()
+        print(f"Chat request not admitted ({result}): {message}")
+        return Overloaded(message, retry_after)
+
+    def start(self, priority: int, queued_at: float) -> Slot:
+        CHAT_ADMISSIONS.labels(PRIORITY_NAMES[priority], "admitted").inc()
+        CHAT_ADMISSION_WAIT.labels(PRIORITY_NAMES[priority]).observe(time.monotonic() - queued_at)
+        return Slot(self, priority)
+
+    def remove(self, entry: tuple):
+        if entry in self.queue:
+            self.queue.remove(entry)
+            heapq.heapify(self.queue)
+
+    async def admit(self, priority: int = INTERACTIVE) -> Slot:
+        """ Waits for a stream slot.
+
+        Parameters:
+        - priority (int): INTERACTIVE or BACKGROUND.
+
+        Returns:
+        - the Slot, to release() once the stream is over.
+
+        Raises:
+        - Overloaded if there's no slot for the request before its deadline. """
+
+        queued_at = time.monotonic()
+        ahead = sum(1 for entry in self.queue if entry[0] <= priority)
+        if not ahead and self.can_start(priority):
+            self.active[priority] += 1
+            return self.start(priority, queued_at)
+
+        deadline = self.deadlines[priority]
+        estimated_wait = self.estimated_wait(ahead)
+        if estimated_wait > deadline:
+            raise self.reject(priority, "rejected", f"{ahead} requests ahead, about {estimated_wait:.1f}s to wait", estimated_wait)
+        if len(self.queue) >= self.max_queued:
+            # Make room by shedding the newest request of the lowest priority, as long as it's behind this one
+            newest = max(self.queue)
+            if newest[0] <= priority:
+                raise self.reject(priority, "rejected", "the queue is full", estimated_wait)
+            self.remove(newest)
+            newest[3].set_exception(self.reject(newest[0], "shed", "shed for a higher priority request", self.estimated_wait(len(self.queue))))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self.sequence), queued_at, future)
+        heapq.heappush(self.queue, entry)
+        try:
+            await asyncio.wait((future,), timeout=deadline)
+        except asyncio.CancelledError: # The client went away while queued
+            self.remove(entry)
+            if future.done() and not future.exception():
+                self.release(priority)
+            raise
+
+        if not future.done():
+            self.remove(entry)
+            raise self.reject(priority, "timed_out", f"no slot within {deadline}s", self.estimated_wait(len(self.queue)))
+        future.result() # Raises Overloaded if it was shed
+        return self.start(priority, queued_at)
+
+    def release(self, priority: int):
+        self.active[priority] -= 1
+        # Hand the slot to the next request that can take it. The slot is counted as taken straight away, so nobody
+        # arriving before the waiter wakes up can take it too
+        while self.queue and self.can_start(self.queue[0][0]):
+            next_priority, _, _, future = heapq.heappop(self.queue)
+            self.active[next_priority] += 1
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        queue = list(self.queue) # Read from the /metrics thread
+        active = sum(self.active.values())
+        return {
+            "active": active,
+            "active_background": self.active[BACKGROUND],
+            "max_active": self.max_active,
+            "queue_depth": {name: sum(1 for entry in queue if entry[0] == priority) for priority, name in PRIORITY_NAMES.items()},
+            "oldest_wait_seconds": max((now - entry[2] for entry in queue), default=0.0),
+            "saturation": (active + len(queue)) / self.max_active,
+        }
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """ A StreamingResponse that gives its Slot back once it's over, however it ends (including the client going away
+    before the stream has started, when the stream's own clean up never runs). """
+
+    def __init__(self, slot: Slot, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.slot.release()
+
+admission_controller = AdmissionController()
@@ -1,94 +1,149 @@
-from openai import AsyncOpenAI #import the async supported open ai client
 from dotenv import load_dotenv 
 import json
 import datetime
 from backend_app.services.chatbot import functions
+from backend_app.services.chatbot.conversation_store import ConversationStore
+from backend_app.services.data_access_layer.repositories import conversation_repository
+from backend_app.services.chatbot.response_cache import response_cache, standalone_question
+from backend_app.services.chatbot.tool_executor import ToolExecutor
+from backend_app.services.chatbot.tool_call_assembler import ToolCallAssembler
+from backend_app.services.llm.llm_gateway import llm_gateway
 import re
 import os
 
 load_dotenv()
-aclient = AsyncOpenAI()
 
 system_prompt = f"Today's date is {datetime.date.today()}. The You are a friendly CFA level financial advisor and analyst first and foremost. Respond in a technical, information-dense format, using specific data points, facts, and figures where applicable. Use available context to answer comprehensively, avoiding the need for follow-up questions. For specific questions, provide detailed techincal analyses where you can. For broader queries, provide a short but comprehensive overview that offers the user the opportunity to delve deeper. Sound like a professional analyst - assume the user is knowledgeable about finance (including investing). Avoid being overly polite. Be concise. You have tools at your disposal, use them liberally - they will give you access to regulatory filings and up-to-date stock prices. Every public company should be formatted as [CompanyName (TICKER)](/company/TICKER) in every instance, including lists and sentences. Example: [Apple (AAPL)](/company/AAPL), [Tesla (TSLA)](/company/TSLA), etc. If the company is not publicly traded, use the format [CompanyName (Private)](/company/CompanyName) instead, like so: [Holtec (Private)](/company/Holtec)"
 model_choice = "gpt-4o-mini"
-messages = [{"role": "system", "content": system_prompt}]
+PERSIST_CONVERSATIONS = os.getenv("CHAT_PERSIST_CONVERSATIONS", "true").lower() == "true"
+# Per-conversation histories, keyed by the conversation_id sent by the frontend, and saved to the database so they
+# survive restarts and can be picked up by any replica
+conversation_store = ConversationStore(system_prompt, repository=conversation_repository if PERSIST_CONVERSATIONS else None)
 
 file_path = os.path.join(os.path.dirname(__file__), "tools.json")
 with open(file_path, "r") as tools_file:
     tools = json.load(tools_file)
 
-async def get_chatgpt_stream(chat_history):
-    # Parsing chat history and adding to messages list for correct formatting
-    parse_and_add_messages(chat_history)
+async def get_chatgpt_stream(chat_history, user_id=None):
+    functions.current_user_id.set(user_id)
+    conversation = await conversation_store.load_conversation(chat_history.get("conversation_id"), user_id)
 
+    # Parsing chat history and adding to the conversation for correct formatting
+    parse_and_add_messages(chat_history, conversation)
     try:
-        # Creating completions chat
-        response = create_completions_chat(model_choice, messages, "auto")
+        async for chunk in answer(conversation):
+            yield chunk
+    finally:
+        conversation_store.save_conversation(conversation) # In the background, once the turn has finished
 
-        # Compile function calls list with function id's, names, and arguments
-        function_calls = []
+async def answer(conversation):
+    """ Streams the answer to the conversation's latest message, from the response cache or the model. """
+
+    # Standalone questions can be answered from the response cache (if it's enabled). The frontend sends the answer
+    # back with the next message, so a replayed answer ends up in the conversation just like a generated one
+    cached, recorder = None, None
+    question = standalone_question(conversation) if response_cache.enabled else None
+    if question:
+        try:
+            cached, recorder = await response_cache.lookup(question)
+        except Exception as e:
+            print(f"Response cache lookup failed, answering without it: {e}")
+    if cached:
+        for chunk in cached.chunks:
+            yield chunk
+        return
+
+    tool_executor = ToolExecutor()
+    tools_used = [] # (name, output) of each finished tool, so we know how long the answer can be cached for
+
+    try:
+        async for chunk in generate_response(conversation, tool_executor, tools_used):
+            if recorder:
+                recorder.add_chunk(chunk)
+            yield chunk
+
+        if recorder:
+            for name, tool_output in tools_used:
+                recorder.add_tool_output(name, tool_output)
+            recorder.finish()
+
+    except Exception as e:
+        print(f"Error in get_chatgpt_stream: {e}")
+        raise # The /chat stream tells the client with an error event
+    finally:
+        tool_executor.cancel() # Stop any tools still running if the stream ended early
+
+async def generate_response(conversation, tool_executor, tools_used):
+    """ Streams the model's response to the conversation, running any tools it calls.
+
+    Parameters:
+    - conversation (Conversation): the conversation to respond to.
+    - tool_executor (ToolExecutor): runs the tool calls, cancelled by the caller if the stream ends early.
+    - tools_used (list): has the (name, output) of each finished tool appended to it.
+
+    Returns:
+    - (AsyncGenerator) text chunks and UI payloads, in the order they should be sent to the client. """
+
+    messages = conversation.get_context_window() # System prompt plus the newest messages that fit in the token budget
+
+    # Creating completions chat
+    response = create_completions_chat(model_choice, messages, "auto")
+
+    # Assemble tool calls as they stream in. Each one is started as soon as its arguments are complete, while the
+    # model carries on emitting the rest of the response
+    tool_call_assembler = ToolCallAssembler()
+    tools_output = 0
+
+    async for chunk in response:
+        # Grabbing token usage
+        if not chunk.choices:
+            print(f"Total token usage: {chunk.usage.total_tokens}") # Can also add prompt tokens and completion tokens
+            continue
+
+        chunk = chunk.choices[0].delta
+        # Returning regular responses
+        if chunk.content:
+            yield chunk.content
+        # Grabbing function calls, and starting any that are complete
+        elif chunk.tool_calls:
+            for tool_call in tool_call_assembler.add_delta(chunk.tool_calls):
+                print(f"Calling function: {tool_call.name}, args: {tool_call.arguments}")
+                tool_executor.submit(tool_call)
+
+        # Pass back any tools that have already finished
+        for tool_call, tool_output in tool_executor.pop_completed():
+            tools_output += not tool_output.get("partial")
+            ui_output = add_tool_output(conversation, tool_call, tool_output, tools_used)
+            if ui_output:
+                yield ui_output
+
+    # Start anything the stream ended on before we could tell it was complete
+    for tool_call in tool_call_assembler.flush():
+        print(f"Calling function: {tool_call.name}, args: {tool_call.arguments}")
+        tool_executor.submit(tool_call)
+
+    # Process the remaining function calls as each one finishes
+    async for tool_call, tool_output in tool_executor.as_completed():
+        tools_output += not tool_output.get("partial")
+        ui_output = add_tool_output(conversation, tool_call, tool_output, tools_used)
+        if ui_output:
+            yield ui_output
+
+    # Check if tools_output list contains as values, if it does pass it back to the model to stream its response
+    if tools_output > 0:
+        messages = conversation.get_context_window()
+        response = create_completions_chat(model_choice, messages, "none")
         async for chunk in response:
             # Grabbing token usage
             if not chunk.choices:
                 print(f"Total token usage: {chunk.usage.total_tokens}") # Can also add prompt tokens and completion tokens
-                continue
-
-            chunk = chunk.choices[0].delta
-            # Returning regular responses
-            if chunk.content:
-                yield chunk.content
-            # Grabbing function id and name
-            elif chunk.tool_calls and chunk.tool_calls[0].function.name:
-                function_id = chunk.tool_calls[0].id
-                function_name = chunk.tool_calls[0].function.name
-                function_arguments = "" # Clearing argument from previous call, if there was one
-                function_list = [function_id, function_name, function_arguments]
-                function_calls.append(function_list)
-            # Grabbing function arguments
-            elif chunk.tool_calls:
-                function_index = chunk.tool_calls[0].index
-                function_arguments += chunk.tool_calls[0].function.arguments # Creating arguments string with each chunk
-                function_calls[function_index][2] = function_arguments # Replacing argument value in list, until its complete
-
-        # Check if function_calls exists, and if its a single list then wrap it for the loop below
-        if function_calls and not isinstance(function_calls[0], list):
-            function_calls = [function_calls]
-
-        tools_output = 0
-
-        # Process each function call in function calls
-        for function_call in function_calls:
-            print(f"Calling function: {function_call[1]}, args: {function_call[2]}")
-            tool_output = await functions.execute_function_call(function_call[1], function_call[2]) # Tool output is returned as a dict, await as the ex_fn_call is async
-            if(tool_output["ui_type"] != "text"): # ui_type 'text' are treated as normal - this indicates no special UI is required 
-                yield tool_output
-            tool_output_content = tool_output["response_content"] # The content relevant for the model is extracted and passed back into the model
-            tools_output += 1
-            messages.append({
-                "role": "function",
-                "tool_call_id": function_call[0],
-                "name": function_call[1],
-                "content": tool_output_content
-            })
-
-        # Check if tools_output list contains as values, if it does pass it back to the model to stream its response
-        if tools_output > 0:
-            response = create_completions_chat(model_choice, messages, "none")
-            async for chunk in response:
-                # Grabbing token usage
-                if not chunk.choices:
-                    print(f"Total token usage: {chunk.usage.total_tokens}") # Can also add prompt tokens and completion tokens
-                # Returning response
-                elif chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
-
-    except Exception as e:
-        # Log the error without yielding it to the response
-        print(f"Error in get_chatgpt_stream: {e}")
+            # Returning response
+            elif chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
 
 
 async def create_completions_chat(model_choice, messages, tool_choice):
-    response = await aclient.chat.completions.create(model=model_choice,
+    response = llm_gateway.stream_chat("chat", model=model_choice,
     messages=messages,
     tools=tools,  # Lists tools for the model's usage
     tool_choice=tool_choice,  # "none" = message only, "auto" = message/tools, "required" = tools only
@@ -99,14 +154,42 @@ async def create_completions_chat(model_choice, messages, tool_choice):
     async for chunk in response:  # Ensure this yields chunks properly, needed for async generator
         yield chunk
 
+def add_tool_output(conversation, tool_call, tool_output, tools_used=None):
+    """ Adds a tool's output to the conversation so it's passed back into the model.
+
+    Partial updates from streaming tools (e.g. get_news) are only for the UI, the model just sees the final output.
+
+    Returns:
+    - the tool output if it needs to be displayed in the UI, otherwise None """
+
+    if tool_output.get("partial"):
+        return tool_output
+
+    conversation.add_message({
+        "role": "function",
+        "tool_call_id": tool_call.id,
+        "name": tool_call.name,
+        "content": tool_output["response_content"] # The content relevant for the model is extracted and passed back into the model
+    })
+    if tools_used is not None:
+        tools_used.append((tool_call.name, tool_output))
+
+    if tool_output["ui_type"] != "text": # ui_type 'text' are treated as normal - this indicates no special UI is required
+        return tool_output
+    return None
+
 # Parse chat history from FastAPI into required format for openai api
-def parse_and_add_messages(data):
+def parse_and_add_messages(data, conversation):
+    # The conversation already holds everything before the most recent two messages. If it's new (first message, or
+    # it was evicted) then seed it with all of the history the frontend sent instead
+    recent_messages = data['message'][-2:] if conversation.messages else data['message']
+
     cleaned_messages = []
-    # Clean the most recent two messages to remove HTML tags
-    for msg in data['message'][-2:]:
+    # Clean the messages to remove HTML tags
+    for msg in recent_messages:
         cleaned_messages.append({
             "role": msg["role"],
             "content": re.sub(r'<.*?>', '', msg['content']).strip()
         })
     
-    messages.extend(cleaned_messages)
\ No newline at end of file
+    conversation.add_messages(cleaned_messages)
\ No newline at end of file
@@ -0,0 +1,108 @@
+""" Runs each /chat answer in a task of its own, which the response reads from, so the answer can be cancelled cleanly
+as soon as nobody is reading it.
+
+The client going away (the tab is closed, or the request is aborted to send a new message) is picked up by the response:
+Starlette cancels it when the server reports the disconnect, or a write fails (hence the heartbeats, see read()). Either
+way the response stops reading and cancels the answer. That stops it wherever it is: the upstream completion is closed
+(llm_gateway.stream_chat), and running tools are cancelled (ToolExecutor.cancel), which cancels their agents
+(Orchestration.cancel) and any news summaries no other request is waiting for (NewsService). Running the answer in
+its own task means the clean up only sees the one cancellation, rather than running under the response's cancel scope,
+where every await (e.g. closing the upstream connection) would be cancelled too.
+
+A new request for a conversation that's still being answered supersedes the old one, which is cancelled the same way,
+so users sending another message (or regenerating) while an answer is streaming don't pay for one nobody will read.
+
+What each cancellation saved is estimated from how long (and how many tokens) the same work usually takes, see
+metrics.record_cancelled(). """
+
+from backend_app.services.monitoring.metrics import record_finished, record_cancelled
+import asyncio
+import time
+
+END = object() # Queued once there's nothing more to read
+
+active_streams = {} # (user id, conversation id) to the ChatStream answering it
+
+def supersede(key: tuple):
+    """ Cancels the stream answering a conversation, if there is one, for a newer request. """
+    previous = active_streams.get(key) if key is not None else None
+    if previous is not None:
+        previous.cancel(superseded=True)
+
+class ChatStream:
+    def __init__(self, chunks, key: tuple = None):
+        """ Parameters:
+        - chunks: the answer, an async generator of text chunks and UI payloads (chat_logic.get_chatgpt_stream).
+        - key (tuple): the (user id, conversation id) being answered, or None if there's no conversation id. """
+
+        self.chunks = chunks
+        self.key = key
+        self.queue = asyncio.Queue() # Unbounded, answers are small and the response reads them as fast as it can
+        self.task = None
+        self.started_at = None
+        self.cancelled = False
+        self.superseded = False
+
+    def start(self):
+        """ Starts answering, superseding any stream still answering the same conversation. Called from within the
+        request, so the task sees its context variables (e.g. metrics.request_usage). """
+
+        if self.key is not None:
+            supersede(self.key)
+            active_streams[self.key] = self
+        self.started_at = time.perf_counter()
+        self.task = asyncio.create_task(self.produce())
+        self.task.add_done_callback(lambda _: self.finish())
+
+    async def produce(self):
+        try:
+            async for chunk in self.chunks:
+                self.queue.put_nowait(chunk)
+            record_finished("chat", "stream", time.perf_counter() - self.started_at)
+            self.queue.put_nowait(END)
+        except Exception as e:
+            self.queue.put_nowait(e) # Raised to the reader
+        finally:
+            await self.chunks.aclose()
+
+    def finish(self):
+        if self.key is not None and active_streams.get(self.key) is self:
+            del active_streams[self.key]
+
+    def cancel(self, superseded: bool = False):
+        """ Cancels the answer, if it's still running.
+
+        Parameters:
+        - superseded (bool): whether it's being cancelled for a newer request rather than because the client went away. """
+
+        if self.task is None or self.task.done() or self.cancelled:
+            return
+        self.cancelled = True
+        self.superseded = superseded
+        self.task.cancel()
+        self.queue.put_nowait(END) # Ends the reader, if there still is one, after whatever was already queued
+
+        elapsed = time.perf_counter() - self.started_at
+        seconds_saved, _ = record_cancelled("chat", "stream", elapsed)
+        print(f"Chat stream {'superseded' if superseded else 'cancelled'} after {elapsed:.2f}s, about {seconds_saved:.2f}s of work saved")
+
+    async def read(self, idle_seconds: float):
+        """ Reads the answer, raising anything it raised.
+
+        Parameters:
+        - idle_seconds (float): how long to wait with nothing to read before yielding None, so the caller can write a
+          heartbeat. A timer rather than a timeout on each read, so reading a chunk doesn't cost an extra task. """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.queue.empty():
+                timer = loop.call_later(idle_seconds, self.queue.put_nowait, None)
+                chunk = await self.queue.get()
+                timer.cancel()
+            else:
+                chunk = self.queue.get_nowait()
+            if chunk is END:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
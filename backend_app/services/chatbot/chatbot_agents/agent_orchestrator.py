@@ -1,133 +1,243 @@
-""" Handles all code pertaining to the orchestrating agent. Responsible for taking queries from the chatbot and directing them 
-to appropriate agents to yield additional context for augmented generation. """
+""" Handles all code pertaining to the orchestrating agent. Responsible for taking queries from the chatbot and directing them
+to appropriate agents to yield additional context for augmented generation.
+
+One AgentOrchestrator lives for the life of the app (agent_orchestrator, below), holding a single instance of each
+agent so that anything an agent sets up on first use is kept between calls. Within an orchestration:
+- Agents are started as soon as their call has streamed in from the model, and independent agents run in parallel.
+- An agent can depend on others (the 'depends_on' argument in agent_orchestrator_tools.json). It waits for those to
+  finish and gets their results added to its instructions. Cycles and unknown agents are ignored.
+- Each agent has a deadline. An agent that misses it is stopped and reported as timed out, and the rest of the results
+  are returned as normal. The whole orchestration also has a deadline, shorter than the tool timeout in
+  tool_executor.py, so partial results are always returned rather than the tool timing out.
+- If the orchestration is cancelled (e.g. the client has gone away), every agent still running is cancelled too. """
 
-from openai import AsyncOpenAI
 from backend_app.Agents import BaseAgent
 from backend_app.services.data_access_layer.data_layer_agents.company_data_agent import CompanyDataAgent
+from backend_app.services.data_access_layer.data_layer_agents.screening_agent import ScreeningAgent
+from backend_app.services.chatbot.tool_call_assembler import ToolCallAssembler
+from backend_app.services.llm.llm_gateway import llm_gateway
+from backend_app.services.monitoring.metrics import timed_stage, AGENT_DURATION, AGENT_RUNS
 import os
-import json 
+import json
 import asyncio
+import time
 
-system_prompt = f"You're the orchestrating agent for a financial market research application. You will receive user prompts from the front-end chatbot agent and are to decide which agents to call on to fully satisfy the user request. You must call each agent once and only once. You may not make multiple calls to the same agent. Therefore, you must be sure to include all relevant context in your singular allowed agent call."
+system_prompt = f"You're the orchestrating agent for a financial market research application. You will receive user prompts from the front-end chatbot agent and are to decide which agents to call on to fully satisfy the user request. You must call each agent once and only once. You may not make multiple calls to the same agent. Therefore, you must be sure to include all relevant context in your singular allowed agent call. If an agent needs the results of another agent, list that agent in its depends_on, otherwise leave depends_on empty so the agents run in parallel."
 model_choice = "gpt-4o-mini"
 
+AGENT_DEADLINE_SECONDS = float(os.getenv("AGENT_DEADLINE_SECONDS", 25))
+ORCHESTRATION_DEADLINE_SECONDS = float(os.getenv("ORCHESTRATION_DEADLINE_SECONDS", 50)) # Under the agent_orchestrator tool timeout
+DEADLINE_MARGIN_SECONDS = 1.0 # Time left for an agent to put together a partial result before its deadline
+
+# Agents that are expected to take longer (or shorter) than the default
+agent_deadlines = {
+    "company_data_agent": 20,
+    "screening_agent": 15,
+}
+
 file_path = os.path.join(os.path.dirname(__file__), "agent_orchestrator_tools.json")
 with open(file_path, "r") as tools_file:
     tools = json.load(tools_file)
 
+class AgentRun:
+    """ A single agent call within an orchestration. """
+
+    def __init__(self, name: str, arguments: dict):
+        self.name = name
+        self.arguments = arguments
+        self.depends_on = [dependency for dependency in dict.fromkeys(arguments.get("depends_on") or []) if dependency != name]
+        self.task = None
+        self.status = "pending" # ok, error, timeout or cancelled once finished
+        self.result = None
+
+class Orchestration:
+    """ The agent runs from a single orchestrate_agents call. """
+
+    def __init__(self, orchestrator):
+        self.orchestrator = orchestrator
+        self.runs = {} # Agent name to its AgentRun, in the order they were called
+        self.all_launched = asyncio.Event() # Set once the model has finished calling agents, so dependencies are known
+
+    def launch(self, tool_call):
+        """ Starts the agent requested by a completed tool call.
+
+        Parameters:
+        - tool_call (ToolCall): the completed call from the ToolCallAssembler. """
+
+        if tool_call.name not in self.orchestrator.available_agents:
+            print(f"Error in agent_orchestrator.py: Agent {tool_call.name} does not exist.")
+            return
+        if tool_call.name in self.runs:
+            print(f"AgentOrchestrator: ignoring a second call to {tool_call.name}")
+            return
+
+        run = AgentRun(tool_call.name, tool_call.parsed_arguments())
+        print(f"AgentOrchestrator: calling on {run.name} with prompt: '{run.arguments.get('instructions')}'" + (f", after {run.depends_on}" if run.depends_on else ""))
+        self.runs[run.name] = run
+        run.task = asyncio.create_task(self.execute(run))
+
+    def depends_on(self, name: str, target: str, seen: set = None) -> bool:
+        """ Whether the agent 'name' depends on 'target', directly or through other agents. """
+        seen = seen if seen is not None else set()
+        if name in seen or name not in self.runs:
+            return False
+        seen.add(name)
+        return any(dependency == target or self.depends_on(dependency, target, seen) for dependency in self.runs[name].depends_on)
+
+    async def wait_for_dependencies(self, run: AgentRun) -> str:
+        """ Waits for the agents this run depends on, and returns their results to add to its instructions. """
+        await self.all_launched.wait()
+
+        dependencies = []
+        for name in run.depends_on:
+            if name not in self.runs:
+                print(f"AgentOrchestrator: {run.name} depends on {name}, which wasn't called, so isn't waiting for it")
+            elif self.depends_on(name, run.name):
+                print(f"AgentOrchestrator: {run.name} and {name} depend on each other, so neither waits for the other")
+            else:
+                dependencies.append(self.runs[name])
+
+        if not dependencies:
+            return ""
+        await asyncio.wait([dependency.task for dependency in dependencies])
+        return "\n\n" + "\n".join(f"Result from {dependency.name} ({dependency.status}): {dependency.result}" for dependency in dependencies)
+
+    async def execute(self, run: AgentRun):
+        """ Runs an agent within its deadline. Errors and timeouts are recorded on the run rather than raised, so that one
+        failing agent doesn't take down the others. """
+
+        context = await self.wait_for_dependencies(run) if run.depends_on else ""
+        instructions = (run.arguments.get("instructions") or "") + context
+        deadline = agent_deadlines.get(run.name, AGENT_DEADLINE_SECONDS)
+        started_at = time.perf_counter()
+
+        try:
+            run.result = await asyncio.wait_for(self.orchestrator.call_agent(run.name, instructions, deadline - DEADLINE_MARGIN_SECONDS), timeout=deadline)
+            run.status = "ok"
+        except asyncio.TimeoutError:
+            print(f"AgentOrchestrator: {run.name} timed out after {deadline}s")
+            run.result = f"{run.name} did not respond in time, no data is available from it."
+            run.status = "timeout"
+        except asyncio.CancelledError:
+            if run.status == "pending": # Not already marked as timed out by results()
+                run.status = "cancelled"
+            raise
+        except Exception as e:
+            print(f"Exception occured in agent {run.name}: {e}")
+            run.result = f"{run.name} failed, no data is available from it."
+            run.status = "error"
+        finally:
+            AGENT_DURATION.labels(run.name).observe(time.perf_counter() - started_at)
+            AGENT_RUNS.labels(run.name, run.status).inc()
+
+    async def results(self, timeout: float) -> list:
+        """ Waits for every agent (up to the timeout) and returns their results, including any that didn't finish. """
+        self.all_launched.set()
+        tasks = [run.task for run in self.runs.values()]
+        await asyncio.wait(tasks, timeout=max(timeout, 0))
+
+        results = []
+        for run in self.runs.values():
+            if not run.task.done():
+                run.status = "timeout"
+                run.result = f"{run.name} did not respond in time, no data is available from it."
+            results.append(f"[{run.name}] {run.result}")
+        return results
+
+    def cancel(self):
+        """ Cancels any agents that are still running. """
+        for run in self.runs.values():
+            if run.task and not run.task.done():
+                run.task.cancel()
+
 class AgentOrchestrator(BaseAgent):
     def __init__(self):
-        self.company_data_agent = None
+        # The pool of agents, created on first use and shared by every orchestration
+        self.agents = {}
 
         self.available_agents = {
-            "company_data_agent":  self.launch_company_data_agent
+            "company_data_agent": CompanyDataAgent,
+            "screening_agent": ScreeningAgent,
         }
 
+    def get_agent(self, name : str):
+        """ Returns the shared instance of an agent, creating it the first time it's needed (lazy initialisation).
+
+        Parameters:
+        - name (str): the agent's name, as in agent_orchestrator_tools.json.
+
+        Returns:
+        - the agent object """
+
+        if name not in self.agents:
+            self.agents[name] = self.available_agents[name]()
+        return self.agents[name]
+
+    async def call_agent(self, name : str, instructions : str, time_budget : float):
+        """ Calls on an agent with its instructions.
+
+        Parameters:
+        - name (str): the agent's name.
+        - instructions (str): the prompt for the agent, including the results of any agents it depends on.
+        - time_budget (float): how long the agent has, in seconds, so it can return what it has before its deadline.
+
+        Returns:
+        - the agent's response (currently formatted as string) """
+
+        return await self.get_agent(name).create_agent_response(instructions, time_budget)
+
+    @timed_stage("agent_orchestrator")
     async def orchestrate_agents(self, prompt : str):
-        """ The orchestration routine. Receives the user prompt along with any additional context specified by the 
+        """ The orchestration routine. Receives the user prompt along with any additional context specified by the
         LLM (as described in the chat_logic/functions tools.json) and then calls on downstream agents using tailored
         generated prompts (as described in agent_orchestrator_tools.json). Returns a list.
-        
-        Parameters: 
+
+        Parameters:
         - prompt (str): specified by the chatbot agent, containing the user prompt and necessary additional context.
-        
-        Returns: 
+
+        Returns:
         - results (list): a list of responses with contributions from each participating agent."""
 
+        started_at = time.monotonic()
+        orchestration = Orchestration(self)
+
         try:
-            aclient = AsyncOpenAI()
             messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}]
 
-            response = await aclient.chat.completions.create(model=model_choice,
+            response = llm_gateway.stream_chat("agent_orchestrator", model=model_choice,
             messages=messages,
-            tools=tools,  
-            tool_choice="required",  # "required" = tools only 
-            stream = True, # Streaming has to be enabled for parallel tool calls 
-            parallel_tool_calls=True, 
+            tools=tools,
+            tool_choice="required",  # "required" = tools only
+            stream = True, # Streaming has to be enabled for parallel tool calls
+            parallel_tool_calls=True,
             )
 
-            agent_tasks = [] # List to hold the collection of agent calls to be performed
-            accumulated_tool_calls = {} # Accumulator for the tool call chunks 
+            tool_call_assembler = ToolCallAssembler() # Accumulator for the tool call chunks
 
-            async for chunk in response: 
+            async for chunk in response:
                 if not chunk.choices:
                     print(f"AgentOrchestrator token usage: {chunk.usage.total_tokens}")
+                    continue
 
                 delta = chunk.choices[0].delta
-                index = chunk.choices[0].index
-
-                if index not in accumulated_tool_calls:
-                    accumulated_tool_calls[index] = {
-                        "function_name": None,
-                        "arguments": ""
-                    }
-
-                accumulated_data = accumulated_tool_calls[index]
-
-                if delta.tool_calls:
-                    for tool_call in delta.tool_calls:
-                        if tool_call.function.name:
-                            accumulated_data['function_name'] = tool_call.function.name
-                        if tool_call.function.arguments:
-                            accumulated_data['arguments'] += tool_call.function.arguments
-
-                        try:
-                            parsed_args = json.loads(accumulated_data['arguments'])
-                            instructions = parsed_args.get("instructions")
-                            agent_name = accumulated_data['function_name']
-
-                            agent_called = self.available_agents.get(agent_name)
-                            if agent_called:
-                                print(f"AgentOrchestrator: calling on {agent_name} with prompt: '{instructions}'")
-                                if asyncio.iscoroutinefunction(agent_called):
-                                    agent_tasks.append(agent_called(parsed_args))
-                                else:
-                                    agent_tasks.append(asyncio.to_thread(agent_called, parsed_args))
-                                del accumulated_tool_calls[index]
-                            else: 
-                                error_message = f"Agent {agent_name} does not exist."
-                                print(f"Error in agent_orchestrator.py: {error_message}")
-                                return {"error": error_message}
-                        except json.JSONDecodeError:
-                            pass      
-            if agent_tasks: 
-                results = await asyncio.gather(*agent_tasks, return_exceptions=True)
-                return results
-            else: 
+
+                # Agents are launched as soon as their arguments are complete, while the rest of the calls stream in
+                for tool_call in tool_call_assembler.add_delta(delta.tool_calls):
+                    orchestration.launch(tool_call)
+
+            for tool_call in tool_call_assembler.flush():
+                orchestration.launch(tool_call)
+
+            if orchestration.runs:
+                return await orchestration.results(ORCHESTRATION_DEADLINE_SECONDS - (time.monotonic() - started_at))
+            else:
                 print("agent_orchestrator.py: no agent calls found.")
                 return "No agents were called."
 
-        except Exception as e: 
+        except Exception as e:
             print(f"Exception occured in agent_orchestrator.py: {e}")
-            return { f"error: {e}"}
-    
-    def get_company_data_agent(self): 
-        """ Getter method for the company data agent object. 
-
-        We're using lazy initalisation so the object is only created when it is needed.
-         
-        This will initialise the Company Data Agent. Change to async if we use async routines in initialisation.
-        
-        Returns: 
-        - CompanyDataAgent object"""
-        
-        if not self.company_data_agent: 
-            self.company_data_agent = CompanyDataAgent()
-        return self.company_data_agent
-    
-    async def launch_company_data_agent(self, arguments : dict):
-        """ Launches the CompanyDataAgent which is responsible for handling quantitative API requests.
-
-        Linked to 'company_data_agent' in agent_orchestrator_tools.json. 
-        
-        Parameters: 
-        - arguments (dict): a dictionary containing the parameters specified in agent_orchestrator_tools.py.
-        
-        Returns: 
-        - a response (currently formatted as string)"""
-
-        instructions = arguments.get("instructions")
-
-        company_data_agent = self.get_company_data_agent() # Lazy intialisation
-        agent_response = await company_data_agent.create_agent_response(instructions)
-        return agent_response
\ No newline at end of file
+            return f"error: {e}"
+        finally:
+            orchestration.cancel() # Anything still running has missed the deadline, or the request was cancelled
+
+agent_orchestrator = AgentOrchestrator()
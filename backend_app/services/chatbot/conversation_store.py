@@ -0,0 +1,213 @@
+""" Per-conversation chat history. Each conversation (identified by the conversation_id sent by the frontend) gets its own
+history so users no longer share one ever-growing message list.
+
+Conversations are evicted when they haven't been used for a while (TTL) or when the store is full (least recently used
+goes first). When building the prompt, only the system prompt plus the newest messages that fit under the token budget
+are sent to the model, which keeps the prompt size (and time to first token) flat however long the conversation runs.
+
+With a repository (repositories.ConversationRepository), new messages are also written to the database after each
+turn, and a conversation that isn't in memory (after a restart, or one that was last used on another replica) is
+rebuilt from its newest stored messages. """
+
+from collections import OrderedDict
+from backend_app.services.chatbot.token_utils import estimate_message_tokens
+import asyncio
+import os
+import time
+import uuid
+
+DEFAULT_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", 6000))
+DEFAULT_MAX_CONVERSATIONS = int(os.getenv("CHAT_MAX_CONVERSATIONS", 1000))
+DEFAULT_CONVERSATION_TTL = int(os.getenv("CHAT_CONVERSATION_TTL_SECONDS", 3600))
+DEFAULT_MAX_MESSAGES = int(os.getenv("CHAT_MAX_MESSAGES_PER_CONVERSATION", 100))
+
+class Conversation:
+    def __init__(self, conversation_id: str, system_prompt: str, max_messages: int = DEFAULT_MAX_MESSAGES):
+        self.conversation_id = conversation_id
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.system_tokens = estimate_message_tokens(self.system_message)
+        self.max_messages = max_messages
+        self.messages = [] # History, excluding the system prompt
+        self.message_tokens = [] # Token count for each entry in self.messages, so they're only counted once
+        self.last_accessed = time.monotonic()
+        self.user_id = None
+        self.unsaved = None # Messages not yet written to the database, None if the conversation isn't persisted
+        self.stored_count = 0 # Messages in the database, as far as we know
+        self.save_lock = None
+
+    def add_message(self, message: dict):
+        """ Appends a message to the conversation, trimming the oldest messages if the history is over max_messages. """
+        self.messages.append(message)
+        self.message_tokens.append(estimate_message_tokens(message))
+        if self.unsaved is not None:
+            self.unsaved.append(message)
+
+        overflow = len(self.messages) - self.max_messages
+        if overflow > 0:
+            del self.messages[:overflow]
+            del self.message_tokens[:overflow]
+
+    def add_messages(self, messages: list):
+        for message in messages:
+            self.add_message(message)
+
+    def load_messages(self, messages: list, stored_count: int):
+        """ Replaces the history with messages read back from the database. """
+        self.messages = messages[-self.max_messages:]
+        self.message_tokens = [estimate_message_tokens(message) for message in self.messages]
+        self.stored_count = stored_count
+
+    def get_context_window(self, token_budget: int = DEFAULT_TOKEN_BUDGET) -> list:
+        """ Builds the message list to send to the model: the system prompt, the current turn (everything from the latest
+        user message onwards, always included), and then as many older messages as fit under the token budget.
+
+        Parameters:
+        - token_budget (int): the maximum number of prompt tokens to spend on history, system prompt included.
+
+        Returns:
+        - (list) OpenAI formatted messages, oldest first. """
+
+        # Find the start of the current turn
+        turn_start = len(self.messages)
+        for i in range(len(self.messages) - 1, -1, -1):
+            if self.messages[i]["role"] == "user":
+                turn_start = i
+                break
+
+        used_tokens = self.system_tokens + sum(self.message_tokens[turn_start:])
+        window_start = turn_start
+
+        # Walk backwards from the current turn, keeping the newest messages until the budget is used up
+        for i in range(turn_start - 1, -1, -1):
+            if used_tokens + self.message_tokens[i] > token_budget:
+                break
+            used_tokens += self.message_tokens[i]
+            window_start = i
+
+        # Don't start the window on a tool output as the message that prompted it has been cut off
+        while window_start < turn_start and self.messages[window_start]["role"] == "function":
+            window_start += 1
+
+        return [self.system_message] + self.messages[window_start:]
+
+class ConversationStore:
+    def __init__(self, system_prompt: str,
+                 max_conversations: int = DEFAULT_MAX_CONVERSATIONS,
+                 ttl_seconds: int = DEFAULT_CONVERSATION_TTL,
+                 max_messages: int = DEFAULT_MAX_MESSAGES,
+                 repository = None):
+        self.system_prompt = system_prompt
+        self.max_conversations = max_conversations
+        self.ttl_seconds = ttl_seconds
+        self.max_messages = max_messages
+        self.repository = repository # Optional ConversationRepository, to persist conversations
+        self.conversations = OrderedDict() # Ordered by last access, least recently used first
+        self.save_tasks = set()
+
+    def get_conversation(self, conversation_id: str = None) -> Conversation:
+        """ Retrieves a conversation by id, creating it if it doesn't exist (or has expired).
+
+        Parameters:
+        - conversation_id (str): the id sent by the frontend. If blank, a new single-use conversation is created.
+
+        Returns:
+        - Conversation object """
+
+        self.evict_expired()
+
+        if not conversation_id:
+            conversation_id = str(uuid.uuid4())
+
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            conversation = Conversation(conversation_id, self.system_prompt, self.max_messages)
+            if self.repository is not None:
+                conversation.unsaved = []
+            self.conversations[conversation_id] = conversation
+            # Evict the least recently used conversations if we're over capacity
+            while len(self.conversations) > self.max_conversations:
+                self.conversations.popitem(last=False)
+        else:
+            self.conversations.move_to_end(conversation_id)
+
+        conversation.last_accessed = time.monotonic()
+        return conversation
+
+    async def load_conversation(self, conversation_id: str = None, user_id: int = None) -> Conversation:
+        """ Like get_conversation, but brings the conversation up to date from the database first, if it's newer there
+        (e.g. this process restarted, or the last turn was handled by another replica). One indexed lookup when the
+        copy in memory is current. If the database can't be reached, carries on with what's in memory.
+
+        A conversation belongs to the user who started it signed in, and only they can continue it. Anyone else sending
+        its id (signed in or not) gets a new conversation instead, so they can't read or add to someone else's history.
+        Conversations started signed out belong to nobody until a signed in user continues one.
+
+        Parameters:
+        - conversation_id (str): the id sent by the frontend.
+        - user_id (int): the signed in user, if there is one.
+
+        Returns:
+        - Conversation object """
+
+        conversation = self.get_conversation(conversation_id)
+        if conversation.user_id is None and self.repository is not None:
+            # Not known to belong to anyone here, but it may have been stored by a signed in user (on another replica)
+            try:
+                conversation.user_id = await self.repository.get_owner(conversation.conversation_id)
+            except Exception as e:
+                print(f"Couldn't look up the owner of conversation {conversation.conversation_id}: {e}")
+        if conversation.user_id is not None and conversation.user_id != user_id:
+            print(f"Conversation {conversation.conversation_id} belongs to another user, starting a new one")
+            conversation = self.get_conversation()
+        if conversation.user_id is None:
+            conversation.user_id = user_id
+        if self.repository is None or conversation.unsaved:
+            return conversation # Nothing stored, or we have messages the database doesn't yet
+
+        try:
+            stored_count = await self.repository.get_message_count(conversation.conversation_id)
+            if stored_count and stored_count > conversation.stored_count:
+                messages, stored_count = await self.repository.get_recent_messages(conversation.conversation_id, self.max_messages)
+                conversation.load_messages(messages, stored_count)
+        except Exception as e:
+            print(f"Couldn't load conversation {conversation.conversation_id} from the database: {e}")
+        return conversation
+
+    def save_conversation(self, conversation: Conversation):
+        """ Writes the conversation's new messages to the database in the background, so the response isn't held up. """
+        if self.repository is None or not conversation.unsaved:
+            return
+        task = asyncio.create_task(self.write_unsaved(conversation))
+        self.save_tasks.add(task)
+        task.add_done_callback(self.save_tasks.discard)
+
+    async def write_unsaved(self, conversation: Conversation):
+        if conversation.save_lock is None:
+            conversation.save_lock = asyncio.Lock()
+        async with conversation.save_lock: # Keeps the messages in order if turns finish close together
+            messages, conversation.unsaved = conversation.unsaved, []
+            if not messages:
+                return
+            try:
+                conversation.stored_count = await self.repository.add_messages(conversation.conversation_id, messages, conversation.user_id)
+            except Exception as e:
+                print(f"Couldn't save conversation {conversation.conversation_id}, will retry after the next turn: {e}")
+                conversation.unsaved[:0] = messages
+
+    async def close(self):
+        """ Waits for any writes still in progress, e.g. on shutdown. """
+        if self.save_tasks:
+            await asyncio.gather(*self.save_tasks, return_exceptions=True)
+
+    def evict_expired(self):
+        """ Drops conversations that haven't been accessed within the TTL. As the dict is ordered by last access, we can
+        stop at the first conversation that hasn't expired. """
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self.conversations:
+            conversation_id, conversation = next(iter(self.conversations.items()))
+            if conversation.last_accessed >= cutoff:
+                break
+            del self.conversations[conversation_id]
+
+    def __len__(self):
+        return len(self.conversations)
@@ -7,18 +7,32 @@
 # All function results must be passed through create_json_response before returning to the model
 from typing import Any
 import backend_app.services.document_retrieval.vectorstore as vectorstore
+import backend_app.services.document_retrieval.fake_vectorstore as fake_vectorstore
 from backend_app.services.news.news_service import news_service
 import asyncio
-import yfinance as yf
+import contextvars
+import functools
+import inspect
 import json
-from backend_app.services.chatbot.chatbot_agents.agent_orchestrator import AgentOrchestrator
+import os
+from concurrent.futures import ThreadPoolExecutor
+from backend_app.services.chatbot.chatbot_agents.agent_orchestrator import agent_orchestrator as orchestrator
+from backend_app.services.market_data.market_data_cache import market_data_cache
+from backend_app.services.market_data.ohlcv_store import is_valid_ticker
+from backend_app.services.analytics.portfolio_analytics import portfolio_store, analyse_portfolio, summarise_breakdown, DEFAULT_BENCHMARK, DEFAULT_LOOKBACK_DAYS
+from backend_app.services.upstream.upstream_scheduler import UpstreamBudgetExceeded, UpstreamThrottled
 from datetime import datetime, timedelta
 
+# The user the current chat turn is for (None if not signed in), set by chat_logic. Tools run as tasks created within
+# the turn, so they see it too
+current_user_id = contextvars.ContextVar("current_user_id", default=None)
+
 def create_json_response(ui_type: str = "text",
                         ui_title: str = "",
                         ui_content: Any = None,
                         response_model_content: str = "",
-                        target: str = None):  # Add target parameter
+                        target: str = None,  # Add target parameter
+                        partial: bool = False):
     """ Generates a standardised json object for passing tool responses back to the model. 
 
     Any of the fields (except for ui_type) can be passed back blank. 
@@ -28,6 +42,7 @@ def create_json_response(ui_type: str = "text",
     - ui_title (str): The title to be displayed in the UI object. Defaults to blank. Must be a string.
     - ui_content (Any): The content to be displayed in the UI object, returned by the function call. Defaults to blank. Can take any data type (I think)
     - response_model_content (str): The response to be passed back to the model for further generation (if applicable). Defaults to blank. Must always be passed as a string.
+    - partial (bool): Marks an intermediate update from a streaming tool, which is shown in the UI but not passed back to the model. Defaults to False.
 
     Returns: 
     - json_object_response (dict): a dictionary representing the JSON structure."""
@@ -41,6 +56,9 @@ def create_json_response(ui_type: str = "text",
     
     if target:
         json_object_response["target"] = target
+
+    if partial:
+        json_object_response["partial"] = True
         
     return json_object_response
 
@@ -60,9 +78,6 @@ def get_stock_price(arguments):
         ticker = arguments.get("ticker")
         date = arguments.get("date")
         
-        # Set the stock ticker
-        stock = yf.Ticker(ticker)
-
         if date:
             # If a date is provided, attempt to retrieve historical data for that specific date
             try:
@@ -70,11 +85,12 @@ def get_stock_price(arguments):
                 next_day = date_parsed + timedelta(days=1)  # Ensure we get at least one trading day
 
                 # Retrieve historical data for the date
-                historical_data = stock.history(start=date_parsed, end=next_day)
+                historical_data = market_data_cache.get_history(ticker, date_parsed.isoformat(), next_day.isoformat())
 
                 # Check if data exists for the exact date
-                if date_parsed.strftime("%Y-%m-%d") in historical_data.index:
-                    historical_price = historical_data.loc[date_parsed.strftime("%Y-%m-%d"), 'Close']
+                matching_bars = [bar for bar in historical_data if bar["date"] == date_parsed.strftime("%Y-%m-%d")]
+                if matching_bars:
+                    historical_price = matching_bars[0]["close"]
                     return create_json_response(
                         "ticker", 
                         f"Ticker: {ticker} on {date}", 
@@ -90,11 +106,12 @@ def get_stock_price(arguments):
                     response_model_content="Invalid date format. Please use YYYY-MM-DD."
                 )
 
-        current_price = stock.info.get('regularMarketPrice')
+        quote = market_data_cache.get_quote(ticker) # Cached, so repeated requests for the same ticker don't go upstream
+        current_price = quote.get('regularMarketPrice')
         
         # If live price is not available, fall back to the previous close price
         if current_price is None:
-            current_price = stock.info.get('regularMarketPreviousClose')
+            current_price = quote.get('regularMarketPreviousClose')
             if current_price is not None:
                 return create_json_response("ticker", f"Ticker: {ticker}", f"{current_price:.2f}", response_model_content=f"The market is currently closed. The last closing price of {ticker} was: ${current_price:.2f}")
             else:
@@ -129,19 +146,15 @@ def get_historical_stock_data(arguments):
         if not ticker or not start_date or not end_date:
             return create_json_response(response_model_content="Please provide a valid ticker, start date, and end date.")
 
-        # Retrieve historical stock data from Yahoo Finance - we may need a better api but will do for now
-        stock = yf.Ticker(ticker)
-        historical_data = stock.history(start=start_date, end=end_date)
+        # Retrieve historical stock data from Yahoo Finance (through the cache) - we may need a better api but will do for now
+        historical_data = market_data_cache.get_history(ticker, start_date, end_date)
 
         # If no data is returned
-        if historical_data.empty:
+        if not historical_data:
             return create_json_response(response_model_content=f"No historical data found for {ticker} in the specified date range.")
         
         # Extract dates and closing prices for plotting
-        data_points = [
-            {"date": date.strftime("%Y-%m-%d"), "close": close}
-            for date, close in zip(historical_data.index, historical_data["Close"])
-        ]
+        data_points = [{"date": bar["date"], "close": bar["close"]} for bar in historical_data]
         
         # Return data in JSON format
         return create_json_response(
@@ -159,23 +172,142 @@ def get_historical_stock_data(arguments):
         print(f"An error occurred: {e}")
         return create_json_response(response_model_content="Unable to retrieve historical stock data.")
 
-def retrieve_portfolio(user_id): 
-    """Retrieves the user's portfolio given the user id.
+MAX_BATCH_TICKERS = 25 # Keeps bulk downloads (and the payload passed back to the model) to a sensible size
+
+def get_batch_stock_prices(arguments):
+    """
+    Retrieves the current stock price for several tickers with a single bulk request, e.g. for peer comparisons.
     
-    Parameters: 
-    - user_id theoretically, but we don't need this yet as it will always retrieve the same portfolio.
+    Parameters:
+    - arguments (dict): A JSON object containing 'tickers', a list of ticker symbols.
     
     Returns:
-    - a JSON string taken from ./portfolios/portfolio1.json """
+    - JSON response containing one compact line per ticker for the model.
+    """
+    try:
+        arguments = json.loads(arguments)
+        tickers = [ticker.upper() for ticker in arguments.get("tickers", [])][:MAX_BATCH_TICKERS]
+
+        if not tickers:
+            return create_json_response(response_model_content="Please provide at least one ticker.")
+
+        quotes = market_data_cache.get_quotes(tickers)
+
+        lines = []
+        for ticker in tickers:
+            quote = quotes.get(ticker) or {}
+            price = quote.get("regularMarketPrice")
+            previous_close = quote.get("regularMarketPreviousClose")
+            if price is None:
+                lines.append(f"{ticker}: unavailable")
+            elif previous_close:
+                lines.append(f"{ticker}: ${price:.2f} ({(price / previous_close - 1) * 100:+.2f}% vs previous close ${previous_close:.2f})")
+            else:
+                lines.append(f"{ticker}: ${price:.2f}")
+
+        return create_json_response(response_model_content="Latest prices:\n" + "\n".join(lines))
+
+    except json.JSONDecodeError as e:
+        print(f"Failed to parse arguments: {e}")
+        return create_json_response(response_model_content="Invalid arguments. Please provide a JSON object.")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return create_json_response(response_model_content="Unable to retrieve stock prices.")
 
-    with open("./portfolios/portfolio1.json", "r") as file:
-        portfolio_data = json.load(file)
+def get_batch_historical_stock_data(arguments):
+    """
+    Retrieves historical stock price data for several tickers over a specified date range with a single bulk request.
     
-    portfolio = json.dumps(portfolio_data) # Converts the json object in to a string to be interpreted by the model. 
+    Parameters:
+    - arguments (dict): A JSON object containing 'tickers', 'start_date', and 'end_date'.
     
-    return create_json_response(response_model_content=portfolio)
+    Returns:
+    - JSON response containing a multi-series line chart for the UI, and a compact per-ticker summary (start/end price,
+    return, high, low) for the model rather than every data point.
+    """
+    try:
+        arguments = json.loads(arguments)
+        tickers = [ticker.upper() for ticker in arguments.get("tickers", [])][:MAX_BATCH_TICKERS]
+        start_date = arguments.get("start_date")
+        end_date = arguments.get("end_date")
+
+        if not tickers or not start_date or not end_date:
+            return create_json_response(response_model_content="Please provide valid tickers, start date, and end date.")
+
+        histories = market_data_cache.get_histories(tickers, start_date, end_date)
+
+        # Line every series up against the same set of dates for the chart
+        dates = sorted({bar["date"] for bars in histories.values() for bar in bars})
+        series = []
+        lines = []
+        for ticker in tickers:
+            bars = histories.get(ticker) or []
+            if not bars:
+                lines.append(f"{ticker}: no data")
+                continue
+
+            closes_by_date = {bar["date"]: bar["close"] for bar in bars}
+            series.append({"label": ticker, "data": [closes_by_date.get(date) for date in dates]})
+
+            first, last = bars[0], bars[-1]
+            high = max(bar["high"] for bar in bars)
+            low = min(bar["low"] for bar in bars)
+            lines.append(
+                f"{ticker}: {first['date']} ${first['close']:.2f} -> {last['date']} ${last['close']:.2f} "
+                f"({(last['close'] / first['close'] - 1) * 100:+.2f}%), high ${high:.2f}, low ${low:.2f}"
+            )
+
+        if not series:
+            return create_json_response(response_model_content="No historical data found for the specified tickers and date range.")
+
+        return create_json_response(
+            ui_type="line_chart",
+            ui_title=f"Historical data for {', '.join(entry['label'] for entry in series)}",
+            ui_content={"labels": dates, "series": series},
+            response_model_content=f"Historical data from {start_date} to {end_date} (shown in the chart):\n" + "\n".join(lines)
+        )
+
+    except json.JSONDecodeError as e:
+        print(f"Failed to parse arguments: {e}")
+        return create_json_response(response_model_content="Invalid arguments. Please provide a JSON object.")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return create_json_response(response_model_content="Unable to retrieve historical stock data.")
+
+async def retrieve_portfolio(arguments):
+    """Retrieves the user's portfolio, valued at current prices and with its exposures and risk (portfolio_analytics.py).
+
+    Parameters:
+    - arguments (str): A JSON object, optionally with 'lookback_days' for the risk figures and 'benchmark' to measure
+      beta against. The user comes from current_user_id, never from the model.
+
+    Returns:
+    - A compact summary for the model, with the full breakdown for the portfolio panel."""
+
+    try:
+        arguments = json.loads(arguments or "{}")
+        portfolio = await portfolio_store.load_portfolio(current_user_id.get())
+        benchmark = str(arguments.get("benchmark") or DEFAULT_BENCHMARK).strip().upper()
+        if not is_valid_ticker(benchmark): # From the model, and it ends up in the market data store's paths
+            print(f"Invalid benchmark '{benchmark}', using {DEFAULT_BENCHMARK}")
+            benchmark = DEFAULT_BENCHMARK
+        # Valuing the portfolio makes blocking market data calls, so it runs on the tool thread pool
+        breakdown = await run_in_tool_thread(lambda: analyse_portfolio(portfolio,
+            benchmark=benchmark,
+            lookback_days=min(max(int(arguments.get("lookback_days") or DEFAULT_LOOKBACK_DAYS), 30), 5 * 365),
+        ))
+        print(f"Analysed a portfolio of {len(portfolio)} positions in {breakdown['elapsed_ms']:.1f}ms")
+        return create_json_response("portfolio", "Portfolio", breakdown, summarise_breakdown(breakdown))
+    except (UpstreamBudgetExceeded, UpstreamThrottled) as e:
+        print(f"Market data rate limit reached in retrieve_portfolio: {e}")
+        return create_json_response(response_model_content="Unable to value the portfolio at this time, the market data provider's rate limit has been reached. Try again in a few minutes.")
+    except Exception as e:
+        print(f"Error in retrieve_portfolio: {e}")
+        return create_json_response(response_model_content=f"Error retrieving the portfolio: {str(e)}")
 
 async def get_news(arguments):
+    """ Streams news summaries to the news panel as each one finishes, then passes the full list back as the final
+    result. """
     try:
         args = json.loads(arguments)
         chat_context = {
@@ -183,64 +315,120 @@ async def get_news(arguments):
             'extracted_tickers': args.get('tickers', []),
             'topics': args.get('topics', [])
         }
-        
-        news_summaries = await news_service.get_news_summaries(chat_context)
-        
+
+        news_summaries = []
+        async for summary in news_service.stream_news_summaries(chat_context):
+            news_summaries.append(summary)
+            # The news panel replaces its list on each update, so send everything we have so far
+            yield create_json_response(
+                ui_type="news_feed",
+                ui_title="Latest News",
+                ui_content=list(news_summaries),
+                target="news_space",
+                partial=True
+            )
+
         if not news_summaries:
-            return create_json_response(
+            yield create_json_response(
                 response_model_content="No relevant news found for the specified tickers."
             )
+            return
 
         # Create a brief summary for the chat
         tickers_str = ", ".join(args.get('tickers', []))
-        
+        # The summaries are shared between users, so pass them to the model to relate back to this user's question
+        article_lines = "\n".join(f"- {summary['title']} ({summary['source']}): {summary['summary']}" for summary in news_summaries)
+
         # Send both the news data and chat message in a single response
-        return create_json_response(
+        yield create_json_response(
             ui_type="news_feed",
             ui_title="Latest News",
             ui_content=news_summaries,
-            response_model_content=f"I've found {len(news_summaries)} relevant news articles about {tickers_str}. You can view them in the News panel on the right side of your screen.",
+            response_model_content=f"I've found {len(news_summaries)} relevant news articles about {tickers_str}. You can view them in the News panel on the right side of your screen.\n{article_lines}",
             target="news_space"
         )
-    
+
+    except (UpstreamBudgetExceeded, UpstreamThrottled) as e:
+        print(f"News provider rate limit reached in get_news: {e}")
+        yield create_json_response(response_model_content="Unable to retrieve news at this time, the news provider's rate limit has been reached. Try again in a few minutes.")
     except Exception as e:
         print(f"Error in get_news: {e}")
-        return create_json_response(response_model_content="Unable to retrieve news at this time.")
+        yield create_json_response(response_model_content="Unable to retrieve news at this time.")
     
 async def agent_orchestrator(arguments): 
     args = json.loads(arguments)
     instructions = args.get("instructions")
 
-    agent_orchestrator = AgentOrchestrator()
-    results = await agent_orchestrator.orchestrate_agents(instructions)
+    results = await orchestrator.orchestrate_agents(instructions)
 
     # Results is returned as a list of responses (one response from each participating agent) so we need to flatten it to pass it back to the chatbot. 
     if isinstance(results, list): 
-        flattened_results = ' '.join(str(result) for result in results) 
+        results = ' '.join(str(result) for result in results) 
 
-    return create_json_response(response_model_content=flattened_results)
+    return create_json_response(response_model_content=str(results))
 
 # Map function names to actual functions, to call with execute_function_call below
 available_functions = {
-    "retrieve_filing": vectorstore.retrieve_filings,
+    "retrieve_filing": fake_vectorstore.retrieve_filings if os.getenv("VECTORSTORE_BACKEND") == "fake" else vectorstore.retrieve_filings,
     "get_stock_price": get_stock_price,
     "retrieve_portfolio" : retrieve_portfolio,
     "get_historical_stock_data" : get_historical_stock_data,
+    "get_batch_stock_prices": get_batch_stock_prices,
+    "get_batch_historical_stock_data": get_batch_historical_stock_data,
     "get_news": get_news,
     "agent_orchestrator": agent_orchestrator,
 }
 
-async def execute_function_call(function_name, arguments):
+# Blocking (sync) functions are run on this pool so they don't stall the event loop. Bounded so a burst of tool calls
+# can't spawn an unlimited number of threads
+tool_thread_pool = ThreadPoolExecutor(max_workers=int(os.getenv("TOOL_THREAD_POOL_SIZE", 8)), thread_name_prefix="tool")
+
+def run_in_tool_thread(function, *args):
+    """ Runs a blocking function on the tool thread pool in a copy of the caller's context, so it still sees the
+    request's context variables (request_priority, current_user_id). run_in_executor doesn't copy them itself, unlike
+    asyncio.to_thread.
+
+    Parameters:
+    - function (callable): the blocking function to run.
+    - *args: passed to the function.
+
+    Returns:
+    - a future for the function's result. """
+
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(tool_thread_pool, functools.partial(context.run, function, *args))
+
+async def execute_function_call(function_name, arguments, on_update=None):
+    """ Runs a tool. Async tools are awaited, blocking tools run on the tool thread pool, and streaming tools (async
+    generators) are iterated, with any partial updates passed to on_update as they arrive.
+
+    Parameters:
+    - function_name (str): the name of the tool, as in available_functions.
+    - arguments (str): the JSON arguments from the model.
+    - on_update (callable): optional, called with each partial update from a streaming tool.
+
+    Returns:
+    - the tool's final (non-partial) response. """
+
     function = available_functions.get(function_name, None)
     if function:
-        if asyncio.iscoroutinefunction(function):
+        if inspect.isasyncgenfunction(function):
+            results = None
+            async for update in function(arguments):
+                if update.get("partial"):
+                    if on_update:
+                        on_update(update)
+                else:
+                    results = update
+            return results
+        elif asyncio.iscoroutinefunction(function):
             results = await function(arguments)
             # Handle case where function returns multiple responses
             if isinstance(results, list):
                 return results
             return results
         else:
-            results = function(arguments)
+            results = await run_in_tool_thread(function, arguments)
     else:
         results = create_json_response(response_model_content=f"Error: function {function_name} does not exist")
     return results
@@ -0,0 +1,167 @@
+""" Opt-in semantic cache of whole chat responses, for the many close variants of the same analyst question ("what does
+Tesla's latest 10-K say about margins").
+
+- Questions are matched on the embedding of the normalised question (the same model and cache as retrieval queries),
+  so rewordings hit as long as they're above the similarity threshold. Tickers, names and numbers in the question
+  must also match exactly, as "AAPL price" and "MSFT price" embed very closely.
+- Only standalone questions (the first user message in a conversation) are cached, as follow-ups depend on context.
+- The stored stream, text and UI payloads included, is replayed straight to the client on a hit.
+- How long an answer lives depends on the tools it used: an answer built on a live price expires in a minute, one
+  built on a filing lasts a week. Answers that used a tool not listed in tool_ttls (e.g. retrieve_portfolio, which is
+  per user), or where a tool failed, aren't cached.
+- The cache is size bounded, evicting the least recently used answer first.
+
+Turn it on with RESPONSE_CACHE_ENABLED=true. """
+
+from collections import OrderedDict
+from backend_app.services.document_retrieval.embedding_service import embedding_service, normalise_query
+import numpy as np
+import os
+import re
+import time
+import uuid
+
+ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+SIMILARITY_THRESHOLD = float(os.getenv("RESPONSE_CACHE_SIMILARITY_THRESHOLD", 0.93))
+MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 2000))
+NO_TOOLS_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_NO_TOOLS_TTL_SECONDS", 6 * 3600))
+
+# Seconds an answer stays valid, by the tools it depended on. The shortest applies
+tool_ttls = {
+    "get_stock_price": 60,
+    "get_batch_stock_prices": 60,
+    "get_historical_stock_data": 15 * 60,
+    "get_batch_historical_stock_data": 15 * 60,
+    "get_news": 15 * 60,
+    "agent_orchestrator": 60 * 60,
+    "retrieve_filing": 7 * 24 * 3600,
+}
+
+ENTITY_PATTERN = re.compile(r"\b(?:[A-Z][A-Za-z0-9&.\-]*|\d[\d.,%]*)")
+QUESTION_WORDS = {"What", "Whats", "What's", "How", "Why", "When", "Where", "Which", "Who", "Is", "Are", "Can", "Could", "Should",
+                  "Would", "Do", "Does", "Did", "Tell", "Show", "Give", "Summarise", "Summarize", "Explain", "Compare", "Please", "I", "I'm"}
+
+def question_entities(question: str) -> frozenset:
+    """ The tickers, names and numbers in a question, which have to match exactly for a cached answer to be reused. """
+    return frozenset(entity.rstrip(".,").upper() for entity in ENTITY_PATTERN.findall(question) if entity not in QUESTION_WORDS)
+
+def standalone_question(conversation):
+    """ Returns the latest user message if it's the first one in the conversation, otherwise None. """
+    user_messages = [message for message in conversation.messages if message["role"] == "user"]
+    if len(user_messages) == 1 and conversation.messages[-1] is user_messages[0]:
+        return user_messages[0]["content"]
+    return None
+
+class CachedResponse:
+    def __init__(self, question: str, embedding: np.ndarray, entities: frozenset, chunks: list, tools: list, expires_at: float):
+        self.question = question
+        self.embedding = embedding
+        self.entities = entities
+        self.chunks = chunks
+        self.tools = tools
+        self.expires_at = expires_at
+
+class ResponseRecorder:
+    """ Collects the chunks of a response as they're streamed, so they can be stored once it has finished. """
+
+    def __init__(self, cache, question: str, embedding: np.ndarray, entities: frozenset):
+        self.cache = cache
+        self.question = question
+        self.embedding = embedding
+        self.entities = entities
+        self.chunks = []
+        self.tools = []
+        self.cacheable = True
+
+    def add_chunk(self, chunk):
+        if isinstance(chunk, dict) and chunk.get("partial"):
+            return # Only the final UI payload needs replaying
+        self.chunks.append(chunk)
+
+    def add_tool_output(self, name: str, tool_output: dict):
+        self.tools.append(name)
+        if str(tool_output.get("response_content", "")).startswith("Error"):
+            self.cacheable = False
+
+    def finish(self):
+        if self.cacheable and self.chunks:
+            self.cache.store(self)
+
+class ResponseCache:
+    def __init__(self, enabled: bool = ENABLED, similarity_threshold: float = SIMILARITY_THRESHOLD, max_entries: int = MAX_ENTRIES):
+        self.enabled = enabled
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # Entry id to CachedResponse, least recently used first
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def ttl_for(self, tools: list):
+        """ Returns the TTL for an answer that used these tools, or None if it shouldn't be cached. """
+        if not tools:
+            return NO_TOOLS_TTL_SECONDS
+        if any(tool not in tool_ttls for tool in tools):
+            return None
+        return min(tool_ttls[tool] for tool in tools)
+
+    async def lookup(self, question: str):
+        """ Finds a cached answer to a question.
+
+        Returns:
+        - (CachedResponse) the cached answer, or None on a miss.
+        - (ResponseRecorder) a recorder for the new answer on a miss, or None on a hit. """
+
+        embedding = await embedding_service.encode_query(question)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        embedding = embedding / (np.linalg.norm(embedding) or 1.0)
+        entities = question_entities(question)
+
+        now = time.monotonic()
+        for entry_id in [entry_id for entry_id, entry in self.entries.items() if entry.expires_at <= now]:
+            del self.entries[entry_id]
+
+        candidates = [(entry_id, entry) for entry_id, entry in self.entries.items() if entry.entities == entities]
+        if candidates:
+            similarities = np.stack([entry.embedding for _, entry in candidates]) @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.similarity_threshold:
+                entry_id, entry = candidates[best]
+                self.entries.move_to_end(entry_id)
+                self.hits += 1
+                print(f"Response cache hit ({similarities[best]:.3f}): '{question}' matched '{entry.question}'")
+                return entry, None
+
+        self.misses += 1
+        return None, ResponseRecorder(self, normalise_query(question), embedding, entities)
+
+    def store(self, recorder: ResponseRecorder):
+        ttl = self.ttl_for(recorder.tools)
+        if ttl is None:
+            return
+        self.entries[uuid.uuid4().hex] = CachedResponse(
+            recorder.question, recorder.embedding, recorder.entities, recorder.chunks, recorder.tools, time.monotonic() + ttl
+        )
+        self.stores += 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+        }
+
+response_cache = ResponseCache()
@@ -0,0 +1,146 @@
+""" Server-sent events framing for the /chat stream.
+
+Every write is one SSE event, with a JSON body:
+
+    event: token    data: {"text": "..."}          answer text, several model deltas coalesced together
+    event: ui       data: {"ui_type": ..., ...}     a tool's UI payload (see functions.create_json_response)
+    event: usage    data: {"prompt_tokens": ..., "completion_tokens": ..., "total_tokens": ...}
+    event: error    data: {"message": "..."}        the answer failed part way, sent before done
+    event: done     data: {"status": ...}           always the last event, see below
+
+done's status is "ok", "error" (after an error event), or "superseded" when a newer request for the same conversation
+took over and the answer was cut short (the text so far is all there is). A stream whose client went away just stops,
+with no done event ("cancelled" only appears in the server's finllm_chat_requests_total metric). Lines starting with
+':' are heartbeats and carry no event.
+
+Model deltas are often a single token of a few bytes, so rather than writing each one, text is buffered and sent when
+the buffer reaches COALESCE_MAX_CHARS, when it's been waiting for COALESCE_WINDOW_MS, or when a UI payload or the end
+of the stream comes along (so ordering is kept). The first text of an answer is sent straight away, so time to first
+token isn't affected.
+
+When the stream has had nothing to send for a while (e.g. tools are running) it yields None, and a comment line is written
+instead (see ChatStream.read). Clients ignore it, but writing it is how a server that only notices a disconnect on write
+finds out the client has gone (so the answer is cancelled), and it stops proxies closing the connection as idle. """
+
+from backend_app.services.monitoring.metrics import SSE_EVENTS, SSE_BYTES, SSE_TEXT_CHUNKS, SSE_STREAM_WRITES, SSE_STREAM_THROUGHPUT
+import asyncio
+import orjson
+import os
+import time
+
+COALESCE_WINDOW_SECONDS = float(os.getenv("SSE_COALESCE_WINDOW_MS", 30)) / 1000
+COALESCE_MAX_CHARS = int(os.getenv("SSE_COALESCE_MAX_CHARS", 256))
+HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", 10))
+HEARTBEAT = b": heartbeat\n\n"
+ERROR_MESSAGE = "Something went wrong while generating the response. Please try again."
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY # Accept what json.dumps did for tool payloads
+
+def encode_event(event: str, data) -> bytes:
+    """ Frames one SSE event. The body is a single line of JSON, so it never needs splitting over data: lines. """
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data, option=ORJSON_OPTIONS) + b"\n\n"
+
+class SSEWriter:
+    """ Turns the chat_logic stream (text chunks and UI payload dicts) into SSE events, and counts what it writes. """
+
+    def __init__(self, window_seconds: float = COALESCE_WINDOW_SECONDS, max_chars: int = COALESCE_MAX_CHARS):
+        self.window_seconds = window_seconds
+        self.max_chars = max_chars
+        self.started_at = time.perf_counter()
+        self.writes = 0
+        self.bytes = 0
+        self.text_chunks = 0
+
+    def event(self, event: str, data) -> bytes:
+        frame = encode_event(event, data)
+        self.writes += 1
+        self.bytes += len(frame)
+        SSE_EVENTS.labels(event).inc()
+        return frame
+
+    def heartbeat(self) -> bytes:
+        self.writes += 1
+        self.bytes += len(HEARTBEAT)
+        SSE_EVENTS.labels("heartbeat").inc()
+        return HEARTBEAT
+
+    async def frames(self, chunks):
+        """ Yields an SSE event for each UI payload and for each coalesced run of text. Raises whatever the stream raises,
+        after sending any text received before it.
+
+        Parameters:
+        - chunks: an async iterator of text chunks and UI payload dicts, and None when a heartbeat is due. """
+
+        buffer = []
+        buffered_chars = 0
+        flush_at = None # When the oldest buffered text has to go out
+        sent_text = False
+        pending = None # The read in progress, when waiting on it with a timeout
+        iterator = chunks.__aiter__()
+
+        try:
+            while True:
+                if flush_at is None:
+                    # Nothing buffered, so wait as long as it takes
+                    try:
+                        chunk = await (pending if pending is not None else iterator.__anext__())
+                    except StopAsyncIteration:
+                        break
+                    pending = None
+                else:
+                    if pending is None:
+                        pending = asyncio.ensure_future(iterator.__anext__())
+                    done, _ = await asyncio.wait((pending,), timeout=max(0.0, flush_at - time.perf_counter()))
+                    if not done: # The window has closed with nothing new, send what we have and keep waiting
+                        yield self.event("token", {"text": "".join(buffer)})
+                        buffer, buffered_chars, flush_at = [], 0, None
+                        continue
+                    try:
+                        chunk = pending.result()
+                    except StopAsyncIteration:
+                        pending = None
+                        break
+                    pending = None
+
+                if isinstance(chunk, dict):
+                    if buffer:
+                        yield self.event("token", {"text": "".join(buffer)})
+                        buffer, buffered_chars, flush_at = [], 0, None
+                    yield self.event("ui", chunk)
+                    continue
+
+                if chunk is None:
+                    if not buffer: # Buffered text is going out within the window anyway
+                        yield self.heartbeat()
+                    continue
+                if not chunk:
+                    continue
+                self.text_chunks += 1
+                SSE_TEXT_CHUNKS.inc()
+                if not sent_text:
+                    sent_text = True
+                    yield self.event("token", {"text": chunk})
+                    continue
+                buffer.append(chunk)
+                buffered_chars += len(chunk)
+                if buffered_chars >= self.max_chars:
+                    yield self.event("token", {"text": "".join(buffer)})
+                    buffer, buffered_chars, flush_at = [], 0, None
+                elif flush_at is None:
+                    flush_at = time.perf_counter() + self.window_seconds
+        except Exception:
+            if buffer: # Send the text we have before the error
+                yield self.event("token", {"text": "".join(buffer)})
+            raise
+        finally:
+            if pending is not None and not pending.done():
+                pending.cancel()
+        if buffer:
+            yield self.event("token", {"text": "".join(buffer)})
+
+    def finish(self):
+        """ Records the stream's write counts, once it's over. """
+        seconds = time.perf_counter() - self.started_at
+        SSE_BYTES.inc(self.bytes)
+        SSE_STREAM_WRITES.observe(self.writes)
+        if seconds > 0:
+            SSE_STREAM_THROUGHPUT.observe(self.bytes / seconds)
@@ -0,0 +1,53 @@
+""" Token counting helpers shared across the chatbot services. Used to keep prompts within a token budget.
+
+Uses tiktoken when it's installed, otherwise falls back to a character based estimate (roughly 4 characters per token
+for English text), which is close enough for budgeting purposes. """
+
+_encoding = None
+_encoding_loaded = False
+
+MESSAGE_OVERHEAD_TOKENS = 4 # Every message carries a few tokens of formatting on top of its content (role, separators)
+
+def get_encoding():
+    """ Lazily loads the tiktoken encoding. Returns None if tiktoken isn't available. """
+    global _encoding, _encoding_loaded
+
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base") # Encoding used by the gpt-4o family
+        except Exception:
+            _encoding = None
+    return _encoding
+
+def estimate_tokens(text: str) -> int:
+    """ Estimates the number of tokens in a string.
+
+    Parameters:
+    - text (str): the text to be counted.
+
+    Returns:
+    - (int) the number of tokens. """
+
+    if not text:
+        return 0
+
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return (len(text) + 3) // 4
+
+def estimate_message_tokens(message: dict) -> int:
+    """ Estimates the number of tokens a single chat message will use in the prompt, including the per-message overhead.
+
+    Parameters:
+    - message (dict): an OpenAI formatted message, i.e. {"role": ..., "content": ...}
+
+    Returns:
+    - (int) the number of tokens. """
+
+    content = message.get("content") or ""
+    if not isinstance(content, str):
+        content = str(content)
+    return estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
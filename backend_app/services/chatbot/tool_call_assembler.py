@@ -0,0 +1,119 @@
+""" Assembles streamed tool calls from OpenAI chat completion deltas. Shared by chat_logic and the AgentOrchestrator.
+
+Each tool call is tracked by its tool_calls[i].index. The argument string is scanned incrementally as fragments arrive
+(tracking brace depth and whether we're inside a string), so we know the moment an argument object is complete without
+re-parsing the whole string after every delta. Completed calls are handed back straight away so the caller can start
+the tool while the model is still emitting later calls. """
+
+import json
+
+class ToolCall:
+    def __init__(self, index: int):
+        self.index = index
+        self.id = None
+        self.name = None
+        self.arguments = ""
+        self.complete = False
+        self.dispatched = False
+
+        # Incremental scanner state
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+
+    def add_arguments(self, fragment: str) -> bool:
+        """ Appends an argument fragment, scanning only the new characters.
+
+        Returns:
+        - (bool) True if this fragment closed the top-level argument object. """
+
+        self.arguments += fragment
+        if self.complete:
+            return False
+
+        for char in fragment:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+                self.started = True
+            elif char in "}]":
+                self.depth -= 1
+                if self.started and self.depth == 0:
+                    self.complete = True
+                    return True
+        return False
+
+    def parsed_arguments(self) -> dict:
+        """ Parses the argument string. Only called once the call is complete. Returns an empty dict if the model
+        produced invalid JSON. """
+        try:
+            arguments = json.loads(self.arguments or "{}")
+        except json.JSONDecodeError:
+            return {}
+        return arguments if isinstance(arguments, dict) else {}
+
+class ToolCallAssembler:
+    def __init__(self):
+        self.calls = {} # Maps tool_calls[i].index to its ToolCall
+
+    def add_delta(self, tool_call_deltas) -> list:
+        """ Adds the tool_calls from a single streamed delta.
+
+        Parameters:
+        - tool_call_deltas (list): chunk.choices[0].delta.tool_calls
+
+        Returns:
+        - (list) ToolCall objects that became ready to dispatch with this delta. """
+
+        ready = []
+        for tool_call_delta in tool_call_deltas or []:
+            index = tool_call_delta.index
+            tool_call = self.calls.get(index)
+
+            if tool_call is None:
+                tool_call = ToolCall(index)
+                self.calls[index] = tool_call
+                # The model has moved on to a new call, so any earlier calls are finished even if we didn't spot it
+                ready.extend(self.take_ready(before_index=index))
+
+            if tool_call_delta.id:
+                tool_call.id = tool_call_delta.id
+            function = tool_call_delta.function
+            if function is not None:
+                if function.name:
+                    tool_call.name = function.name
+                if function.arguments:
+                    tool_call.add_arguments(function.arguments)
+
+        ready.extend(self.take_ready(complete_only=True))
+        return ready
+
+    def take_ready(self, before_index: int = None, complete_only: bool = False) -> list:
+        """ Marks calls as dispatched and returns them. Either every complete call, or every call before an index. """
+        ready = []
+        for index, tool_call in sorted(self.calls.items()):
+            if tool_call.dispatched or tool_call.name is None:
+                continue
+            if before_index is not None and index >= before_index:
+                continue
+            if complete_only and not tool_call.complete:
+                continue
+            tool_call.dispatched = True
+            ready.append(tool_call)
+        return ready
+
+    def flush(self) -> list:
+        """ Called once the stream has ended. Returns any calls that haven't been dispatched yet. """
+        return self.take_ready()
+
+    def __len__(self):
+        return len(self.calls)
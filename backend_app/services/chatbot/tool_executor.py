@@ -0,0 +1,101 @@
+""" Runs the tool calls from a single chat turn concurrently. Async tools run as asyncio tasks, blocking tools run on the
+bounded thread pool in functions.py (see execute_function_call), and results are handed back as each tool finishes, so
+a turn takes as long as its slowest tool rather than the sum of all of them.
+
+Streaming tools (async generators, e.g. get_news) can also hand back partial UI updates while they're still running.
+These come through in the same stream of results, marked with "partial": True. """
+
+from backend_app.services.chatbot import functions
+from backend_app.services.monitoring.metrics import TOOL_CALLS, TOOL_DURATION, record_finished, record_cancelled
+import asyncio
+import os
+import time
+
+DEFAULT_TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT_SECONDS", 20))
+
+# Tools that are expected to take longer than the default (they make their own LLM calls)
+tool_timeouts = {
+    "get_news": 45,
+    "agent_orchestrator": 60,
+}
+
+class ToolExecutor:
+    def __init__(self, default_timeout: float = DEFAULT_TOOL_TIMEOUT):
+        self.default_timeout = default_timeout
+        self.tasks = {} # Maps each running task to its ToolCall
+        self.results = asyncio.Queue() # (tool_call, tool_output) for partial updates and finished tools, in the order they happen
+        self.unfinished = 0 # Tools that haven't queued their final output yet
+
+    def submit(self, tool_call):
+        """ Starts a tool call straight away without waiting on it.
+
+        Parameters:
+        - tool_call (ToolCall): the completed call from the ToolCallAssembler. """
+
+        self.unfinished += 1
+        task = asyncio.create_task(self.run_tool(tool_call))
+        self.tasks[task] = tool_call
+        task.add_done_callback(lambda task: self.tasks.pop(task, None))
+
+    async def run_tool(self, tool_call):
+        """ Runs a single tool with its timeout and queues its output. Errors and timeouts are returned to the model as
+        a normal tool response so that one failing tool doesn't take down the rest of the turn. """
+
+        function_name = tool_call.name
+        timeout = tool_timeouts.get(function_name, self.default_timeout)
+        on_update = lambda update: self.results.put_nowait((tool_call, update))
+        started_at = time.perf_counter()
+        status = "ok"
+
+        try:
+            tool_output = await asyncio.wait_for(functions.execute_function_call(function_name, tool_call.arguments, on_update), timeout=timeout)
+        except asyncio.CancelledError:
+            # The turn was cancelled (e.g. the client went away). Async tools stop where they are, blocking tools carry
+            # on in their thread until they return, but nothing waits for them
+            TOOL_CALLS.labels(function_name, "cancelled").inc()
+            record_cancelled("tool", function_name, time.perf_counter() - started_at)
+            raise
+        except asyncio.TimeoutError:
+            # Note that a blocking tool will carry on in its thread until it returns, we just stop waiting for it
+            print(f"Tool {function_name} timed out after {timeout}s")
+            tool_output = functions.create_json_response(response_model_content=f"Error: {function_name} timed out.")
+            status = "timeout"
+        except Exception as e:
+            print(f"Error in tool {function_name}: {e}")
+            tool_output = functions.create_json_response(response_model_content=f"Error: {function_name} failed.")
+            status = "error"
+
+        elapsed = time.perf_counter() - started_at
+        TOOL_DURATION.labels(function_name).observe(elapsed)
+        TOOL_CALLS.labels(function_name, status).inc()
+        if status == "ok":
+            record_finished("tool", function_name, elapsed)
+
+        if tool_output is None:
+            tool_output = functions.create_json_response(response_model_content=f"Error: {function_name} returned no result.")
+        self.unfinished -= 1
+        self.results.put_nowait((tool_call, tool_output))
+
+    async def as_completed(self):
+        """ Yields (tool_call, tool_output) for each partial update and each finished tool, in the order they happen,
+        until every submitted tool has finished. """
+        while self.unfinished or not self.results.empty():
+            yield await self.results.get()
+
+    def pop_completed(self) -> list:
+        """ Returns (tool_call, tool_output) for any updates and finished tools so far, without waiting. Lets the caller
+        pass results on while the model is still streaming. """
+        completed = []
+        while not self.results.empty():
+            completed.append(self.results.get_nowait())
+        return completed
+
+    def cancel(self):
+        """ Cancels any tools that are still running, e.g. if the client has gone away. """
+        for task in list(self.tasks):
+            task.cancel()
+        self.tasks.clear()
+        self.unfinished = 0
+
+    def __len__(self):
+        return self.unfinished
@@ -1 +1,280 @@
-pass
\ No newline at end of file
+""" Async connector for the Financial Modeling Prep (FMP) API, used by the CompanyDataAgent for fundamentals.
+
+- Every dataset for every requested ticker is fetched concurrently over one pooled HTTP client.
+- Endpoints that take a comma separated list of tickers (profile, quote) are fetched in batches of up to
+  MAX_BATCH_SIZE tickers per request. FMP's statement endpoints only take one ticker each (its bulk endpoints are
+  whole-market CSV dumps, far more than a chat question needs), so those are one request per ticker.
+- Requests go through the shared upstream scheduler ('fmp' provider), so they're paced to FMP's rate limits.
+- Responses are written to an on-disk cache keyed by version, endpoint, period and ticker:
+
+      {FMP_CACHE_DIR}/{CACHE_VERSION}/{endpoint}/{period}/{TICKER}.json
+
+  Each dataset has its own TTL (statements only change when a company reports, quotes change by the minute). Cached
+  responses are served first, so asking a second question about the same company doesn't go upstream. When FMP
+  can't be reached (or we're out of budget), expired entries are served instead. Bump CACHE_VERSION whenever the
+  stored format changes, so old entries are ignored.
+
+Run the local fixture server (fmp_fixture_server.py) and set FMP_BASE_URL to use this without an API key. """
+
+from backend_app.services.upstream.upstream_scheduler import upstream_scheduler, UpstreamBudgetExceeded, UpstreamThrottled
+import asyncio
+import httpx
+import json
+import os
+import re
+import time
+
+FMP_BASE_URL = os.getenv("FMP_BASE_URL", "https://financialmodelingprep.com/api/v3")
+CACHE_DIRECTORY = os.getenv("FMP_CACHE_DIR", "./fmp_cache")
+CACHE_VERSION = "v1"
+FETCH_TIMEOUT_SECONDS = float(os.getenv("FMP_FETCH_TIMEOUT_SECONDS", 10))
+MAX_BATCH_SIZE = 50 # Tickers per request, for the endpoints that take a list
+DEFAULT_LIMIT = 5 # Periods fetched for statements. Always fetched in full so later questions can reuse them
+TICKER_PATTERN = re.compile(r"^[A-Z0-9][A-Z0-9.\-]{0,9}$") # Tickers come from the model and end up in URLs and cache paths
+
+DAY = 24 * 3600
+
+# Endpoint to (whether it takes a list of tickers, whether it has annual/quarterly periods, seconds it's cached for)
+datasets = {
+    "profile": (True, False, 7 * DAY),
+    "quote": (True, False, 60),
+    "income-statement": (False, True, DAY),
+    "balance-sheet-statement": (False, True, DAY),
+    "cash-flow-statement": (False, True, DAY),
+    "ratios": (False, True, DAY),
+    "key-metrics": (False, True, DAY),
+    "ratios-ttm": (False, False, DAY),
+}
+
+class FMPError(Exception):
+    """ Raised when FMP returns an error payload, e.g. an invalid API key or an endpoint outside our plan. """
+
+def valid_tickers(tickers: list) -> list:
+    """ Drops (and logs) anything that isn't a plausible ticker, e.g. one containing '/' or '..'. """
+    invalid = [ticker for ticker in tickers if not TICKER_PATTERN.match(ticker)]
+    if invalid:
+        print(f"Ignoring invalid FMP tickers: {invalid}")
+    return [ticker for ticker in tickers if TICKER_PATTERN.match(ticker)]
+
+class FMPConnector:
+    def __init__(self, base_url: str = FMP_BASE_URL, cache_directory: str = CACHE_DIRECTORY):
+        self.api_key = os.getenv("FMP_API_KEY")
+        self.base_url = base_url.rstrip("/")
+        self.cache_directory = os.path.join(cache_directory, CACHE_VERSION)
+        self.http_client = None # Created on first use, so it's bound to the running event loop
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.stale_fallbacks = 0
+        self.requests = 0
+        self.errors = 0
+
+    def get_http_client(self) -> httpx.AsyncClient:
+        if self.http_client is None or self.http_client.is_closed:
+            self.http_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(FETCH_TIMEOUT_SECONDS),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=30),
+            )
+        return self.http_client
+
+    async def close(self):
+        """ Closes the pooled HTTP client. Called on app shutdown. """
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+
+    def cache_path(self, dataset: str, period: str, ticker: str) -> str:
+        return os.path.join(self.cache_directory, dataset, period, f"{ticker}.json")
+
+    def read_cache(self, dataset: str, period: str, tickers: list) -> dict:
+        """ Returns {ticker: (fetched_at, data)} for the tickers we have a cached response for, fresh or not. """
+        cached = {}
+        for ticker in tickers:
+            try:
+                with open(self.cache_path(dataset, period, ticker), "r") as cache_file:
+                    entry = json.load(cache_file)
+                cached[ticker] = (entry["fetched_at"], entry["data"])
+            except (OSError, ValueError, KeyError):
+                continue
+        return cached
+
+    def write_cache(self, dataset: str, period: str, responses: dict):
+        """ Writes {ticker: data} to the cache. Each file is written to a temp file first and swapped in, so a reader
+        never sees a half written response. """
+        directory = os.path.join(self.cache_directory, dataset, period)
+        os.makedirs(directory, exist_ok=True)
+        fetched_at = time.time()
+        for ticker, data in responses.items():
+            path = self.cache_path(dataset, period, ticker)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "w") as cache_file:
+                json.dump({"fetched_at": fetched_at, "data": data}, cache_file)
+            os.replace(temp_path, path)
+
+    async def request(self, dataset: str, tickers: list, period: str) -> dict:
+        """ Makes one request to FMP.
+
+        Returns:
+        - (dict) each requested ticker mapped to its rows (an empty list if FMP had nothing for it). """
+
+        _, has_periods, _ = datasets[dataset]
+        params = {"apikey": self.api_key}
+        if has_periods:
+            params["period"] = period
+            params["limit"] = DEFAULT_LIMIT
+
+        await upstream_scheduler.acquire_async("fmp")
+        self.requests += 1
+        response = await self.get_http_client().get(f"{self.base_url}/{dataset}/{','.join(tickers)}", params=params)
+        if response.status_code == 429:
+            upstream_scheduler.report_throttled("fmp")
+            raise UpstreamThrottled("FMP rate limit reached")
+        response.raise_for_status()
+
+        payload = response.json()
+        if isinstance(payload, dict):
+            if "Error Message" in payload:
+                raise FMPError(payload["Error Message"])
+            payload = [payload]
+
+        rows = {ticker: [] for ticker in tickers}
+        for row in payload:
+            symbol = str(row.get("symbol", "")).upper()
+            if symbol in rows:
+                rows[symbol].append(row)
+        return rows
+
+    async def fetch_dataset(self, dataset: str, tickers: list, period: str) -> dict:
+        """ Fetches a dataset for the tickers, in batches where the endpoint allows it, and caches the responses.
+        Failed requests are logged and left out of the result. Tickers FMP had nothing for are returned with no rows,
+        but not cached, so a mistyped symbol or a gap on FMP's side isn't remembered as "no data" for a day. """
+
+        tickers = valid_tickers(tickers)
+        takes_list, _, _ = datasets[dataset]
+        batches = [tickers[i:i + MAX_BATCH_SIZE] for i in range(0, len(tickers), MAX_BATCH_SIZE)] if takes_list else [[ticker] for ticker in tickers]
+        responses = await asyncio.gather(*(self.request(dataset, batch, period) for batch in batches), return_exceptions=True)
+
+        fetched = {}
+        for batch, response in zip(batches, responses):
+            if isinstance(response, asyncio.CancelledError):
+                raise response
+            if isinstance(response, Exception):
+                self.errors += 1
+                kind = "rate limited" if isinstance(response, (UpstreamBudgetExceeded, UpstreamThrottled)) else "failed"
+                print(f"FMP request {kind} for {dataset} {','.join(batch)}: {response}")
+                continue
+            fetched.update(response)
+
+        found = {ticker: rows for ticker, rows in fetched.items() if rows}
+        if found:
+            try:
+                await asyncio.to_thread(self.write_cache, dataset, period, found)
+            except OSError as e:
+                print(f"Error writing to the FMP cache: {e}")
+        return fetched
+
+    async def get_dataset(self, dataset: str, tickers: list, period: str) -> dict:
+        """ Returns {ticker: rows} for a dataset, from the cache where it's fresh and from FMP otherwise. Tickers we
+        couldn't get anything for are left out. """
+
+        _, has_periods, ttl = datasets[dataset]
+        period = period if has_periods else "none"
+        cached = await asyncio.to_thread(self.read_cache, dataset, period, tickers)
+
+        now = time.time()
+        result = {ticker: data for ticker, (fetched_at, data) in cached.items() if now - fetched_at < ttl}
+        missing = [ticker for ticker in tickers if ticker not in result]
+        self.cache_hits += len(result)
+        self.cache_misses += len(missing)
+        if not missing:
+            return result
+
+        result.update(await self.fetch_dataset(dataset, missing, period))
+
+        # Fall back to expired responses for the tickers we couldn't fetch, or that FMP had nothing for this time
+        for ticker in missing:
+            if ticker in cached and not result.get(ticker):
+                result[ticker] = cached[ticker][1]
+                self.stale_fallbacks += 1
+        return result
+
+    async def get_company_data(self, tickers: list, requested_datasets: list, period: str = "annual", timeout: float = None) -> dict:
+        """ Fetches several datasets for several companies at once.
+
+        Parameters:
+        - tickers (list): the ticker symbols, e.g. ['AAPL', 'MSFT']. A string is taken as one ticker, or several
+          separated by commas (the model sometimes sends 'AAPL,MSFT' rather than a list).
+        - requested_datasets (list): the datasets (keys of `datasets`) to fetch, e.g. ['profile', 'income-statement'].
+        - period (str): 'annual' or 'quarter', for the datasets that have periods.
+        - timeout (float): the longest to wait, in seconds. Datasets that aren't back in time are served from the
+          cache if possible and otherwise left out, so the caller gets a partial result rather than nothing.
+
+        Returns:
+        - (dict) {ticker: {dataset: rows}}. """
+
+        if isinstance(tickers, str):
+            tickers = tickers.split(",")
+        tickers = valid_tickers(list(dict.fromkeys(str(ticker).strip().upper() for ticker in tickers if str(ticker).strip())))
+        requested_datasets = [dataset for dataset in dict.fromkeys(requested_datasets) if dataset in datasets]
+        period = "quarter" if period == "quarter" else "annual"
+
+        tasks = {asyncio.create_task(self.get_dataset(dataset, tickers, period)): dataset for dataset in requested_datasets}
+        result = {ticker: {} for ticker in tickers}
+        if not tasks:
+            return result
+
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=timeout)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        # Datasets still waiting on FMP fall back to anything cached, fresh or not
+        for task in pending:
+            dataset = tasks[task]
+            _, has_periods, _ = datasets[dataset]
+            print(f"FMP {dataset} didn't finish within {timeout}s, using cached data")
+            cached = await asyncio.to_thread(self.read_cache, dataset, period if has_periods else "none", tickers)
+            for ticker, (_, data) in cached.items():
+                result[ticker][dataset] = data
+
+        for task, dataset in tasks.items(): # In the order they were asked for
+            if task not in done:
+                continue
+            if task.exception():
+                print(f"Error fetching FMP {dataset}: {task.exception()}")
+                continue
+            for ticker, data in task.result().items():
+                result[ticker][dataset] = data
+        return result
+
+    async def get_index_constituents(self, index: str = "sp500") -> list:
+        """ Returns the tickers in an index, e.g. to build the fundamentals table for the whole S&P 500.
+
+        Parameters:
+        - index (str): 'sp500', 'nasdaq' or 'dowjones'.
+
+        Returns:
+        - (list) the ticker symbols. """
+
+        await upstream_scheduler.acquire_async("fmp")
+        self.requests += 1
+        response = await self.get_http_client().get(f"{self.base_url}/{index}_constituent", params={"apikey": self.api_key})
+        response.raise_for_status()
+        payload = response.json()
+        if isinstance(payload, dict) and "Error Message" in payload:
+            raise FMPError(payload["Error Message"])
+        return [row["symbol"] for row in payload if row.get("symbol")]
+
+    def stats(self) -> dict:
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "hit_rate": self.cache_hits / lookups if lookups else 0.0,
+            "stale_fallbacks": self.stale_fallbacks,
+            "requests": self.requests,
+            "errors": self.errors,
+        }
+
+fmp_connector = FMPConnector()
@@ -0,0 +1,152 @@
+""" A local stand-in for the Financial Modeling Prep API, so the FMPConnector and CompanyDataAgent can be run and tested
+without an API key or network access. Start it with:
+
+    python -m backend_app.services.data_access_layer.api_connectors.fmp_fixture_server --port 8002
+
+and run the backend with FMP_BASE_URL=http://127.0.0.1:8002/api/v3.
+
+Serves every dataset the connector uses, with the same shape of response as FMP. The figures are made up but
+deterministic for each ticker, so repeated runs give the same answers. Tickers starting with 'X' are treated as
+unknown and get nothing back, like FMP does for symbols it doesn't cover. Each response is delayed by
+FAKE_FMP_LATENCY_MS. Requests are counted by dataset (GET /stats), which makes it easy to check what was served from
+the connector's cache. """
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from collections import Counter
+import argparse
+import asyncio
+import datetime
+import os
+import zlib
+
+LATENCY_SECONDS = float(os.getenv("FAKE_FMP_LATENCY_MS", 100)) / 1000
+UNIVERSE_SIZE = int(os.getenv("FAKE_FMP_UNIVERSE_SIZE", 500))
+
+app = FastAPI()
+request_counts = Counter()
+
+SECTORS = [("Technology", "Software"), ("Healthcare", "Pharmaceuticals"), ("Financial Services", "Banks"),
+           ("Consumer Cyclical", "Retail"), ("Industrials", "Machinery"), ("Energy", "Oil & Gas"), ("Utilities", "Electric Utilities")]
+
+def company_traits(ticker: str) -> dict:
+    """ Stable, made up characteristics for a ticker, so companies differ in size, margins, leverage and valuation. """
+    seed = zlib.crc32(ticker.encode("utf-8"))
+    fraction = lambda shift: ((seed >> shift) & 0xFF) / 255
+    gross_margin = 0.2 + 0.5 * fraction(0)
+    return {
+        "revenue": 1e9 * (1 + seed % 400), # Between 1bn and 400bn
+        "gross_margin": gross_margin,
+        "operating_margin": gross_margin * (0.2 + 0.6 * fraction(8)),
+        "fcf_margin": gross_margin * (0.05 + 0.5 * fraction(16)),
+        "debt": 0.1 + 1.2 * fraction(24), # Total debt as a multiple of revenue
+        "sales_multiple": 0.8 + 9 * fraction(4), # Market cap as a multiple of revenue
+        "sector": SECTORS[seed % len(SECTORS)],
+    }
+
+def period_dates(period: str, limit: int) -> list:
+    year = datetime.date.today().year - 1
+    if period == "quarter":
+        quarters = [(year - i // 4, 4 - i % 4) for i in range(limit)]
+        return [(f"{y}-{3 * q:02d}-{30 if q in (2, 3) else 31}", y, f"Q{q}") for y, q in quarters]
+    return [(f"{year - i}-12-31", year - i, "FY") for i in range(limit)]
+
+def statement_rows(dataset: str, ticker: str, period: str, limit: int) -> list:
+    traits = company_traits(ticker)
+    scale = traits["revenue"] / (4 if period == "quarter" else 1)
+    rows = []
+    for index, (date, year, period_name) in enumerate(period_dates(period, limit)):
+        revenue = scale * 0.92 ** index # Growing about 8% a period
+        gross, operating, fcf = (revenue * traits[margin] for margin in ("gross_margin", "operating_margin", "fcf_margin"))
+        net, ebitda, debt = operating * 0.78, operating * 1.25, revenue * traits["debt"]
+        equity, cash, market_cap = revenue * 0.7, revenue * 0.3, revenue * traits["sales_multiple"]
+        row = {"date": date, "symbol": ticker, "reportedCurrency": "USD", "calendarYear": str(year), "period": period_name}
+        if dataset == "income-statement":
+            row.update({
+                "revenue": round(revenue), "costOfRevenue": round(revenue - gross), "grossProfit": round(gross),
+                "operatingIncome": round(operating), "netIncome": round(net), "eps": round(net / 1.5e9, 2), "ebitda": round(ebitda),
+            })
+        elif dataset == "balance-sheet-statement":
+            row.update({
+                "cashAndCashEquivalents": round(cash), "totalAssets": round(equity + debt + revenue * 0.2),
+                "totalLiabilities": round(debt + revenue * 0.2), "totalStockholdersEquity": round(equity),
+                "totalDebt": round(debt), "netDebt": round(debt - cash),
+            })
+        elif dataset == "cash-flow-statement":
+            row.update({
+                "operatingCashFlow": round(fcf + revenue * 0.06), "capitalExpenditure": -round(revenue * 0.06),
+                "freeCashFlow": round(fcf), "dividendsPaid": -round(fcf * 0.3), "commonStockRepurchased": -round(fcf * 0.2),
+            })
+        elif dataset == "ratios":
+            row.update({
+                "grossProfitMargin": round(gross / revenue, 4), "operatingProfitMargin": round(operating / revenue, 4),
+                "netProfitMargin": round(net / revenue, 4), "returnOnEquity": round(net / equity, 4), "currentRatio": 1.4,
+                "debtEquityRatio": round(debt / equity, 4), "priceEarningsRatio": round(market_cap / net, 2),
+            })
+        elif dataset == "key-metrics":
+            row.update({
+                "marketCap": round(market_cap), "enterpriseValue": round(market_cap + debt - cash), "peRatio": round(market_cap / net, 2),
+                "freeCashFlowYield": round(fcf / market_cap, 4), "dividendYield": round(fcf * 0.3 / market_cap, 4),
+                "revenuePerShare": round(revenue / 1.5e9, 2),
+            })
+        rows.append(row)
+    return rows
+
+def snapshot_row(dataset: str, ticker: str) -> dict:
+    traits = company_traits(ticker)
+    revenue, market_cap = traits["revenue"], traits["revenue"] * traits["sales_multiple"]
+    net = revenue * traits["operating_margin"] * 0.78
+    price = round(market_cap / 1.5e9, 2)
+    if dataset == "profile":
+        sector, industry = traits["sector"]
+        return {
+            "symbol": ticker, "companyName": f"{ticker} Holdings Inc.", "currency": "USD", "exchangeShortName": "NASDAQ",
+            "sector": sector, "industry": industry, "price": price, "mktCap": round(market_cap), "beta": round(0.6 + traits["debt"], 2),
+            "description": f"{ticker} Holdings operates in {industry.lower()} worldwide.",
+        }
+    if dataset == "quote":
+        return {"symbol": ticker, "price": price, "marketCap": round(market_cap), "pe": round(market_cap / net, 2), "volume": 1_000_000}
+    return {"symbol": ticker, "grossProfitMarginTTM": round(traits["gross_margin"], 4), "operatingProfitMarginTTM": round(traits["operating_margin"], 4),
+            "netProfitMarginTTM": round(traits["operating_margin"] * 0.78, 4), "returnOnEquityTTM": round(net / (revenue * 0.7), 4),
+            "peRatioTTM": round(market_cap / net, 2), "debtEquityRatioTTM": round(traits["debt"] / 0.7, 4)}
+
+@app.get("/api/v3/{index}_constituent")
+async def fmp_index_constituents(index: str):
+    """ A made up universe of UNIVERSE_SIZE tickers (T0000, T0001, ...), so the fundamentals table can be built at scale. """
+    request_counts[f"{index}_constituent"] += 1
+    return [{"symbol": f"T{i:04d}", "name": f"T{i:04d} Holdings Inc.", "sector": "Technology"} for i in range(UNIVERSE_SIZE)]
+
+@app.get("/api/v3/{dataset}/{tickers}")
+async def fmp_dataset(dataset: str, tickers: str, request: Request):
+    await asyncio.sleep(LATENCY_SECONDS)
+    request_counts[dataset] += 1
+    period = request.query_params.get("period", "annual")
+    limit = int(request.query_params.get("limit", 5))
+
+    rows = []
+    for ticker in tickers.upper().split(","):
+        if not ticker or ticker.startswith("X"):
+            continue
+        if dataset in ("income-statement", "balance-sheet-statement", "cash-flow-statement", "ratios", "key-metrics"):
+            rows.extend(statement_rows(dataset, ticker, period, limit))
+        elif dataset in ("profile", "quote", "ratios-ttm"):
+            rows.append(snapshot_row(dataset, ticker))
+        else:
+            return JSONResponse({"Error Message": f"Invalid API call: {dataset} isn't served by the fixture server."})
+    return rows
+
+@app.get("/stats")
+async def stats():
+    return dict(request_counts)
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run a local Financial Modeling Prep fixture server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,139 @@
-""" Handles requests for quantitative data by interacting with external APIs. Working towards engaging with 
-financialmodelingprep_api_connector.py for API calls."""
+""" Handles requests for quantitative data by interacting with external APIs. The model decides which companies and
+datasets are needed, and the data itself comes from financialmodelingprep_api_connector.py, which answers from its
+on-disk cache wherever it can. """
 
-from openai import AsyncOpenAI
 from backend_app.Agents import BaseAgent
+from backend_app.services.llm.llm_gateway import llm_gateway
+from backend_app.services.chatbot.tool_call_assembler import ToolCallAssembler
+from backend_app.services.data_access_layer.api_connectors.financialmodelingprep_api_connector import fmp_connector
 import os
-import json 
+import json
+import re
+import time
 
-system_prompt = f""
+system_prompt = "You're the company data agent for a financial market research application. You receive requests for quantitative company data from the orchestrating agent. Call get_company_fundamentals once with every company and dataset needed to satisfy the request, and nothing more."
 model_choice = "gpt-4o-mini"
 
 file_path = os.path.join(os.path.dirname(__file__), "company_data_agent_tools.json")
 with open(file_path, "r") as tools_file:
     tools = json.load(tools_file)
 
+TICKER_PATTERN = re.compile(r"\b[A-Z]{1,5}\b")
+NOT_TICKERS = {"A", "I", "CEO", "CFO", "EPS", "FY", "TTM", "USD", "PE", "ROE", "EV", "FCF", "YOY", "QOQ", "AND", "OR", "THE"}
+DEFAULT_DATASETS = ["profile", "income-statement", "ratios"]
+DEFAULT_PERIODS = 3
+
+# The fields from each dataset worth passing to the model, so a few years of statements stays a few hundred tokens
+summary_fields = {
+    "profile": ["companyName", "sector", "industry", "price", "mktCap", "beta"],
+    "quote": ["price", "marketCap", "pe", "volume"],
+    "income-statement": ["revenue", "grossProfit", "operatingIncome", "netIncome", "ebitda", "eps"],
+    "balance-sheet-statement": ["cashAndCashEquivalents", "totalAssets", "totalLiabilities", "totalStockholdersEquity", "totalDebt", "netDebt"],
+    "cash-flow-statement": ["operatingCashFlow", "capitalExpenditure", "freeCashFlow", "dividendsPaid", "commonStockRepurchased"],
+    "ratios": ["grossProfitMargin", "operatingProfitMargin", "netProfitMargin", "returnOnEquity", "currentRatio", "debtEquityRatio", "priceEarningsRatio"],
+    "key-metrics": ["marketCap", "enterpriseValue", "peRatio", "freeCashFlowYield", "dividendYield"],
+    "ratios-ttm": ["grossProfitMarginTTM", "operatingProfitMarginTTM", "netProfitMarginTTM", "returnOnEquityTTM", "peRatioTTM", "debtEquityRatioTTM"],
+}
+
+def format_value(value):
+    """ Shortens large figures, e.g. 383285000000 to 383.29B. """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return str(value)
+    for threshold, suffix in ((1e12, "T"), (1e9, "B"), (1e6, "M")):
+        if abs(value) >= threshold:
+            return f"{value / threshold:.2f}{suffix}"
+    return f"{value:.4g}" if isinstance(value, float) else str(value)
+
+def format_rows(dataset: str, rows: list, periods: int) -> str:
+    fields = summary_fields.get(dataset, [])
+    lines = []
+    for row in rows[:periods]:
+        label = f"{row.get('period', '')} {row.get('date', '')}".strip()
+        values = ", ".join(f"{field}={format_value(row[field])}" for field in fields if row.get(field) is not None)
+        lines.append(f"  {label + ': ' if label else ''}{values}")
+    return "\n".join(lines)
+
+def format_company_data(company_data: dict, period: str, periods: int) -> str:
+    """ Formats the connector's {ticker: {dataset: rows}} as compact text for the model. """
+    sections = []
+    for ticker, ticker_datasets in company_data.items():
+        if not any(ticker_datasets.values()):
+            sections.append(f"{ticker}: no data available.")
+            continue
+        lines = [f"{ticker}:"]
+        for dataset, rows in ticker_datasets.items():
+            if rows:
+                lines.append(f" {dataset} ({period}):" if dataset in ("income-statement", "balance-sheet-statement", "cash-flow-statement", "ratios", "key-metrics") else f" {dataset}:")
+                lines.append(format_rows(dataset, rows, periods))
+        sections.append("\n".join(lines))
+    return "\n".join(sections)
+
+def extract_tickers(text: str) -> list:
+    return [ticker for ticker in dict.fromkeys(TICKER_PATTERN.findall(text or "")) if ticker not in NOT_TICKERS]
+
 class CompanyDataAgent(BaseAgent):
     def __init__(self):
-        # Can store persistent state variables here later down the line
+        # Nothing is held per request, so one agent is shared by every orchestration (see AgentOrchestrator)
         pass
 
-    async def create_agent_response(self, prompt : str):
-        return "Inform the user that company_data_agent was called successfully and that further functionality needs to be added to this agent. No further response is required."
-        # try:
-        #     aclient = AsyncOpenAI()
-        #     messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}]
-
-        #     response = await aclient.chat.completions.create(model=model_choice,
-        #     messages=messages,
-        #     tools=tools,  # Lists tools for the model's usage
-        #     tool_choice="required",  # "none" = message only, "auto" = message/tools, "required" = tools only
-        #     stream=True,
-        #     parallel_tool_calls=True, 
-        #     )
-
-        #     return "response"
-
-        # except Exception as e: 
-        #     print(f"Exception occured in company_data_agent.py: {e}")
-        #     return { f"error: {e}"}
+    async def plan_requests(self, prompt : str) -> list:
+        """ Asks the model which companies and datasets the request needs.
+
+        Returns:
+        - (list) the arguments of each get_company_fundamentals call. """
+
+        messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}]
+
+        response = llm_gateway.stream_chat("company_data_agent", model=model_choice,
+        messages=messages,
+        tools=tools,  # Lists tools for the model's usage
+        tool_choice="required",  # "none" = message only, "auto" = message/tools, "required" = tools only
+        stream=True,
+        parallel_tool_calls=True,
+        )
+
+        tool_call_assembler = ToolCallAssembler()
+        tool_calls = []
+        async for chunk in response:
+            if not chunk.choices:
+                print(f"CompanyDataAgent token usage: {chunk.usage.total_tokens}")
+                continue
+            tool_calls.extend(tool_call_assembler.add_delta(chunk.choices[0].delta.tool_calls))
+        tool_calls.extend(tool_call_assembler.flush())
+        return [tool_call.parsed_arguments() for tool_call in tool_calls if tool_call.name == "get_company_fundamentals"]
+
+    async def create_agent_response(self, prompt : str, time_budget : float = None):
+        """ Fetches the quantitative data asked for in the prompt.
+
+        Parameters:
+        - prompt (str): the request from the orchestrating agent.
+        - time_budget (float): how long we have, in seconds. Data that isn't back in time is served from the cache if
+          possible and otherwise left out, rather than holding up the rest of the orchestration.
+
+        Returns:
+        - (str) the data, formatted for the model. """
+
+        started_at = time.monotonic()
+        try:
+            planned_requests = await self.plan_requests(prompt)
+        except Exception as e:
+            print(f"Exception occured in company_data_agent.py: {e}")
+            planned_requests = []
+
+        # If the model didn't give us the tickers, go on the ones mentioned in the prompt
+        planned_requests = planned_requests or [{}]
+        responses = []
+        for arguments in planned_requests:
+            tickers = arguments.get("tickers") or extract_tickers(prompt)
+            if not tickers:
+                responses.append("No tickers were identified in the request.")
+                continue
+            datasets = arguments.get("datasets") or DEFAULT_DATASETS
+            period = arguments.get("period") or "annual"
+            periods = min(max(int(arguments.get("periods") or DEFAULT_PERIODS), 1), 5)
+
+            timeout = None if time_budget is None else max(time_budget - (time.monotonic() - started_at), 0.5)
+            company_data = await fmp_connector.get_company_data(tickers, datasets, period, timeout=timeout)
+            responses.append(format_company_data(company_data, period, periods))
+
+        return "\n".join(responses)
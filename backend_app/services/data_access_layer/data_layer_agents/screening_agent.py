@@ -0,0 +1,94 @@
+""" Answers cross-sectional questions ("S&P 500 names with an FCF yield over 5% and net debt/EBITDA under 1") by
+screening the local fundamentals table, rather than fetching companies one at a time. The model turns the request into
+filter and ranking expressions, and the screener (analytics/screener.py) evaluates them over the whole table at once. """
+
+from backend_app.Agents import BaseAgent
+from backend_app.services.llm.llm_gateway import llm_gateway
+from backend_app.services.chatbot.tool_call_assembler import ToolCallAssembler
+from backend_app.services.analytics.fundamentals_table import fundamentals_store, column_descriptions
+from backend_app.services.analytics.screener import screen, ScreenError
+from backend_app.services.data_access_layer.data_layer_agents.company_data_agent import format_value
+import asyncio
+import os
+import json
+
+columns_prompt = "; ".join(f"{name}: {description}" for name, description in column_descriptions.items())
+system_prompt = f"You're the screening agent for a financial market research application. You receive requests from the orchestrating agent to find, filter or rank companies across the market. Call run_screen once, translating the request into filter expressions and a ranking. Ratios are fractions (5% is 0.05). The columns are: {columns_prompt}."
+model_choice = "gpt-4o-mini"
+MAX_ATTEMPTS = 2 # The model gets one more go if its expressions can't be evaluated
+
+file_path = os.path.join(os.path.dirname(__file__), "screening_agent_tools.json")
+with open(file_path, "r") as tools_file:
+    tools = json.load(tools_file)
+
+def format_screen(result: dict, arguments: dict) -> str:
+    """ Formats the screener's result as compact text for the model. """
+    filters = arguments.get("filters") or []
+    lines = [
+        f"Screened {result['universe']} companies ({'latest period' if arguments.get('latest_only', True) else 'all periods'}) "
+        f"with filters {filters or 'none'}: {result['matches']} matched, ranked by {arguments.get('sort_by') or 'market_cap'} "
+        f"({'descending' if arguments.get('descending', True) else 'ascending'})."
+    ]
+    for row in result["rows"]:
+        values = ", ".join(f"{name}={format_value(row[name])}" for name in result["columns"][4:] if row.get(name) is not None)
+        lines.append(f"{row['ticker']} ({row['name']}, {row['sector']}, FY{row['fiscal_year']}): {values}")
+    return "\n".join(lines)
+
+class ScreeningAgent(BaseAgent):
+    def __init__(self):
+        # The table itself is shared through fundamentals_store, which reloads it when it's rebuilt
+        pass
+
+    async def plan_screen(self, messages : list) -> dict:
+        """ Asks the model for the run_screen arguments. Returns an empty dict if it didn't call the tool. """
+        response = llm_gateway.stream_chat("screening_agent", model=model_choice,
+        messages=messages,
+        tools=tools,  # Lists tools for the model's usage
+        tool_choice="required",  # "none" = message only, "auto" = message/tools, "required" = tools only
+        stream=True,
+        )
+
+        tool_call_assembler = ToolCallAssembler()
+        tool_calls = []
+        async for chunk in response:
+            if not chunk.choices:
+                print(f"ScreeningAgent token usage: {chunk.usage.total_tokens}")
+                continue
+            tool_calls.extend(tool_call_assembler.add_delta(chunk.choices[0].delta.tool_calls))
+        tool_calls.extend(tool_call_assembler.flush())
+        return next((tool_call.parsed_arguments() for tool_call in tool_calls if tool_call.name == "run_screen"), {})
+
+    async def create_agent_response(self, prompt : str, time_budget : float = None):
+        """ Runs the screen asked for in the prompt.
+
+        Parameters:
+        - prompt (str): the request from the orchestrating agent.
+        - time_budget (float): how long we have, in seconds. Screens take milliseconds, so it isn't needed here.
+
+        Returns:
+        - (str) the matching companies, formatted for the model. """
+
+        table = await asyncio.to_thread(fundamentals_store.get_table) # Only touches the disk when the table has changed
+        if not len(table):
+            return "The fundamentals table hasn't been built yet, so no screen could be run."
+
+        messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}]
+        for attempt in range(MAX_ATTEMPTS):
+            arguments = await self.plan_screen(messages)
+            try:
+                result = screen(table,
+                    filters=[expression for expression in arguments.get("filters") or [] if isinstance(expression, str)],
+                    sort_by=arguments.get("sort_by") or "market_cap",
+                    descending=arguments.get("descending", True),
+                    limit=arguments.get("limit"),
+                    latest_only=arguments.get("latest_only", True),
+                )
+            except ScreenError as e:
+                print(f"ScreeningAgent: screen failed ({e}), arguments: {arguments}")
+                messages.append({"role": "user", "content": f"The screen {json.dumps(arguments)} failed: {e} Fix it and call run_screen again."})
+                continue
+
+            print(f"ScreeningAgent: {result['matches']}/{result['universe']} companies matched in {result['elapsed_ms']:.2f}ms")
+            return format_screen(result, arguments)
+
+        return "The screen couldn't be run, as the request couldn't be expressed over the available data."
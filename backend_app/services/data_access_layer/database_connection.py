@@ -1,14 +1,58 @@
-from databases import Database
-from sqlalchemy import create_engine, MetaData
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
-from dotenv import load_dotenv  
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
-DATABASE_URL = os.getenv("DATABASE_URL")
+# PostgreSQL (postgresql+asyncpg://...) in deployment. Falls back to a local SQLite file, which is also what tests use
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./goose.sqlite3")
+DATABASE_ECHO = os.getenv("DATABASE_ECHO", "false").lower() == "true" # Logs every statement, so only for debugging
 
-engine = create_async_engine(DATABASE_URL, echo=True) # Includes connection pooling, extra parameters are available 
-async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+# Pool sizing, per process. Sized for a chat turn holding a connection for a handful of short queries, keep
+# replicas x (pool size + overflow) under the server's max_connections
+POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", 10))
+MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", 10))
+POOL_TIMEOUT_SECONDS = float(os.getenv("DATABASE_POOL_TIMEOUT_SECONDS", 5)) # Fail fast rather than stall a stream
+POOL_RECYCLE_SECONDS = int(os.getenv("DATABASE_POOL_RECYCLE_SECONDS", 1800)) # Under typical proxy/load balancer idle timeouts
 
+is_sqlite = DATABASE_URL.startswith("sqlite")
+
+if is_sqlite:
+    # SQLite handles its own connections, the pool options don't apply
+    engine = create_async_engine(DATABASE_URL, echo=DATABASE_ECHO, connect_args={"timeout": 30})
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def configure_sqlite(connection, _):
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL") # Readers don't block the writer
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+else:
+    engine = create_async_engine(DATABASE_URL, echo=DATABASE_ECHO,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT_SECONDS,
+        pool_recycle=POOL_RECYCLE_SECONDS,
+        pool_pre_ping=True, # Replaces connections dropped while idle, e.g. after a database failover
+    )
+
+async_session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+async def init_database():
+    """ Creates any tables that don't exist yet. """
+    from backend_app.services.data_access_layer.models import Base
+    import backend_app.services.auth.models.user_model # Registers the users table, which the other tables reference
+
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+async def close_database():
+    await engine.dispose()
+
+def pool_stats() -> dict:
+    pool = engine.pool
+    if not hasattr(pool, "checkedout"):
+        return {}
+    return {"size": pool.size(), "checked_out": pool.checkedout(), "overflow": pool.overflow()}
@@ -0,0 +1,59 @@
+""" Tables for the app's persistent state: users (auth/models/user_model.py, which shares this Base), their portfolios
+and positions, and conversation history. Tables are created on startup by database_connection.init_database().
+
+Indexes follow the queries in repositories.py: positions are read by portfolio, portfolios by user, and messages by
+conversation in id order (the pagination cursor). """
+
+from sqlalchemy import Column, DateTime, Float, ForeignKey, Index, Integer, String, Text, UniqueConstraint, func
+from sqlalchemy.orm import declarative_base
+
+Base = declarative_base()
+
+class PortfolioTable(Base):
+    __tablename__ = "portfolios"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    name = Column(String(100), nullable=False, default="default")
+    base_currency = Column(String(3), nullable=False, default="USD")
+    version = Column(Integer, nullable=False, default=1) # Bumped by every write, so other replicas know their cached copy is stale
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    __table_args__ = (UniqueConstraint("user_id", "name", name="uq_portfolios_user_name"),) # Also serves lookups by user
+
+class PositionTable(Base):
+    __tablename__ = "positions"
+    id = Column(Integer, primary_key=True)
+    portfolio_id = Column(Integer, ForeignKey("portfolios.id", ondelete="CASCADE"), nullable=False)
+    symbol = Column(String(32), nullable=False)
+    name = Column(String(200))
+    asset_type = Column(String(32), nullable=False, default="stock")
+    quantity = Column(Float, nullable=False)
+    purchase_price = Column(Float)
+    current_price = Column(Float)
+    sector = Column(String(100))
+    currency = Column(String(3))
+
+    __table_args__ = (UniqueConstraint("portfolio_id", "symbol", name="uq_positions_portfolio_symbol"),) # The upsert key
+
+class ConversationTable(Base):
+    __tablename__ = "conversations"
+    id = Column(String(64), primary_key=True) # The conversation_id sent by the frontend
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    title = Column(String(200))
+    message_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    __table_args__ = (Index("ix_conversations_user_updated", "user_id", "updated_at"),) # A user's conversations, newest first
+
+class ConversationMessageTable(Base):
+    __tablename__ = "conversation_messages"
+    id = Column(Integer, primary_key=True)
+    conversation_id = Column(String(64), ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False)
+    role = Column(String(16), nullable=False)
+    content = Column(Text, nullable=False, default="")
+    name = Column(String(64)) # Tool name, for tool outputs
+    tool_call_id = Column(String(64))
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    __table_args__ = (Index("ix_conversation_messages_conversation_id", "conversation_id", "id"),) # Pages of history
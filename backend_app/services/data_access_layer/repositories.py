@@ -0,0 +1,266 @@
+""" Async reads and writes for portfolios and conversation history (tables in models.py), on the shared engine in
+database_connection.py. Each method uses its own short session, so a connection is only held for the queries
+themselves and never across a streamed response.
+
+Portfolio imports are a bulk upsert keyed on (portfolio, symbol), so importing thousands of positions is one
+statement rather than a query per position. History is paged by message id (a keyset cursor), so reading the 50
+messages before a given one costs the same however long the conversation is.
+
+To import a portfolio file for a user:
+
+    python -m backend_app.services.data_access_layer.repositories --user-id 1 --file ./portfolios/portfolio1.json """
+
+from backend_app.services.data_access_layer.database_connection import async_session_maker, is_sqlite, init_database, close_database
+from backend_app.services.data_access_layer.models import PortfolioTable, PositionTable, ConversationTable, ConversationMessageTable
+from sqlalchemy import select, delete, update, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from datetime import datetime, timezone
+import argparse
+import asyncio
+import json
+
+insert = sqlite_insert if is_sqlite else postgresql_insert # Both support ON CONFLICT ... DO UPDATE
+UPSERT_BATCH_SIZE = 1000 # Rows per statement, under SQLite's limit on bound parameters
+MAX_PAGE_SIZE = 200
+
+position_fields = ("symbol", "name", "asset_type", "quantity", "purchase_price", "current_price", "sector", "currency")
+
+def position_row(portfolio_id: int, position: dict) -> dict:
+    symbol = str(position.get("symbol") or "").strip().upper()
+    if not symbol:
+        raise ValueError(f"Position without a symbol: {position}")
+    try:
+        quantity = float(position["quantity"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"Position {symbol} doesn't have a valid quantity")
+    return {
+        "portfolio_id": portfolio_id,
+        "symbol": symbol,
+        "name": position.get("name"),
+        "asset_type": position.get("asset_type") or "stock",
+        "quantity": quantity,
+        "purchase_price": position.get("purchase_price"),
+        "current_price": position.get("current_price"),
+        "sector": position.get("sector"),
+        "currency": (position.get("currency") or "").upper() or None,
+    }
+
+class PortfolioRepository:
+    def __init__(self, session_maker=async_session_maker):
+        self.session_maker = session_maker
+
+    async def get_portfolio_version(self, user_id: int, name: str = "default"):
+        """ Returns the portfolio's version (bumped on every write), or None if the user doesn't have one. A cheap check
+        for whether a cached copy is still current. """
+        async with self.session_maker() as session:
+            return await session.scalar(select(PortfolioTable.version).where(PortfolioTable.user_id == user_id, PortfolioTable.name == name))
+
+    async def get_portfolio(self, user_id: int, name: str = "default") -> dict:
+        """ Retrieves a user's portfolio in the same shape as the portfolio files, or None if they don't have one.
+
+        Returns:
+        - (dict) {user_id, currency, version, portfolio: [positions]} """
+
+        async with self.session_maker() as session:
+            portfolio = await session.scalar(select(PortfolioTable).where(PortfolioTable.user_id == user_id, PortfolioTable.name == name))
+            if portfolio is None:
+                return None
+            positions = await session.execute(select(*(getattr(PositionTable, field) for field in position_fields))
+                .where(PositionTable.portfolio_id == portfolio.id).order_by(PositionTable.id))
+            return {
+                "user_id": user_id,
+                "currency": portfolio.base_currency,
+                "version": portfolio.version,
+                "portfolio": [dict(row._mapping) for row in positions],
+            }
+
+    async def upsert_positions(self, user_id: int, positions: list, base_currency: str = "USD", name: str = "default",
+                               replace: bool = False) -> int:
+        """ Imports positions into a user's portfolio (creating it if needed) in bulk. Positions already held are updated
+        in place, matched by symbol.
+
+        Parameters:
+        - user_id (int): the owner, which must exist in the users table.
+        - positions (list): position dicts, as in the portfolio files.
+        - base_currency (str): the portfolio's reporting currency.
+        - name (str): the portfolio, for users with more than one.
+        - replace (bool): remove any positions that aren't in this import, i.e. a full resync rather than an update.
+
+        Returns:
+        - (int) the number of positions written.
+
+        Raises:
+        - ValueError if a position doesn't have a symbol or quantity (nothing is written). """
+
+        async with self.session_maker() as session, session.begin():
+            statement = insert(PortfolioTable).values(user_id=user_id, name=name, base_currency=base_currency.upper(), version=1, updated_at=datetime.now(timezone.utc))
+            statement = statement.on_conflict_do_update(
+                index_elements=["user_id", "name"],
+                set_={"base_currency": statement.excluded.base_currency, "version": PortfolioTable.version + 1, "updated_at": statement.excluded.updated_at},
+            ).returning(PortfolioTable.id)
+            portfolio_id = await session.scalar(statement)
+
+            rows = list({row["symbol"]: row for row in (position_row(portfolio_id, position) for position in positions)}.values()) # Last one wins for duplicate symbols
+            for i in range(0, len(rows), UPSERT_BATCH_SIZE):
+                statement = insert(PositionTable)
+                statement = statement.on_conflict_do_update(
+                    index_elements=["portfolio_id", "symbol"],
+                    set_={field: statement.excluded[field] for field in position_fields if field != "symbol"},
+                )
+                await session.execute(statement, rows[i:i + UPSERT_BATCH_SIZE])
+
+            if replace:
+                await session.execute(delete(PositionTable).where(PositionTable.portfolio_id == portfolio_id,
+                    PositionTable.symbol.not_in([row["symbol"] for row in rows])))
+        return len(rows)
+
+    async def delete_positions(self, user_id: int, symbols: list, name: str = "default") -> int:
+        """ Removes positions from a user's portfolio. Returns the number removed. """
+        async with self.session_maker() as session, session.begin():
+            portfolio_id = await session.scalar(select(PortfolioTable.id).where(PortfolioTable.user_id == user_id, PortfolioTable.name == name))
+            if portfolio_id is None:
+                return 0
+            result = await session.execute(delete(PositionTable).where(PositionTable.portfolio_id == portfolio_id,
+                PositionTable.symbol.in_([symbol.upper() for symbol in symbols])))
+            await session.execute(update(PortfolioTable).where(PortfolioTable.id == portfolio_id)
+                .values(version=PortfolioTable.version + 1, updated_at=datetime.now(timezone.utc)))
+            return result.rowcount
+
+def message_row(conversation_id: str, message: dict) -> dict:
+    return {
+        "conversation_id": conversation_id,
+        "role": message["role"],
+        "content": message.get("content") or "",
+        "name": message.get("name"),
+        "tool_call_id": message.get("tool_call_id"),
+    }
+
+def message_from_row(row) -> dict:
+    """ Back to an OpenAI formatted message, as the conversation store holds them. """
+    message = {"role": row.role, "content": row.content}
+    if row.name:
+        message["name"] = row.name
+    if row.tool_call_id:
+        message["tool_call_id"] = row.tool_call_id
+    return message
+
+class ConversationRepository:
+    def __init__(self, session_maker=async_session_maker):
+        self.session_maker = session_maker
+
+    async def get_message_count(self, conversation_id: str) -> int:
+        """ Returns the number of stored messages, or None if the conversation hasn't been stored. """
+        async with self.session_maker() as session:
+            return await session.scalar(select(ConversationTable.message_count).where(ConversationTable.id == conversation_id))
+
+    async def get_owner(self, conversation_id: str) -> int:
+        """ Returns the id of the user the conversation belongs to, or None if it was started signed out (or isn't stored). """
+        async with self.session_maker() as session:
+            return await session.scalar(select(ConversationTable.user_id).where(ConversationTable.id == conversation_id))
+
+    async def get_recent_messages(self, conversation_id: str, limit: int):
+        """ Retrieves the newest messages of a conversation, e.g. to rebuild it after a restart or on another replica.
+
+        Returns:
+        - (list) up to limit messages, oldest first.
+        - (int) the total number of stored messages. """
+
+        async with self.session_maker() as session:
+            message_count = await session.scalar(select(ConversationTable.message_count).where(ConversationTable.id == conversation_id))
+            if not message_count:
+                return [], 0
+            rows = (await session.execute(select(ConversationMessageTable)
+                .where(ConversationMessageTable.conversation_id == conversation_id)
+                .order_by(ConversationMessageTable.id.desc()).limit(limit))).scalars().all()
+            return [message_from_row(row) for row in reversed(rows)], message_count
+
+    async def add_messages(self, conversation_id: str, messages: list, user_id: int = None) -> int:
+        """ Appends messages to a conversation (creating it if needed) in one round of inserts.
+
+        Returns:
+        - (int) the total number of stored messages afterwards. """
+
+        now = datetime.now(timezone.utc)
+        first_question = next((message.get("content") for message in messages if message["role"] == "user"), None)
+        async with self.session_maker() as session, session.begin():
+            statement = insert(ConversationTable).values(id=conversation_id, user_id=user_id, title=(first_question or "")[:200] or None,
+                message_count=len(messages), created_at=now, updated_at=now)
+            statement = statement.on_conflict_do_update(
+                index_elements=["id"],
+                set_={"message_count": ConversationTable.message_count + len(messages), "updated_at": now,
+                      "user_id": func.coalesce(ConversationTable.user_id, statement.excluded.user_id)},
+            ).returning(ConversationTable.message_count)
+            message_count = await session.scalar(statement)
+            if messages:
+                await session.execute(insert(ConversationMessageTable), [message_row(conversation_id, message) for message in messages])
+            return message_count
+
+    async def get_history(self, conversation_id: str, before: int = None, limit: int = 50) -> dict:
+        """ Reads a page of a conversation's history, newest first.
+
+        Parameters:
+        - conversation_id (str)
+        - before (int): the cursor from the previous page, or None for the newest messages.
+        - limit (int): messages per page.
+
+        Returns:
+        - (dict) {messages: [{id, role, content, name, created_at}], next_cursor: pass as before for the next page, or
+          None at the start of the conversation} """
+
+        limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+        query = select(ConversationMessageTable).where(ConversationMessageTable.conversation_id == conversation_id)
+        if before is not None:
+            query = query.where(ConversationMessageTable.id < before)
+        async with self.session_maker() as session:
+            rows = (await session.execute(query.order_by(ConversationMessageTable.id.desc()).limit(limit + 1))).scalars().all()
+
+        messages = [{"id": row.id, **message_from_row(row), "created_at": row.created_at.isoformat()} for row in rows[:limit]]
+        return {"messages": messages, "next_cursor": messages[-1]["id"] if len(rows) > limit else None}
+
+    async def list_conversations(self, user_id: int, before: str = None, limit: int = 20) -> dict:
+        """ Lists a user's conversations, most recently updated first, a page at a time.
+
+        Returns:
+        - (dict) {conversations: [{id, title, message_count, updated_at}], next_cursor} """
+
+        limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+        query = select(ConversationTable).where(ConversationTable.user_id == user_id)
+        if before:
+            query = query.where(ConversationTable.updated_at < datetime.fromisoformat(before))
+        async with self.session_maker() as session:
+            rows = (await session.execute(query.order_by(ConversationTable.updated_at.desc()).limit(limit + 1))).scalars().all()
+
+        conversations = [{"id": row.id, "title": row.title, "message_count": row.message_count, "updated_at": row.updated_at.isoformat()} for row in rows[:limit]]
+        return {"conversations": conversations, "next_cursor": conversations[-1]["updated_at"] if len(rows) > limit else None}
+
+    async def delete_conversation(self, conversation_id: str):
+        async with self.session_maker() as session, session.begin():
+            await session.execute(delete(ConversationMessageTable).where(ConversationMessageTable.conversation_id == conversation_id))
+            await session.execute(delete(ConversationTable).where(ConversationTable.id == conversation_id))
+
+portfolio_repository = PortfolioRepository()
+conversation_repository = ConversationRepository()
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a portfolio file into the database for a user.")
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--file", required=True, help="A portfolio JSON file, e.g. ./portfolios/portfolio1.json")
+    parser.add_argument("--name", default="default")
+    parser.add_argument("--replace", action="store_true", help="Remove positions that aren't in the file.")
+    args = parser.parse_args()
+
+    with open(args.file, "r") as file:
+        data = json.load(file)
+
+    async def run():
+        await init_database()
+        try:
+            return await portfolio_repository.upsert_positions(args.user_id, data.get("portfolio") or [], data.get("currency") or "USD", args.name, args.replace)
+        finally:
+            await close_database()
+
+    print(f"Imported {asyncio.run(run())} positions for user {args.user_id}")
+
+if __name__ == "__main__":
+    main()
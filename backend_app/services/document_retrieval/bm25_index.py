@@ -0,0 +1,171 @@
+""" Local BM25 (keyword) index over the filing chunks, used alongside the Chroma vector search in retrieve_filings.
+
+Dense embeddings are good at meaning but often miss exact figures and line items ("diluted EPS", "Item 7A"), which
+keyword scoring handles well. The index is built during ingestion and persisted next to the vectordb, partitioned by
+ticker and filing date (bm25/<ticker>/<date>_<filename>.json), so a ticker or date scoped search only loads and
+scores that ticker's filings rather than the whole corpus.
+
+Each partition stores its chunk ids, chunk lengths and a postings list of term to [[chunk index, term frequency]].
+Corpus statistics (document count, average length, document frequencies) are worked out across whichever partitions
+a search covers, so scores are exact BM25 for that scope. """
+
+from collections import Counter, defaultdict
+import json
+import math
+import os
+import re
+import threading
+
+K1 = 1.5
+B = 0.75
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+TICKER_PATTERN = re.compile(r"^[a-z0-9][a-z0-9.\-]{0,9}$") # Tickers name partition directories, so no '/', '.' or '..'
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "in", "is", "it", "its", "of", "on",
+    "or", "that", "the", "this", "to", "was", "were", "which", "with",
+}
+
+def tokenise(text: str) -> list:
+    """ Lowercases and splits text into terms, keeping numbers (including decimals) and item numbers like 7a. """
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+class BM25Index:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.partitions = {} # Path to (mtime, partition data), so partitions are only read from disk when they change
+        self.lock = threading.Lock()
+
+    def partition_path(self, metadata: dict) -> str:
+        ticker = metadata["ticker"].lower()
+        stem = os.path.splitext(metadata["filename"])[0]
+        return os.path.join(self.directory, ticker, f"{metadata['date_yyyymmdd']}_{stem}.json")
+
+    def has_filing(self, metadata: dict) -> bool:
+        return os.path.exists(self.partition_path(metadata))
+
+    def add_filing(self, metadata: dict, ids: list, documents: list):
+        """ Builds and writes the partition for one filing, replacing any previous version.
+
+        Parameters:
+        - metadata (dict): the filing's filename, ticker and date_yyyymmdd (see ingest.parse_filing_metadata).
+        - ids (list): the chunk ids, as stored in Chroma.
+        - documents (list): the chunk texts, in the same order as ids. """
+
+        postings = defaultdict(list)
+        lengths = []
+        for index, document in enumerate(documents):
+            terms = tokenise(document)
+            lengths.append(len(terms))
+            for term, frequency in Counter(terms).items():
+                postings[term].append([index, frequency])
+
+        path = self.partition_path(metadata)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as partition_file:
+            json.dump({"filename": metadata["filename"], "ids": ids, "lengths": lengths, "postings": postings}, partition_file)
+        os.replace(temporary_path, path)
+
+    def remove_filing(self, metadata: dict):
+        path = self.partition_path(metadata)
+        if os.path.exists(path):
+            os.remove(path)
+        with self.lock:
+            self.partitions.pop(path, None)
+
+    def load_partition(self, path: str) -> dict:
+        mtime = os.path.getmtime(path)
+        with self.lock:
+            cached = self.partitions.get(path)
+            if cached and cached[0] == mtime:
+                return cached[1]
+
+        with open(path, "r") as partition_file:
+            partition = json.load(partition_file)
+        with self.lock:
+            self.partitions[path] = (mtime, partition)
+        return partition
+
+    def partition_paths(self, ticker: str = None, filing_date: str = None) -> list:
+        """ The partition files for a ticker (or every ticker), optionally only those whose date starts with
+        filing_date, e.g. '2023' or '20231231'. An invalid ticker has none. """
+        if not os.path.exists(self.directory):
+            return []
+        if ticker and not TICKER_PATTERN.match(ticker.lower()):
+            return []
+
+        tickers = [ticker.lower()] if ticker else os.listdir(self.directory)
+        paths = []
+        for partition_ticker in tickers:
+            ticker_directory = os.path.join(self.directory, partition_ticker)
+            if not os.path.isdir(ticker_directory):
+                continue
+            for filename in os.listdir(ticker_directory):
+                if not filename.endswith(".json"):
+                    continue
+                if filing_date and not filename.startswith(filing_date):
+                    continue
+                paths.append(os.path.join(ticker_directory, filename))
+        return paths
+
+    def select_partitions(self, ticker: str = None, filing_date: str = None) -> list:
+        """ Loads the partitions for a ticker (or every ticker), optionally only those whose date starts with
+        filing_date. """
+        return [self.load_partition(path) for path in self.partition_paths(ticker, filing_date)]
+
+    def filing_dates(self, ticker: str = None, filing_date: str = None) -> list:
+        """ The dates (YYYYMMDD) of the filings indexed for a ticker whose date starts with filing_date, e.g. to
+        filter the vector search to the same filings. """
+        return sorted({os.path.basename(path).split("_", 1)[0] for path in self.partition_paths(ticker, filing_date)})
+
+    def search(self, query: str, ticker: str = None, filing_date: str = None, top_k: int = 20) -> list:
+        """ Scores the chunks in scope against the query.
+
+        Returns:
+        - (list) (chunk id, score) tuples, best first. """
+
+        terms = set(tokenise(query))
+        partitions = self.select_partitions(ticker, filing_date)
+        if not terms or not partitions:
+            return []
+
+        document_count = sum(len(partition["ids"]) for partition in partitions)
+        average_length = sum(sum(partition["lengths"]) for partition in partitions) / max(document_count, 1)
+
+        document_frequencies = {
+            term: sum(len(partition["postings"].get(term, [])) for partition in partitions)
+            for term in terms
+        }
+
+        scores = []
+        for partition in partitions:
+            partition_scores = defaultdict(float)
+            for term in terms:
+                postings = partition["postings"].get(term)
+                if not postings:
+                    continue
+                frequency = document_frequencies[term]
+                idf = math.log(1 + (document_count - frequency + 0.5) / (frequency + 0.5))
+                for index, term_frequency in postings:
+                    length_norm = K1 * (1 - B + B * partition["lengths"][index] / average_length)
+                    partition_scores[index] += idf * term_frequency * (K1 + 1) / (term_frequency + length_norm)
+            scores.extend((partition["ids"][index], score) for index, score in partition_scores.items())
+
+        scores.sort(key=lambda item: item[1], reverse=True)
+        return scores[:top_k]
+
+def reciprocal_rank_fusion(*rankings, k: int = 60) -> list:
+    """ Combines several rankings of ids into one. Each id scores 1 / (k + rank) in every ranking it appears in, so
+    ids ranked well by both the dense and the keyword search come out on top.
+
+    Parameters:
+    - rankings (list): lists of ids, best first.
+
+    Returns:
+    - (list) ids, best first. """
+
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking):
+            scores[item_id] += 1 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
@@ -0,0 +1,192 @@
+""" Packs retrieved filing chunks into the context passed back to the model by retrieve_filings.
+
+Chunks are fixed 500 character slices, so the raw results are often overlapping or near-duplicate boilerplate, and
+every wasted token adds cost and latency to the second completion. Packing:
+1. drops near-identical chunks (word shingle overlap),
+2. picks a relevant but diverse set with maximal marginal relevance (MMR),
+3. merges chunks that are next to each other in the same filing back into one passage,
+4. trims the result to a token budget,
+5. labels each passage with a compact source (ticker, date, chunk ids).
+
+Counts of tokens before and after packing are kept so we can see how much each call saves. """
+
+from backend_app.services.chatbot.token_utils import estimate_tokens
+import numpy as np
+import os
+import threading
+
+TOKEN_BUDGET = int(os.getenv("FILINGS_CONTEXT_TOKEN_BUDGET", 1200))
+MAX_CHUNKS = int(os.getenv("FILINGS_CONTEXT_MAX_CHUNKS", 5))
+MMR_LAMBDA = 0.7 # 1.0 is pure relevance, 0.0 is pure diversity
+DUPLICATE_THRESHOLD = 0.8 # Shingle Jaccard similarity above which two chunks count as duplicates
+SHINGLE_SIZE = 5
+
+def shingles(text: str) -> set:
+    words = text.lower().split()
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def jaccard(first: set, second: set) -> float:
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+def parse_chunk_id(chunk_id: str):
+    """ Splits an id like tsla_20231231.pdf_doc_12 into ('tsla_20231231.pdf', 12). """
+    filename, _, index = chunk_id.rpartition("_doc_")
+    return filename, int(index) if index.isdigit() else -1
+
+def normalise_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+class ContextPacker:
+    def __init__(self, token_budget: int = TOKEN_BUDGET, max_chunks: int = MAX_CHUNKS, mmr_lambda: float = MMR_LAMBDA):
+        self.token_budget = token_budget
+        self.max_chunks = max_chunks
+        self.mmr_lambda = mmr_lambda
+
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.duplicates_dropped = 0
+        self.chunks_merged = 0
+
+    def pack(self, query_embedding, candidates: list) -> str:
+        """ Packs candidate chunks into a single labelled context string.
+
+        Parameters:
+        - query_embedding: the embedding of the retrieval query.
+        - candidates (list): dicts with 'id', 'document', 'metadata' and 'embedding', best ranked first.
+
+        Returns:
+        - (str) the packed context. """
+
+        if not candidates:
+            return ""
+
+        tokens_before = sum(estimate_tokens(candidate["document"]) for candidate in candidates)
+
+        unique = self.deduplicate(candidates)
+        selected = self.select_mmr(query_embedding, unique)
+        passages = self.merge_adjacent(selected)
+        context = self.trim_to_budget(passages)
+
+        tokens_after = estimate_tokens(context)
+        with self.lock:
+            self.calls += 1
+            self.tokens_before += tokens_before
+            self.tokens_after += tokens_after
+            self.duplicates_dropped += len(candidates) - len(unique)
+            self.chunks_merged += len(selected) - len(passages)
+        print(f"Context packing: {tokens_before} -> {tokens_after} tokens ({len(candidates)} chunks in, {len(passages)} passages out)")
+        return context
+
+    def deduplicate(self, candidates: list) -> list:
+        """ Drops chunks that are near-identical to a better ranked chunk. """
+        unique, unique_shingles = [], []
+        for candidate in candidates:
+            candidate_shingles = shingles(candidate["document"])
+            if any(jaccard(candidate_shingles, kept) >= DUPLICATE_THRESHOLD for kept in unique_shingles):
+                continue
+            unique.append(candidate)
+            unique_shingles.append(candidate_shingles)
+        return unique
+
+    def select_mmr(self, query_embedding, candidates: list) -> list:
+        """ Greedily picks chunks that are relevant to the query but not too similar to the chunks already picked. Falls
+        back to the given ranking for any candidates without an embedding. """
+        if any(candidate.get("embedding") is None for candidate in candidates):
+            return candidates[:self.max_chunks]
+
+        embeddings = normalise_rows(np.asarray([candidate["embedding"] for candidate in candidates], dtype=np.float32))
+        query = normalise_rows(np.asarray(query_embedding, dtype=np.float32))
+        relevance = embeddings @ query
+        similarity = embeddings @ embeddings.T
+
+        selected = []
+        remaining = list(range(len(candidates)))
+        while remaining and len(selected) < self.max_chunks:
+            if selected:
+                redundancy = similarity[np.ix_(remaining, selected)].max(axis=1)
+            else:
+                redundancy = np.zeros(len(remaining))
+            scores = self.mmr_lambda * relevance[remaining] - (1 - self.mmr_lambda) * redundancy
+            best = remaining[int(np.argmax(scores))]
+            selected.append(best)
+            remaining.remove(best)
+        return [candidates[index] for index in selected]
+
+    def merge_adjacent(self, selected: list) -> list:
+        """ Joins chunks that follow on from each other in the same filing, keeping the order of the best ranked chunk
+        in each run.
+
+        Returns:
+        - (list) passages, as dicts with 'metadata', 'chunk_indexes' and 'text'. """
+
+        by_filing = {}
+        for rank, candidate in enumerate(selected):
+            filename, index = parse_chunk_id(candidate["id"])
+            by_filing.setdefault(filename, []).append((index, rank, candidate))
+
+        passages = []
+        for chunks in by_filing.values():
+            chunks.sort(key=lambda chunk: chunk[0])
+            run = [chunks[0]]
+            for chunk in chunks[1:]:
+                if chunk[0] >= 0 and chunk[0] == run[-1][0] + 1:
+                    run.append(chunk)
+                else:
+                    passages.append(run)
+                    run = [chunk]
+            passages.append(run)
+
+        passages.sort(key=lambda run: min(chunk[1] for chunk in run))
+        return [
+            {
+                "metadata": run[0][2].get("metadata") or {},
+                "chunk_indexes": [chunk[0] for chunk in run],
+                "text": "".join(chunk[2]["document"] for chunk in run),
+            }
+            for run in passages
+        ]
+
+    def label(self, passage: dict) -> str:
+        metadata = passage["metadata"]
+        date = metadata.get("date_yyyymmdd", "")
+        if len(date) == 8:
+            date = f"{date[:4]}-{date[4:6]}-{date[6:]}"
+        indexes = passage["chunk_indexes"]
+        chunk_range = f"{indexes[0]}-{indexes[-1]}" if len(indexes) > 1 else f"{indexes[0]}"
+        return f"[{metadata.get('ticker', '').upper()} {date} #{chunk_range}]"
+
+    def trim_to_budget(self, passages: list) -> str:
+        """ Adds labelled passages in order until the token budget is used, cutting the last one short if needed. """
+        blocks = []
+        remaining = self.token_budget
+        for passage in passages:
+            block = f"{self.label(passage)} {' '.join(passage['text'].split())}"
+            block_tokens = estimate_tokens(block)
+            if block_tokens > remaining:
+                if remaining > 50: # Only worth including part of a passage if a useful amount fits
+                    blocks.append(block[:remaining * 4].rsplit(" ", 1)[0] + " ...")
+                break
+            blocks.append(block)
+            remaining -= block_tokens
+        return "\n\n".join(blocks)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "tokens_before": self.tokens_before,
+                "tokens_after": self.tokens_after,
+                "tokens_saved": self.tokens_before - self.tokens_after,
+                "average_tokens_saved": (self.tokens_before - self.tokens_after) / self.calls if self.calls else 0.0,
+                "duplicates_dropped": self.duplicates_dropped,
+                "chunks_merged": self.chunks_merged,
+            }
+
+context_packer = ContextPacker()
@@ -0,0 +1,154 @@
+""" Embedding service for retrieval queries.
+
+- The model is loaded and warmed up when the app starts (see app.py), so the first retrieve_filing call after a deploy
+  doesn't pay for the model load.
+- Encoding runs on a worker thread, off the event loop, so other streams carry on while a query is embedded.
+- Queries that arrive within a few milliseconds of each other are encoded together in one forward pass.
+- Recent query embeddings are kept in an LRU cache keyed by the normalised query text. """
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+import threading
+
+MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "all-MiniLM-L6-v2")
+BATCH_WINDOW_SECONDS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", 5)) / 1000
+MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", 64))
+CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 2048))
+WORKERS = int(os.getenv("EMBEDDING_WORKERS", 1)) # torch already uses several threads within each encode
+
+def normalise_query(query: str) -> str:
+    """ Lowercases and collapses whitespace. The model is uncased, so this doesn't change the embedding. """
+    return " ".join(query.lower().split())
+
+class EmbeddingService:
+    def __init__(self, model_name: str = MODEL_NAME, batch_window_seconds: float = BATCH_WINDOW_SECONDS,
+                 max_batch_size: int = MAX_BATCH_SIZE, cache_size: int = CACHE_SIZE, workers: int = WORKERS):
+        self.model_name = model_name
+        self.batch_window_seconds = batch_window_seconds
+        self.max_batch_size = max_batch_size
+        self.cache_size = cache_size
+
+        self.model = None
+        self.model_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embedding")
+
+        self.cache = OrderedDict() # Normalised query to embedding, least recently used first
+        self.pending = {} # Normalised query to the future its caller is waiting on, for the batch being collected
+        self.flush_handle = None
+        self.batch_tasks = set() # Batches being encoded, referenced so they aren't garbage collected mid-flight
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.batches = 0
+        self.batched_queries = 0
+
+    def get_model(self):
+        """ Returns the SentenceTransformer, loading it if it isn't already. Blocking, so call from a worker thread (or
+        from sync code such as the ingestion pipeline). """
+        if self.model is None:
+            with self.model_lock:
+                if self.model is None:
+                    from sentence_transformers import SentenceTransformer
+
+                    print(f"Loading embedding model {self.model_name} ...")
+                    model = SentenceTransformer(self.model_name, device="cpu")
+                    model.encode(["warm up"], show_progress_bar=False) # The first forward pass is much slower than the rest
+                    self.model = model
+        return self.model
+
+    async def start(self):
+        """ Loads and warms the model on the worker pool. Called on app startup. """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.get_model)
+
+    def encode(self, texts: list):
+        """ Encodes a list of texts in a single forward pass. Blocking. """
+        return self.get_model().encode(texts, batch_size=len(texts), show_progress_bar=False)
+
+    async def encode_query(self, query: str):
+        """ Returns the embedding for a query, from the cache if possible. Otherwise it's added to the current batch,
+        which is encoded once the batch window closes or the batch is full.
+
+        Parameters:
+        - query (str): the query text.
+
+        Returns:
+        - (numpy.ndarray) the query embedding. """
+
+        key = normalise_query(query)
+
+        if key in self.cache:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.cache_misses += 1
+
+        # Someone else is already waiting on this exact query in the current batch
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending[key] = future
+
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_window_seconds, self.flush)
+
+        return await asyncio.shield(future)
+
+    def flush(self):
+        """ Sends the current batch off to be encoded. """
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        batch = self.pending
+        self.pending = {}
+        if batch:
+            task = asyncio.get_running_loop().create_task(self.encode_batch(batch))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_done)
+
+    def batch_done(self, task: asyncio.Task):
+        self.batch_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Embedding batch failed: {task.exception()}")
+
+    async def encode_batch(self, batch: dict):
+        loop = asyncio.get_running_loop()
+        keys = list(batch)
+        self.batches += 1
+        self.batched_queries += len(keys)
+
+        try:
+            embeddings = await loop.run_in_executor(self.executor, self.encode, keys)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for key, embedding in zip(keys, embeddings):
+            self.cache[key] = embedding
+            self.cache.move_to_end(key)
+            if not batch[key].done():
+                batch[key].set_result(embedding)
+
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_hit_rate": self.cache_hits / lookups if lookups else 0.0,
+            "batches": self.batches,
+            "average_batch_size": self.batched_queries / self.batches if self.batches else 0.0,
+        }
+
+embedding_service = EmbeddingService()
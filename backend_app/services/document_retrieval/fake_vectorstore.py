@@ -0,0 +1,27 @@
+""" A stand-in for retrieve_filings, used for benchmarks and offline runs so we don't need Chroma, the embedding model or
+any ingested filings. Select it by setting VECTORSTORE_BACKEND=fake.
+
+Returns a deterministic, labelled context in the same shape as the packed context from the real retrieval, sized to
+roughly the real token budget. An optional latency (FAKE_VECTORSTORE_LATENCY_SECONDS) simulates the search. """
+
+import backend_app.services.chatbot.functions as functions
+from backend_app.services.document_retrieval.context_packer import TOKEN_BUDGET
+import asyncio
+import json
+import os
+
+LATENCY_SECONDS = float(os.getenv("FAKE_VECTORSTORE_LATENCY_SECONDS", 0.05))
+PASSAGES = 3
+
+async def retrieve_filings(arguments):
+    arguments = json.loads(arguments)
+    ticker = arguments.get("ticker", "").upper()
+    keywords = arguments.get("keywords") or []
+    filing_date = arguments.get("filing_date") or "20231231"
+    await asyncio.sleep(LATENCY_SECONDS)
+
+    # Each passage is about a third of the token budget, at roughly 4 characters a token
+    sentence = f"{ticker} reported on {', '.join(keywords) or 'its results'} for the period. "
+    passage_text = (sentence * (TOKEN_BUDGET * 4 // PASSAGES // len(sentence) + 1))[:TOKEN_BUDGET * 4 // PASSAGES]
+    passages = [f"[{ticker} {filing_date} #{index}] {passage_text}" for index in range(PASSAGES)]
+    return functions.create_json_response(response_model_content="\n\n".join(passages))
@@ -0,0 +1,231 @@
+""" Filings ingestion pipeline for the vectorstore. Run from the repository root (it's imported as backend_app...) with:
+
+    python -m backend_app.services.document_retrieval.ingest --filings-dir ./backend_app/services/document_retrieval/filings/
+
+- A manifest of content hashes (ingest_manifest.json, next to the vectordb) records which PDFs have been ingested, so
+  only new or changed filings are processed and a restart never redoes finished work. Filings removed from the
+  directory have their chunks deleted.
+- Text extraction runs in a process pool, as fitz is CPU bound.
+- Chunks from several filings are embedded together in large batches and written with bulk upserts.
+- The BM25 keyword index (bm25_index.py) is built from the same chunks, one partition per filing.
+
+Throughput (pages/s, chunks/s) is reported at the end of each run. """
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from backend_app.services.document_retrieval.bm25_index import BM25Index
+import argparse
+import fitz
+import hashlib
+import json
+import os
+import time
+
+CHUNK_SIZE = 500 # Characters per chunk
+DEFAULT_BATCH_SIZE = 1024 # Chunks embedded and written per batch
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+MANIFEST_FILENAME = "ingest_manifest.json"
+
+def parse_filing_metadata(filename: str) -> dict:
+    """ Pulls the ticker and filing date out of the filename.
+
+    Given filename tsla_20231231.pdf, takes the first 4 letters as the ticker [i.e., tsla] and skips the first 5 letters
+    and then takes all letters except the final 4 as the date [i.e., 20231231]. """
+    return {"filename": filename, "ticker": filename[:4], "date_yyyymmdd": filename[5:-4]}
+
+def hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def extract_filing(pdf_path: str) -> dict:
+    """ Extracts and chunks a single PDF. Runs in a worker process, so it only uses fitz and returns plain data.
+
+    Returns:
+    - (dict) the filename, page count and list of text chunks. """
+
+    with fitz.open(pdf_path) as pdf:
+        pages = len(pdf)
+        text = "".join(page.get_text() for page in pdf)
+
+    return {
+        "filename": os.path.basename(pdf_path),
+        "pages": pages,
+        "chunks": [text[i:i + CHUNK_SIZE] for i in range(0, len(text), CHUNK_SIZE)],
+    }
+
+class FilingsIngestor:
+    def __init__(self, filings_directory: str, persistent_directory: str = None, workers: int = DEFAULT_WORKERS, batch_size: int = DEFAULT_BATCH_SIZE):
+        import backend_app.services.document_retrieval.vectorstore as vectorstore
+
+        self.vectorstore = vectorstore
+        self.filings_directory = filings_directory
+        self.persistent_directory = persistent_directory or vectorstore.persistent_directory
+        self.workers = workers
+        self.batch_size = batch_size
+        self.manifest_path = os.path.join(self.persistent_directory, MANIFEST_FILENAME)
+        self.manifest = self.load_manifest()
+        self.bm25_index = BM25Index(os.path.join(self.persistent_directory, "bm25"))
+
+        self.pending = [] # Extracted filings waiting to be embedded and written
+        self.pending_chunks = 0
+        self.pages = 0
+        self.chunks = 0
+
+    def load_manifest(self) -> dict:
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as manifest_file:
+                return json.load(manifest_file)
+        return {}
+
+    def save_manifest(self):
+        os.makedirs(self.persistent_directory, exist_ok=True)
+        temporary_path = self.manifest_path + ".tmp"
+        with open(temporary_path, "w") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2)
+        os.replace(temporary_path, self.manifest_path)
+
+    def plan(self, force: bool = False):
+        """ Works out which filings need ingesting, and which have been removed from the directory.
+
+        Returns:
+        - (list) (filename, path, hash) for each new or changed filing
+        - (list) filenames in the manifest that no longer exist
+        - (int) the number of unchanged filings skipped """
+
+        to_ingest = []
+        present = set()
+        for filename in sorted(os.listdir(self.filings_directory)):
+            if not filename.endswith(".pdf"):
+                continue
+            present.add(filename)
+            path = os.path.join(self.filings_directory, filename)
+            file_hash = hash_file(path)
+            changed = self.manifest.get(filename, {}).get("sha256") != file_hash
+            # Filings ingested before the BM25 index existed need their partition building too
+            if force or changed or not self.bm25_index.has_filing(parse_filing_metadata(filename)):
+                to_ingest.append((filename, path, file_hash))
+
+        removed = [filename for filename in self.manifest if filename not in present]
+        return to_ingest, removed, len(present) - len(to_ingest)
+
+    def run(self, force: bool = False) -> dict:
+        """ Ingests every new or changed filing in the directory.
+
+        Parameters:
+        - force (bool): re-ingest everything, even if it's unchanged.
+
+        Returns:
+        - (dict) run statistics, including throughput. """
+
+        self.vectorstore.initialise()
+        collection = self.vectorstore.collection
+        start_time = time.perf_counter()
+
+        to_ingest, removed, skipped = self.plan(force)
+        for filename in removed:
+            print(f"Removing chunks for deleted filing {filename}")
+            collection.delete(where={"filename": filename})
+            self.bm25_index.remove_filing(parse_filing_metadata(filename))
+            del self.manifest[filename]
+        if removed:
+            self.save_manifest()
+
+        print(f"Ingesting {len(to_ingest)} filings ({skipped} unchanged, {len(removed)} removed)")
+
+        hashes = {filename: file_hash for filename, _, file_hash in to_ingest}
+        if to_ingest:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                futures = {pool.submit(extract_filing, path): filename for filename, path, _ in to_ingest}
+                for future in as_completed(futures):
+                    filename = futures[future]
+                    try:
+                        filing = future.result()
+                    except Exception as e:
+                        print(f"Error extracting {filename}: {e}")
+                        continue
+
+                    filing["sha256"] = hashes[filename]
+                    self.pending.append(filing)
+                    self.pending_chunks += len(filing["chunks"])
+                    if self.pending_chunks >= self.batch_size:
+                        self.flush()
+            self.flush()
+
+        elapsed = time.perf_counter() - start_time
+        stats = {
+            "filings": len(to_ingest),
+            "skipped": skipped,
+            "removed": len(removed),
+            "pages": self.pages,
+            "chunks": self.chunks,
+            "seconds": round(elapsed, 2),
+            "pages_per_second": round(self.pages / elapsed, 1) if elapsed else 0.0,
+            "chunks_per_second": round(self.chunks / elapsed, 1) if elapsed else 0.0,
+        }
+        print(f"Ingestion complete: {stats}")
+        return stats
+
+    def flush(self):
+        """ Embeds and writes all pending filings, then records them in the manifest. """
+        if not self.pending:
+            return
+
+        collection = self.vectorstore.collection
+        documents, ids, metadatas = [], [], []
+        for filing in self.pending:
+            filename = filing["filename"]
+            # Remove any chunks from a previous version of this filing, it may have had more chunks than this one
+            if filename in self.manifest:
+                collection.delete(where={"filename": filename})
+            metadata = parse_filing_metadata(filename)
+            filing_ids = [f"{filename}_doc_{idx}" for idx in range(len(filing["chunks"]))]  # Unique ID for each document
+            documents.extend(filing["chunks"])
+            ids.extend(filing_ids)
+            metadatas.extend([metadata] * len(filing_ids))
+            self.bm25_index.add_filing(metadata, filing_ids, filing["chunks"])
+
+        print(f"Generating embeddings for {len(documents)} chunks from {len(self.pending)} filings")
+        embeddings = self.vectorstore.embedding_model.encode(documents, batch_size=64, show_progress_bar=False)
+
+        # Chroma limits how much can be written in a single call
+        max_batch_size = self.vectorstore.client.get_max_batch_size()
+        for i in range(0, len(documents), max_batch_size):
+            collection.upsert(
+                documents=documents[i:i + max_batch_size],
+                ids=ids[i:i + max_batch_size],
+                embeddings=[embedding.tolist() for embedding in embeddings[i:i + max_batch_size]],
+                metadatas=metadatas[i:i + max_batch_size]
+            )
+
+        # Only recorded once the chunks are written, so an interrupted run picks these filings up again
+        for filing in self.pending:
+            self.manifest[filing["filename"]] = {
+                "sha256": filing["sha256"],
+                "pages": filing["pages"],
+                "chunks": len(filing["chunks"]),
+                "ingested_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+            self.pages += filing["pages"]
+            self.chunks += len(filing["chunks"])
+        self.save_manifest()
+
+        self.pending = []
+        self.pending_chunks = 0
+
+def ingest_filings(filings_directory: str, force: bool = False, workers: int = DEFAULT_WORKERS, batch_size: int = DEFAULT_BATCH_SIZE) -> dict:
+    return FilingsIngestor(filings_directory, workers=workers, batch_size=batch_size).run(force)
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest regulatory filings (PDFs) into the vectorstore.")
+    parser.add_argument("--filings-dir", default="./filings/", help="Directory containing the filing PDFs.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Number of extraction processes.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of chunks embedded and written per batch.")
+    parser.add_argument("--force", action="store_true", help="Re-ingest every filing, even if it's unchanged.")
+    args = parser.parse_args()
+
+    ingest_filings(args.filings_dir, force=args.force, workers=args.workers, batch_size=args.batch_size)
+
+if __name__ == "__main__":
+    main()
@@ -2,30 +2,41 @@
 import os 
 import fitz
 import json
+import asyncio
+import threading
 import backend_app.services.chatbot.functions as functions
+from backend_app.services.document_retrieval.embedding_service import embedding_service
+from backend_app.services.document_retrieval.bm25_index import BM25Index, reciprocal_rank_fusion
+from backend_app.services.document_retrieval.context_packer import context_packer
+from backend_app.services.monitoring.metrics import timed_stage
 
 client = None
 collection = None
 embedding_model = None
 filings_directory = "./filings/"
 persistent_directory = "./vectordb/"
+initialise_lock = threading.Lock() # initialise() can be called from several worker threads at once
+bm25_index = BM25Index(os.path.join(persistent_directory, "bm25")) # Keyword index, built by ingest.py
+
+DENSE_CANDIDATES = 20 # Candidates taken from each of the vector and keyword searches before fusion
+PACKING_CANDIDATES = 12 # Best fused chunks handed to the context packer, which picks and trims the final context
 
 def initialise():
     print(f"Initialising vectordb module ...")
     import chromadb
-    from sentence_transformers import SentenceTransformer
 
     global client, collection, embedding_model
 
-    if embedding_model is None: 
-        embedding_model = SentenceTransformer('all-MiniLM-L6-v2', device='cpu')
-    
-    if not os.path.exists(persistent_directory):
-        os.makedirs(persistent_directory)
+    with initialise_lock:
+        if embedding_model is None: 
+            embedding_model = embedding_service.get_model() # Shared with query encoding, normally already loaded at startup
+        
+        if not os.path.exists(persistent_directory):
+            os.makedirs(persistent_directory)
 
-    if client is None:
-        client = chromadb.PersistentClient(settings=chromadb.Settings(persist_directory=persistent_directory))
-        collection = client.get_or_create_collection(name="filings")
+        if client is None:
+            client = chromadb.PersistentClient(settings=chromadb.Settings(persist_directory=persistent_directory))
+            collection = client.get_or_create_collection(name="filings")
 
     if collection is None: 
         print("Failed to create or retrieve a collection")
@@ -33,9 +44,9 @@ def initialise():
 def check_existing_data():
     initialise()
 
-    existing_ids = collection.get()["ids"]
-    if existing_ids:
-        print("Existing data found in collection:", existing_ids)
+    existing_count = collection.count() # Avoids loading every id just to check if the collection is empty
+    if existing_count:
+        print(f"Existing data found in collection: {existing_count} chunks")
         return True  # Return True if data exists
     else:
         print("No existing data found in collection. New data will be added.")
@@ -57,42 +68,11 @@ def generate_chunks(pdf_path):
 
     return text_chunks
 
-def add_filings_to_chromadb():
-    initialise()
-
-    existing_ids = collection.get()["ids"]
-    
-    if existing_ids and len(existing_ids) > 0:
-        print("Data already exists. Skipping processing.")
-        return  
-
-    # Process each PDF in the directory
-
-    for filename in os.listdir(filings_directory):
-        if filename.endswith(".pdf"):
-            pdf_path = os.path.join(filings_directory, filename)
-
-            text_chunks = generate_chunks(pdf_path)            
+def add_filings_to_chromadb(force=False):
+    """ Ingests any new or changed filings in the filings directory. See ingest.py for the pipeline (and CLI). """
+    from backend_app.services.document_retrieval.ingest import ingest_filings
 
-            print("Generating embeddings")
-            embeddings = embedding_model.encode(text_chunks)
-
-            print("Adding chunks and embeddings to collection")
-
-            # Given filename tsla_20231231.pdf:
-            filename_ticker = filename[:4] # Selects the first 4 letters in filename [i.e., tsla]
-            filename_date = filename[5:-4] # Skips the first 5 letters, and then takes all letters except the final 4 [i.e., 20231231]
-
-            for idx, chunk in enumerate(text_chunks):
-                try: 
-                    collection.add(
-                        documents=[chunk], 
-                        ids=[f"{filename}_doc_{idx}"],  # Unique ID for each document
-                        embeddings=[embeddings[idx]],
-                        metadatas=[{"filename" : filename, "ticker" : filename_ticker, "date_yyyymmdd" : filename_date}]
-                    )
-                except Exception as e: 
-                    print(f"Error adding document {idx} from {filename}: {e}")
+    return ingest_filings(filings_directory, force=force)
 
 
 def retrieve_relevant_chunks(query, top_k=3):
@@ -106,25 +86,54 @@ def retrieve_relevant_chunks(query, top_k=3):
     
     return results["documents"][0]
 
-def retrieve_filings(arguments):
+@timed_stage("retrieve_filings")
+async def retrieve_filings(arguments):
     arguments = json.loads(arguments)
-    ticker = arguments.get("ticker")
+    ticker = (arguments.get("ticker") or "").lower() # Tickers are stored lowercase, as parsed from the filenames
     keywords = arguments.get("keywords")
-    initialise()  # Ensure the vector store is initialized
+    filing_date = arguments.get("filing_date") # Optional, a YYYY, YYYYMM or YYYYMMDD prefix
+    await asyncio.to_thread(initialise)  # Ensure the vector store is initialized, off the event loop
 
     query_text = " ".join(keywords)
-    conditional_clause = {"ticker": ticker}
-
-    query_embedding = embedding_model.encode([query_text])[0]
+    conditions = [{"ticker": ticker}]
+    if filing_date:
+        # Chroma can't match a prefix, so the date is matched against the indexed filings' dates. Filtering in the query
+        # (rather than afterwards) means a company with years of filings still gets its candidates from the right ones
+        matching_dates = await asyncio.to_thread(bm25_index.filing_dates, ticker, filing_date)
+        conditions.append({"date_yyyymmdd": {"$in": matching_dates or [filing_date]}})
+    conditional_clause = {"$and": conditions} if len(conditions) > 1 else conditions[0]
+
+    # Dense (vector) and sparse (BM25 keyword) searches run at the same time
+    query_embedding, sparse_results = await asyncio.gather(
+        embedding_service.encode_query(query_text), # Batched with other concurrent queries, and cached
+        asyncio.to_thread(bm25_index.search, query_text, ticker, filing_date, DENSE_CANDIDATES)
+    )
 
-    results = collection.query(
+    results = await asyncio.to_thread(
+        collection.query,
         where=conditional_clause, 
-        query_embeddings=[query_embedding],
-        n_results=5  # Number of chunks to return
+        query_embeddings=[query_embedding.tolist()],
+        n_results=DENSE_CANDIDATES,
+        include=["documents", "metadatas", "embeddings"]
     )
 
-    documents = results["documents"][0]
-    # Combine into one string for tool output message to api, could possibly amend this in future to pass a key:value pair of documentname:content
-    documents = ''.join(documents)
+    chunks_by_id = {}
+    dense_ranking = []
+    for chunk_id, document, metadata, embedding in zip(results["ids"][0], results["documents"][0], results["metadatas"][0], results["embeddings"][0]):
+        chunks_by_id[chunk_id] = {"id": chunk_id, "document": document, "metadata": metadata, "embedding": embedding}
+        dense_ranking.append(chunk_id)
+    sparse_ranking = [chunk_id for chunk_id, _ in sparse_results]
+
+    # Combine both rankings, and fetch any keyword-only hits
+    fused_ids = reciprocal_rank_fusion(dense_ranking, sparse_ranking)[:PACKING_CANDIDATES]
+    missing_ids = [chunk_id for chunk_id in fused_ids if chunk_id not in chunks_by_id]
+    if missing_ids:
+        missing = await asyncio.to_thread(collection.get, ids=missing_ids, include=["documents", "metadatas", "embeddings"])
+        for chunk_id, document, metadata, embedding in zip(missing["ids"], missing["documents"], missing["metadatas"], missing["embeddings"]):
+            chunks_by_id[chunk_id] = {"id": chunk_id, "document": document, "metadata": metadata, "embedding": embedding}
+
+    candidates = [chunks_by_id[chunk_id] for chunk_id in fused_ids if chunk_id in chunks_by_id]
+    # Deduplicate, diversify, merge neighbouring chunks and trim to the token budget, with a source label on each passage
+    documents = context_packer.pack(query_embedding, candidates)
     documents = functions.create_json_response(response_model_content=documents)
-    return documents
\ No newline at end of file
+    return documents
@@ -0,0 +1,180 @@
+""" A local stand-in for the OpenAI chat completions API, so the backend can be run and load tested without an API key
+or network access. Start it with:
+
+    python -m backend_app.services.llm.fake_openai_server --port 8001
+
+and run the backend with LLM_BACKEND=fake (and FAKE_OPENAI_BASE_URL if it isn't on the default port).
+
+Responses are deterministic:
+- With tool_choice 'required', the first tool is called with the last user message as its 'instructions'.
+- With tool_choice 'auto', at the start of a turn, the tool script (see below) decides which tools to call. Without a
+  script, if the user mentions a ticker (e.g. AAPL) and get_stock_price is available, get_stock_price is called for
+  it. Otherwise it answers with text.
+- With tool_choice 'none' (or no tools), it answers with text.
+
+A tool script is a JSON file (set FAKE_OPENAI_TOOL_SCRIPT to its path) holding a list of rules, checked in order
+against the last user message. The first rule whose regex matches has its tool calls made, in parallel. Arguments
+can use the regex's named groups, e.g.
+
+    [{"match": "news about (?P<ticker>[A-Z]+)", "tool_calls": [{"name": "get_news", "arguments": {"tickers": ["{ticker}"]}}]}]
+
+A rule with an empty tool_calls list answers with text.
+
+Text answers stream FAKE_OPENAI_RESPONSE_TOKENS tokens, after a FAKE_OPENAI_TTFT_MS delay and with
+FAKE_OPENAI_TOKEN_DELAY_MS between tokens, so latency profiles roughly match the real API. Usage is reported when
+stream_options.include_usage is set, with token counts estimated the same way as the rest of the backend. """
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from backend_app.services.chatbot.token_utils import estimate_message_tokens
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+import uuid
+
+TTFT_SECONDS = float(os.getenv("FAKE_OPENAI_TTFT_MS", 200)) / 1000
+TOKEN_DELAY_SECONDS = float(os.getenv("FAKE_OPENAI_TOKEN_DELAY_MS", 10)) / 1000
+RESPONSE_TOKENS = int(os.getenv("FAKE_OPENAI_RESPONSE_TOKENS", 60))
+TOOL_SCRIPT_PATH = os.getenv("FAKE_OPENAI_TOOL_SCRIPT")
+TICKER_PATTERN = re.compile(r"\b[A-Z]{2,5}\b")
+
+def load_tool_script(path: str) -> list:
+    if not path:
+        return None
+    with open(path, "r") as script_file:
+        rules = json.load(script_file)
+    return [(re.compile(rule["match"]), rule.get("tool_calls", [])) for rule in rules]
+
+tool_script = load_tool_script(TOOL_SCRIPT_PATH)
+
+app = FastAPI()
+
+def last_user_message(messages: list) -> str:
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            return message.get("content") or ""
+    return ""
+
+def fill_arguments(value, groups: dict):
+    """ Substitutes the regex's named groups into a script's arguments. """
+    if isinstance(value, str):
+        return value.format(**groups)
+    if isinstance(value, list):
+        return [fill_arguments(item, groups) for item in value]
+    if isinstance(value, dict):
+        return {key: fill_arguments(item, groups) for key, item in value.items()}
+    return value
+
+def choose_tool_calls(body: dict) -> list:
+    """ Returns (name, arguments) for each tool the fake model 'decides' to call, or an empty list to answer with text. """
+    tools = body.get("tools") or []
+    tool_choice = body.get("tool_choice", "auto" if tools else "none")
+    messages = body.get("messages", [])
+    if not tools or tool_choice == "none":
+        return []
+
+    if tool_choice == "required":
+        return [(tools[0]["function"]["name"], {"instructions": last_user_message(messages)})]
+
+    # Only call tools at the start of a turn, so the follow up completion with the tool output answers with text
+    if not messages or messages[-1].get("role") != "user":
+        return []
+    tool_names = {tool["function"]["name"] for tool in tools}
+    user_message = last_user_message(messages)
+
+    if tool_script is not None:
+        for pattern, tool_calls in tool_script:
+            match = pattern.search(user_message)
+            if match:
+                groups = match.groupdict()
+                return [(call["name"], fill_arguments(call.get("arguments", {}), groups)) for call in tool_calls if call["name"] in tool_names]
+        return []
+
+    ticker = TICKER_PATTERN.search(user_message)
+    if ticker and "get_stock_price" in tool_names:
+        return [("get_stock_price", {"ticker": ticker.group(0)})]
+    return []
+
+def response_words(body: dict) -> list:
+    seed = last_user_message(body.get("messages", [])).split() or ["market"]
+    return [f"{seed[i % len(seed)]} " for i in range(RESPONSE_TOKENS)]
+
+def usage(body: dict, completion_tokens: int) -> dict:
+    prompt_tokens = sum(estimate_message_tokens(message) for message in body.get("messages", []))
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+def chunk(completion_id: str, model: str, delta: dict = None, finish_reason: str = None, usage_data: dict = None) -> str:
+    data = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    if usage_data is not None:
+        data["usage"] = usage_data
+    return f"data: {json.dumps(data)}\n\n"
+
+async def stream_completion(body: dict):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    model = body.get("model", "fake")
+    await asyncio.sleep(TTFT_SECONDS)
+
+    tool_calls = choose_tool_calls(body)
+    if tool_calls:
+        completion_tokens = 0
+        for index, (name, arguments) in enumerate(tool_calls):
+            yield chunk(completion_id, model, {"role": "assistant", "tool_calls": [
+                {"index": index, "id": f"call_{uuid.uuid4().hex[:24]}", "type": "function", "function": {"name": name, "arguments": ""}}
+            ]})
+            # Arguments arrive in fragments, like the real API
+            arguments = json.dumps(arguments)
+            for i in range(0, len(arguments), 8):
+                yield chunk(completion_id, model, {"tool_calls": [{"index": index, "function": {"arguments": arguments[i:i + 8]}}]})
+                await asyncio.sleep(TOKEN_DELAY_SECONDS)
+            completion_tokens += len(arguments) // 4 + 1
+        yield chunk(completion_id, model, {}, finish_reason="tool_calls")
+    else:
+        words = response_words(body)
+        yield chunk(completion_id, model, {"role": "assistant", "content": ""})
+        for word in words:
+            yield chunk(completion_id, model, {"content": word})
+            await asyncio.sleep(TOKEN_DELAY_SECONDS)
+        yield chunk(completion_id, model, {}, finish_reason="stop")
+        completion_tokens = len(words)
+
+    if (body.get("stream_options") or {}).get("include_usage"):
+        yield chunk(completion_id, model, usage_data=usage(body, completion_tokens))
+    yield "data: [DONE]\n\n"
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    if body.get("stream"):
+        return StreamingResponse(stream_completion(body), media_type="text/event-stream")
+
+    await asyncio.sleep(TTFT_SECONDS + TOKEN_DELAY_SECONDS * RESPONSE_TOKENS)
+    words = response_words(body)
+    return JSONResponse({
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words).strip()}, "finish_reason": "stop"}],
+        "usage": usage(body, len(words)),
+    })
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run a local OpenAI-compatible chat completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
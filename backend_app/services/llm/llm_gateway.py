@@ -0,0 +1,271 @@
+""" The single entry point for LLM calls. chat_logic, the AgentOrchestrator and the NewsService all go through the
+llm_gateway singleton rather than creating their own OpenAI clients, so that:
+
+- One tuned httpx connection pool is shared by every call, so connections to the API are reused.
+- A global semaphore caps the number of calls in flight, and per-model semaphores cap each model, so a burst of
+  users queues here rather than being rejected by the API.
+- 429s, 5xxs and connection errors are retried with jittered exponential backoff (honouring Retry-After). Streams are
+  only retried before their first chunk, after that the caller has already passed tokens on.
+- Token usage is logged for every call and totalled by caller and model.
+- A call cancelled part way (the client went away) is recorded as cancelled, with the tokens it had used so far
+  estimated, as the API doesn't send usage for a stream that's closed early.
+
+Set LLM_BACKEND=fake to send everything to the local stand-in in fake_openai_server.py instead of OpenAI, so the
+backend can run and be load tested offline. """
+
+from openai import AsyncOpenAI
+from openai.types import CompletionUsage
+import openai
+import asyncio
+import httpx
+import os
+import random
+import time
+from backend_app.services.monitoring.metrics import record_llm_call, LLM_RETRIES
+from backend_app.services.chatbot.token_utils import estimate_message_tokens
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+FAKE_OPENAI_BASE_URL = os.getenv("FAKE_OPENAI_BASE_URL", "http://127.0.0.1:8001/v1")
+
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 64))
+DEFAULT_MODEL_CONCURRENCY = int(os.getenv("LLM_DEFAULT_MODEL_CONCURRENCY", 32))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8.0
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("LLM_REQUEST_TIMEOUT_SECONDS", 60))
+
+def parse_model_limits(value: str) -> dict:
+    """ Parses per-model concurrency limits from a string like 'gpt-4o-mini=32,gpt-3.5-turbo=8'. """
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            model, limit = item.split("=", 1)
+            limits[model.strip()] = int(limit)
+    return limits
+
+MODEL_CONCURRENCY = parse_model_limits(os.getenv("LLM_MODEL_CONCURRENCY", "gpt-4o-mini=48,gpt-3.5-turbo=16"))
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """ Full jitter backoff, or the server's Retry-After if it gave one. """
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), BACKOFF_MAX_SECONDS)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+def estimate_usage(messages: list, completion_tokens: int) -> CompletionUsage:
+    """ Usage for a call that was cancelled before the API told us. The prompt is counted locally, and for streams each
+    content or tool call chunk is roughly one completion token. """
+    prompt_tokens = sum(estimate_message_tokens(message) for message in messages or [])
+    return CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens)
+
+class UsageRecord:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.cancelled = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_seconds = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "cancelled": self.cancelled,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+            "average_seconds": self.total_seconds / self.calls if self.calls else 0.0,
+        }
+
+class LLMGateway:
+    def __init__(self, backend: str = LLM_BACKEND, max_concurrency: int = MAX_CONCURRENCY, model_concurrency: dict = None,
+                 max_retries: int = MAX_RETRIES):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.model_concurrency = MODEL_CONCURRENCY if model_concurrency is None else model_concurrency
+        self.max_retries = max_retries
+
+        # Created on first use, so they're bound to the running event loop
+        self.client = None
+        self.http_client = None
+        self.global_semaphore = None
+        self.model_semaphores = {}
+
+        self.usage = {} # (caller, model) to UsageRecord
+        self.waiting = 0 # Calls queued for a concurrency slot
+        self.in_flight = 0
+
+    def get_client(self) -> AsyncOpenAI:
+        if self.client is None:
+            self.http_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(REQUEST_TIMEOUT_SECONDS, connect=10.0),
+                limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency, keepalive_expiry=60),
+            )
+            # Retries are handled here so they can be counted and jittered, so the SDK's own are turned off
+            if self.backend == "fake":
+                self.client = AsyncOpenAI(base_url=FAKE_OPENAI_BASE_URL, api_key="fake", http_client=self.http_client, max_retries=0)
+            else:
+                self.client = AsyncOpenAI(http_client=self.http_client, max_retries=0)
+        return self.client
+
+    def get_semaphores(self, model: str) -> tuple:
+        if self.global_semaphore is None:
+            self.global_semaphore = asyncio.Semaphore(self.max_concurrency)
+        if model not in self.model_semaphores:
+            self.model_semaphores[model] = asyncio.Semaphore(self.model_concurrency.get(model, DEFAULT_MODEL_CONCURRENCY))
+        return self.global_semaphore, self.model_semaphores[model]
+
+    def get_usage(self, caller: str, model: str) -> UsageRecord:
+        return self.usage.setdefault((caller, model), UsageRecord())
+
+    async def acquire(self, model: str):
+        global_semaphore, model_semaphore = self.get_semaphores(model)
+        self.waiting += 1
+        try:
+            await model_semaphore.acquire()
+            try:
+                await global_semaphore.acquire()
+            except BaseException:
+                model_semaphore.release()
+                raise
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    def release(self, model: str):
+        global_semaphore, model_semaphore = self.get_semaphores(model)
+        global_semaphore.release()
+        model_semaphore.release()
+        self.in_flight -= 1
+
+    async def create_with_retries(self, caller: str, **kwargs):
+        """ Makes the request, retrying failures that are worth retrying. Call with a concurrency slot held. """
+        usage = self.get_usage(caller, kwargs.get("model"))
+        attempt = 0
+        while True:
+            try:
+                return await self.get_client().chat.completions.create(**kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = retry_delay(e, attempt)
+                print(f"LLM call from {caller} failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                usage.retries += 1
+                LLM_RETRIES.labels(caller, kwargs.get("model")).inc()
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    def record(self, caller: str, model: str, started_at: float, usage_data, error: bool = False, cancelled: bool = False):
+        usage = self.get_usage(caller, model)
+        elapsed = time.perf_counter() - started_at
+        usage.calls += 1
+        usage.total_seconds += elapsed
+        if error:
+            usage.errors += 1
+        if cancelled:
+            usage.cancelled += 1
+        prompt_tokens = (usage_data.prompt_tokens or 0) if usage_data is not None else 0
+        completion_tokens = (usage_data.completion_tokens or 0) if usage_data is not None else 0
+        record_llm_call(caller, model, elapsed, prompt_tokens, completion_tokens, error, cancelled)
+        if usage_data is not None:
+            usage.prompt_tokens += prompt_tokens
+            usage.completion_tokens += completion_tokens
+            print(f"LLM usage [{caller}, {model}]: {usage_data.prompt_tokens} prompt + {usage_data.completion_tokens} completion tokens in {elapsed:.2f}s" + (" (cancelled, estimated)" if cancelled else ""))
+
+    async def create_chat(self, caller: str, **kwargs):
+        """ A non-streaming chat completion.
+
+        Parameters:
+        - caller (str): who's making the call, for usage accounting, e.g. 'news_summary'.
+        - kwargs: passed to chat.completions.create.
+
+        Returns:
+        - the ChatCompletion. """
+
+        model = kwargs.get("model")
+        await self.acquire(model)
+        started_at = time.perf_counter()
+        try:
+            response = await self.create_with_retries(caller, **kwargs)
+        except asyncio.CancelledError:
+            self.record(caller, model, started_at, estimate_usage(kwargs.get("messages"), 0), cancelled=True)
+            raise
+        except Exception:
+            self.record(caller, model, started_at, None, error=True)
+            raise
+        finally:
+            self.release(model)
+        self.record(caller, model, started_at, response.usage)
+        return response
+
+    async def stream_chat(self, caller: str, **kwargs):
+        """ A streaming chat completion. Yields the chunks as they arrive, including the final usage chunk. The
+        concurrency slot is held until the stream ends (or the caller stops reading).
+
+        Parameters:
+        - caller (str): who's making the call, for usage accounting, e.g. 'chat'.
+        - kwargs: passed to chat.completions.create. stream is always set. """
+
+        model = kwargs.get("model")
+        kwargs["stream"] = True
+        kwargs.setdefault("stream_options", {"include_usage": True}) # Needed for the usage accounting
+
+        await self.acquire(model)
+        started_at = time.perf_counter()
+        response = None
+        usage_data = None
+        completion_chunks = 0 # Counted in case the stream is cancelled before its usage chunk
+        error = False
+        cancelled = False
+        try:
+            response = await self.create_with_retries(caller, **kwargs)
+            async for chunk in response:
+                if getattr(chunk, "usage", None) is not None:
+                    usage_data = chunk.usage
+                elif chunk.choices:
+                    completion_chunks += 1
+                yield chunk
+        except (asyncio.CancelledError, GeneratorExit): # Cancelled, or the caller stopped reading
+            cancelled = usage_data is None
+            raise
+        except Exception:
+            error = True
+            raise
+        finally:
+            try:
+                if response is not None:
+                    await response.close() # Closing the stream is what stops the model generating (and billing) the rest
+            finally: # Even if closing fails (e.g. the connection dropped), or the slot would be lost for good
+                self.release(model)
+                if cancelled:
+                    usage_data = estimate_usage(kwargs.get("messages"), completion_chunks)
+                self.record(caller, model, started_at, usage_data, error=error, cancelled=cancelled)
+
+    async def close(self):
+        """ Closes the shared connection pool. Called on app shutdown. """
+        if self.http_client is not None:
+            await self.http_client.aclose()
+        self.client = None
+        self.http_client = None
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "usage": {f"{caller}:{model}": usage.to_dict() for (caller, model), usage in self.usage.items()},
+        }
+
+llm_gateway = LLMGateway()
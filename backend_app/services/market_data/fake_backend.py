@@ -0,0 +1,90 @@
+""" A stand-in for the yfinance backend, used for tests and benchmarks so we don't hit Yahoo. Select it by setting
+MARKET_DATA_BACKEND=fake.
+
+Prices are a deterministic random walk seeded from the ticker, so the same ticker always gives the same history. An
+optional latency simulates the upstream round trip, and every call is counted so tests can check how many upstream
+requests were actually made. """
+
+from datetime import date, timedelta
+import os
+import random
+import threading
+import time
+import zlib
+
+class FakeMarketDataBackend:
+    def __init__(self, latency_seconds: float = None):
+        if latency_seconds is None:
+            latency_seconds = float(os.getenv("FAKE_MARKET_DATA_LATENCY_SECONDS", 0))
+        self.latency_seconds = latency_seconds
+        self.lock = threading.Lock()
+        self.quote_calls = 0
+        self.history_calls = 0
+        self.bulk_calls = 0
+
+    def base_price(self, ticker: str) -> float:
+        return 20 + zlib.crc32(ticker.upper().encode()) % 480
+
+    def generate_bars(self, ticker: str, start: date, end: date) -> list:
+        """ Generates daily bars for weekdays in [start, end). Each day's price only depends on the ticker and the date,
+        so overlapping ranges agree with each other. """
+        bars = []
+        day = start
+        while day < end:
+            if day.weekday() < 5:
+                rng = random.Random(f"{ticker.upper()}:{day.isoformat()}")
+                drift = 1 + 0.0002 * (day.toordinal() % 2000) + 0.01 * (rng.random() - 0.5)
+                close = round(self.base_price(ticker) * drift, 2)
+                bars.append({
+                    "date": day.isoformat(),
+                    "open": round(close * (1 + 0.005 * (rng.random() - 0.5)), 2),
+                    "high": round(close * (1 + 0.01 * rng.random()), 2),
+                    "low": round(close * (1 - 0.01 * rng.random()), 2),
+                    "close": close,
+                    "volume": float(rng.randint(1_000_000, 50_000_000)),
+                })
+            day += timedelta(days=1)
+        return bars
+
+    def get_quote(self, ticker: str) -> dict:
+        with self.lock:
+            self.quote_calls += 1
+        time.sleep(self.latency_seconds)
+
+        today = date.today()
+        bars = self.generate_bars(ticker, today - timedelta(days=7), today + timedelta(days=1))
+        return {
+            "ticker": ticker,
+            "regularMarketPrice": bars[-1]["close"],
+            "regularMarketPreviousClose": bars[-2]["close"],
+            "currency": "USD",
+        }
+
+    def get_history(self, ticker: str, start: str, end: str) -> list:
+        with self.lock:
+            self.history_calls += 1
+        time.sleep(self.latency_seconds)
+        return self.generate_bars(ticker, date.fromisoformat(start), date.fromisoformat(end))
+
+    def get_quotes(self, tickers: list) -> dict:
+        with self.lock:
+            self.bulk_calls += 1
+        time.sleep(self.latency_seconds)
+
+        today = date.today()
+        quotes = {}
+        for ticker in tickers:
+            bars = self.generate_bars(ticker, today - timedelta(days=7), today + timedelta(days=1))
+            quotes[ticker] = {
+                "ticker": ticker,
+                "regularMarketPrice": bars[-1]["close"],
+                "regularMarketPreviousClose": bars[-2]["close"],
+                "currency": "USD",
+            }
+        return quotes
+
+    def get_histories(self, tickers: list, start: str, end: str) -> dict:
+        with self.lock:
+            self.bulk_calls += 1
+        time.sleep(self.latency_seconds)
+        return {ticker: self.generate_bars(ticker, date.fromisoformat(start), date.fromisoformat(end)) for ticker in tickers}
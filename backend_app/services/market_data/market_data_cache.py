@@ -0,0 +1,396 @@
+""" Cache layer for the market data tools in functions.py (get_stock_price, get_historical_stock_data).
+
+- Quotes are cached with a short TTL while the US market is open and a long TTL while it's closed.
+- Historical data for ranges that are entirely in the past never changes, so it's cached without expiry.
+- Concurrent identical requests share one upstream fetch (single-flight), so 50 users asking about AAPL in the same
+  minute make one call to Yahoo rather than 50.
+- With stale-while-revalidate on, an expired entry is returned straight away while it's refreshed in the background.
+- Yahoo requests are paced by the upstream scheduler (upstream_scheduler.py). If there's no request budget left, or
+  Yahoo throttles us, an expired entry is served rather than an error.
+
+Historical data is read through the OHLCVStore (ohlcv_store.py) when one is given, so only dates we haven't seen
+before go upstream. The upstream source is a backend object with get_quote(ticker) and get_history(ticker, start, end),
+so the yfinance backend can be swapped for FakeMarketDataBackend (fake_backend.py) in tests and benchmarks. The tools
+run on the thread pool in functions.py, so the cache is thread-safe rather than asyncio based. """
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, time as dt_time
+from zoneinfo import ZoneInfo
+from backend_app.services.market_data.ohlcv_store import OHLCVStore
+from backend_app.services.upstream.upstream_scheduler import (
+    upstream_scheduler, background_priority, is_rate_limit_error, UpstreamBudgetExceeded, UpstreamThrottled
+)
+import os
+import threading
+import time
+
+MARKET_TIMEZONE = ZoneInfo("America/New_York")
+MARKET_OPEN = dt_time(9, 30)
+MARKET_CLOSE = dt_time(16, 0)
+
+QUOTE_TTL_MARKET_OPEN = int(os.getenv("QUOTE_TTL_MARKET_OPEN_SECONDS", 15))
+QUOTE_TTL_MARKET_CLOSED = int(os.getenv("QUOTE_TTL_MARKET_CLOSED_SECONDS", 900))
+STALE_WHILE_REVALIDATE = os.getenv("MARKET_DATA_STALE_WHILE_REVALIDATE", "true").lower() == "true"
+STALE_GRACE_SECONDS = int(os.getenv("MARKET_DATA_STALE_GRACE_SECONDS", 300)) # How long past expiry we'll still serve stale data
+MAX_CACHE_ENTRIES = int(os.getenv("MARKET_DATA_CACHE_MAX_ENTRIES", 5000))
+
+def is_market_open(now: datetime = None) -> bool:
+    """ Whether the US equity market is in regular trading hours. Doesn't account for exchange holidays, on which we'll
+    just use the shorter TTL. """
+    now = now or datetime.now(MARKET_TIMEZONE)
+    now = now.astimezone(MARKET_TIMEZONE)
+    return now.weekday() < 5 and MARKET_OPEN <= now.time() < MARKET_CLOSE
+
+def bars_from_frame(historical_data) -> list:
+    """ Converts a yfinance OHLCV DataFrame into a list of {date, open, high, low, close, volume} dicts. """
+    historical_data = historical_data.dropna(subset=["Close"])
+    return [
+        {
+            "date": index.strftime("%Y-%m-%d"),
+            "open": float(row["Open"]),
+            "high": float(row["High"]),
+            "low": float(row["Low"]),
+            "close": float(row["Close"]),
+            "volume": float(row["Volume"]),
+        }
+        for index, row in historical_data.iterrows()
+    ]
+
+def frame_for_ticker(data, ticker: str):
+    """ Selects one ticker's columns from a yf.download result, which has (ticker, field) columns. Returns None if
+    the ticker isn't in the result. """
+    if data is None or data.empty:
+        return None
+    if data.columns.nlevels > 1:
+        if ticker not in data.columns.get_level_values(0):
+            return None
+        return data[ticker]
+    return data
+
+class YFinanceBackend:
+    """ Fetches market data from Yahoo Finance. Every request goes through the upstream scheduler, so bursts are paced
+    and we back off when Yahoo throttles us. """
+
+    def request(self, fetch):
+        """ Waits for the scheduler, then runs fetch(). """
+        upstream_scheduler.acquire("yahoo")
+        try:
+            return fetch()
+        except Exception as e:
+            if is_rate_limit_error(e):
+                upstream_scheduler.report_throttled("yahoo")
+                raise UpstreamThrottled(str(e)) from e
+            raise
+
+    def get_quote(self, ticker: str) -> dict:
+        import yfinance as yf
+
+        info = self.request(lambda: yf.Ticker(ticker).info)
+        return {
+            "ticker": ticker,
+            "regularMarketPrice": info.get("regularMarketPrice"),
+            "regularMarketPreviousClose": info.get("regularMarketPreviousClose"),
+            "currency": info.get("currency"),
+        }
+
+    def get_quotes(self, tickers: list) -> dict:
+        """ Returns quotes for several tickers from one bulk download of the last few daily bars. While the market is
+        open the latest bar is today's, so its close is the current price. """
+        import yfinance as yf
+
+        data = self.request(lambda: yf.download(tickers, period="5d", interval="1d", group_by="ticker", auto_adjust=False, progress=False, threads=True))
+        quotes = {}
+        for ticker in tickers:
+            frame = frame_for_ticker(data, ticker)
+            closes = frame["Close"].dropna() if frame is not None else []
+            quotes[ticker] = {
+                "ticker": ticker,
+                "regularMarketPrice": float(closes.iloc[-1]) if len(closes) > 0 else None,
+                "regularMarketPreviousClose": float(closes.iloc[-2]) if len(closes) > 1 else None,
+                "currency": None,
+            }
+        return quotes
+
+    def get_history(self, ticker: str, start: str, end: str) -> list:
+        """ Returns daily bars for [start, end) as a list of {date, open, high, low, close, volume} dicts. """
+        import yfinance as yf
+
+        return bars_from_frame(self.request(lambda: yf.Ticker(ticker).history(start=start, end=end)))
+
+    def get_histories(self, tickers: list, start: str, end: str) -> dict:
+        """ Returns daily bars for [start, end) for several tickers from one bulk download, as a dict of ticker to bars. """
+        import yfinance as yf
+
+        data = self.request(lambda: yf.download(tickers, start=start, end=end, interval="1d", group_by="ticker", auto_adjust=True, progress=False, threads=True))
+        histories = {}
+        for ticker in tickers:
+            frame = frame_for_ticker(data, ticker)
+            histories[ticker] = bars_from_frame(frame) if frame is not None else []
+        return histories
+
+class CacheEntry:
+    def __init__(self, value, expires_at: float = None):
+        self.value = value
+        self.expires_at = expires_at # None means the entry never expires
+
+    def is_fresh(self, now: float) -> bool:
+        return self.expires_at is None or now < self.expires_at
+
+class MarketDataCache:
+    def __init__(self, backend,
+                 history_store = None,
+                 quote_ttl_market_open: int = QUOTE_TTL_MARKET_OPEN,
+                 quote_ttl_market_closed: int = QUOTE_TTL_MARKET_CLOSED,
+                 stale_while_revalidate: bool = STALE_WHILE_REVALIDATE,
+                 stale_grace_seconds: int = STALE_GRACE_SECONDS,
+                 max_entries: int = MAX_CACHE_ENTRIES):
+        self.backend = backend
+        self.history_store = history_store
+        self.quote_ttl_market_open = quote_ttl_market_open
+        self.quote_ttl_market_closed = quote_ttl_market_closed
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_grace_seconds = stale_grace_seconds
+        self.max_entries = max_entries
+
+        self.entries = OrderedDict() # Least recently used first
+        self.inflight = {} # Maps a key to the Future of the upstream fetch currently running for it
+        self.lock = threading.Lock()
+        self.refresh_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="market-data-refresh")
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0 # Requests that waited on another request's upstream fetch rather than making their own
+        self.errors = 0
+        self.fallbacks = 0 # Expired entries served because the upstream budget had run out
+
+    def quote_ttl(self) -> int:
+        return self.quote_ttl_market_open if is_market_open() else self.quote_ttl_market_closed
+
+    def history_ttl(self, bars: list, end: str):
+        """ A range that ends before today can't change, so it never expires. Anything including today (or an empty
+        result, which could be a transient upstream problem) is treated like a quote. """
+        if bars and date.fromisoformat(end) <= datetime.now(MARKET_TIMEZONE).date():
+            return None
+        return self.quote_ttl()
+
+    def get_quote(self, ticker: str) -> dict:
+        """ Retrieves the latest quote for a ticker. """
+        ticker = ticker.upper()
+        return self.get(("quote", ticker), lambda: self.backend.get_quote(ticker), lambda value: self.quote_ttl())
+
+    def get_history(self, ticker: str, start: str, end: str) -> list:
+        """ Retrieves daily bars for a ticker over [start, end). Dates are YYYY-MM-DD strings. """
+        ticker = ticker.upper()
+        history_ttl = lambda bars: self.history_ttl(bars, end)
+        history_source = self.history_store.get_range if self.history_store else self.backend.get_history
+        return self.get(("history", ticker, start, end), lambda: history_source(ticker, start, end), history_ttl)
+
+    def get_quotes(self, tickers: list) -> dict:
+        """ Retrieves the latest quotes for several tickers. Any that aren't cached are fetched in one bulk request.
+
+        Returns:
+        - (dict) ticker to quote. """
+
+        tickers = [ticker.upper() for ticker in tickers]
+
+        def load_quotes(keys):
+            quotes = self.backend.get_quotes([key[1] for key in keys])
+            return {("quote", ticker): quote for ticker, quote in quotes.items()}
+
+        results = self.get_many([("quote", ticker) for ticker in tickers], load_quotes, lambda value: self.quote_ttl())
+        return {key[1]: value for key, value in results.items()}
+
+    def get_histories(self, tickers: list, start: str, end: str) -> dict:
+        """ Retrieves daily bars over [start, end) for several tickers. Any that aren't cached are fetched together.
+
+        Returns:
+        - (dict) ticker to a list of bars. """
+
+        tickers = [ticker.upper() for ticker in tickers]
+        history_ttl = lambda bars: self.history_ttl(bars, end)
+
+        def load_histories(keys):
+            missing_tickers = [key[1] for key in keys]
+            if self.history_store:
+                histories = self.history_store.get_ranges(missing_tickers, start, end)
+            else:
+                histories = self.backend.get_histories(missing_tickers, start, end)
+            return {("history", ticker, start, end): bars for ticker, bars in histories.items()}
+
+        results = self.get_many([("history", ticker, start, end) for ticker in tickers], load_histories, history_ttl)
+        return {key[1]: value for key, value in results.items()}
+
+    def get(self, key: tuple, loader, ttl_for):
+        """ Returns the cached value for key, or loads it with loader().
+
+        Parameters:
+        - key (tuple): the cache key.
+        - loader (callable): fetches the value from upstream.
+        - ttl_for (callable): takes the loaded value and returns its TTL in seconds, or None to never expire. """
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry.is_fresh(now):
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return entry.value
+                if self.stale_while_revalidate and now < entry.expires_at + self.stale_grace_seconds:
+                    self.stale_hits += 1
+                    if key not in self.inflight:
+                        self.inflight[key] = Future()
+                        self.refresh_pool.submit(self.refresh, key, loader, ttl_for, self.inflight[key])
+                    return entry.value
+
+            future = self.inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                is_leader = False
+            else:
+                future = Future()
+                self.inflight[key] = future
+                self.misses += 1
+                is_leader = True
+
+        try:
+            if is_leader:
+                return self.load(key, loader, ttl_for, future)
+            return future.result()
+        except (UpstreamBudgetExceeded, UpstreamThrottled) as e:
+            return self.fallback(key, e)
+
+    def fallback(self, key: tuple, error: Exception):
+        """ Serves an expired entry, however old, when we're out of upstream budget. Older data is better than telling
+        the user there's no data. Re-raises the upstream error if there's nothing cached. """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                raise error
+            self.fallbacks += 1
+        print(f"Upstream budget exhausted, serving expired data for {key}")
+        return entry.value
+
+    def refresh(self, key: tuple, loader, ttl_for, future: Future):
+        """ Reloads an expired entry in the background, at background priority so it doesn't hold up user requests. """
+        with background_priority():
+            try:
+                self.load(key, loader, ttl_for, future)
+            except Exception as e:
+                print(f"Background refresh of {key} failed: {e}")
+
+    def load(self, key: tuple, loader, ttl_for, future: Future):
+        """ Fetches a value from upstream, stores it, and passes it on to anyone waiting on the same key. """
+        try:
+            value = loader()
+            ttl = ttl_for(value)
+            self.set(key, value, ttl)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def get_many(self, keys: list, bulk_loader, ttl_for) -> dict:
+        """ Like get(), but for several keys at once. Keys that are neither cached nor already being fetched are loaded
+        together with a single bulk_loader(keys) call, which returns a dict of key to value. Expired entries are
+        reloaded rather than served stale.
+
+        Returns:
+        - (dict) key to value for every key requested. """
+
+        now = time.monotonic()
+        results, waiting, to_load = {}, {}, []
+        with self.lock:
+            for key in dict.fromkeys(keys): # Drops duplicates but keeps the order
+                entry = self.entries.get(key)
+                if entry is not None and entry.is_fresh(now):
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    results[key] = entry.value
+                elif key in self.inflight:
+                    self.coalesced += 1
+                    waiting[key] = self.inflight[key]
+                else:
+                    future = Future()
+                    self.inflight[key] = future
+                    self.misses += 1
+                    to_load.append((key, future))
+
+        if to_load:
+            try:
+                values = bulk_loader([key for key, _ in to_load])
+                for key, future in to_load:
+                    value = values.get(key)
+                    self.set(key, value, ttl_for(value))
+                    future.set_result(value)
+                    results[key] = value
+            except (UpstreamBudgetExceeded, UpstreamThrottled) as e:
+                with self.lock:
+                    self.errors += 1
+                for key, future in to_load:
+                    if not future.done():
+                        future.set_exception(e)
+                    results[key] = self.fallback(key, e)
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                for key, future in to_load:
+                    if not future.done():
+                        future.set_exception(e)
+                raise
+            finally:
+                with self.lock:
+                    for key, _ in to_load:
+                        self.inflight.pop(key, None)
+
+        for key, future in waiting.items():
+            try:
+                results[key] = future.result()
+            except (UpstreamBudgetExceeded, UpstreamThrottled) as e:
+                results[key] = self.fallback(key, e)
+        return results
+
+    def set(self, key: tuple, value, ttl: float = None):
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self.lock:
+            self.entries[key] = CacheEntry(value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.stale_hits + self.misses + self.coalesced
+            return {
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+                "fallbacks": self.fallbacks,
+                "entries": len(self.entries),
+                "hit_rate": (self.hits + self.stale_hits + self.coalesced) / lookups if lookups else 0.0,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+def create_market_data_backend(name: str = None):
+    """ Creates the upstream backend named by the MARKET_DATA_BACKEND env variable ('yfinance' by default, or 'fake'). """
+    name = name or os.getenv("MARKET_DATA_BACKEND", "yfinance")
+    if name == "fake":
+        from backend_app.services.market_data.fake_backend import FakeMarketDataBackend
+        return FakeMarketDataBackend()
+    return YFinanceBackend()
+
+market_data_backend = create_market_data_backend()
+market_data_cache = MarketDataCache(market_data_backend, history_store=OHLCVStore(market_data_backend.get_history, market_data_backend.get_histories))
@@ -0,0 +1,275 @@
+""" Local on-disk store of daily OHLCV bars, one directory per ticker, sitting behind get_historical_stock_data and
+get_stock_price(date=...).
+
+Each ticker is stored as memory-mapped NumPy arrays (dates.npy holds days since the epoch, ohlcv.npy holds the open,
+high, low, close and volume columns) plus coverage.json, the list of date ranges we've already fetched. A range query
+works out which parts of the range aren't covered yet, fetches only those from upstream, merges them in, and then
+slices the answer out of the local arrays. Recording coverage (rather than just looking at which dates have bars)
+means weekends and holidays aren't re-requested every time. A range is only recorded as covered once we know the
+answer for it is settled, though: upstream returns no bars when a request fails or drops a ticker, which looks just
+like a range with no trading days, so an empty range is left to be fetched again (see settled()).
+
+Today's bar is still changing while the market is open, so anything from today onwards is always fetched from
+upstream and never written to disk. """
+
+from collections import defaultdict
+from datetime import date
+import json
+import numpy as np
+import os
+import re
+import threading
+
+DEFAULT_STORE_DIRECTORY = os.getenv("MARKET_DATA_STORE_DIRECTORY", "./market_data_store/")
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+# Tickers name directories in the store and come from the model, so nothing that could be a path: starts with a letter,
+# digit or ^ (indices, e.g. ^GSPC), then only letters, digits and . - = ^ (e.g. BRK-B, EURUSD=X). No '/', '.' or '..'
+TICKER_PATTERN = re.compile(r"^[A-Z0-9^][A-Z0-9.\-=^]{0,19}$")
+COLUMNS = ["open", "high", "low", "close", "volume"]
+SETTLED_AFTER_DAYS = int(os.getenv("MARKET_DATA_SETTLED_AFTER_DAYS", 5)) # Empty ranges older than this are taken as holidays/before listing
+
+def to_day(value: str) -> int:
+    """ Converts a YYYY-MM-DD string to days since the epoch. """
+    return date.fromisoformat(value).toordinal() - EPOCH_ORDINAL
+
+def from_day(day: int) -> str:
+    """ Converts days since the epoch to a YYYY-MM-DD string. """
+    return date.fromordinal(int(day) + EPOCH_ORDINAL).isoformat()
+
+def is_valid_ticker(ticker: str) -> bool:
+    return isinstance(ticker, str) and TICKER_PATTERN.match(ticker) is not None
+
+def merge_ranges(ranges: list) -> list:
+    """ Merges overlapping or touching [start, end) ranges. """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def missing_ranges(coverage: list, start: int, end: int) -> list:
+    """ Returns the parts of [start, end) that aren't in coverage. """
+    gaps = []
+    cursor = start
+    for covered_start, covered_end in coverage:
+        if covered_end <= cursor:
+            continue
+        if covered_start >= end:
+            break
+        if covered_start > cursor:
+            gaps.append([cursor, covered_start])
+        cursor = max(cursor, covered_end)
+    if cursor < end:
+        gaps.append([cursor, end])
+    return gaps
+
+class OHLCVStore:
+    def __init__(self, fetcher, bulk_fetcher = None, directory: str = DEFAULT_STORE_DIRECTORY):
+        """ Parameters:
+        - fetcher (callable): fetcher(ticker, start, end) returns a list of {date, open, high, low, close, volume} dicts
+          for [start, end), e.g. a market data backend's get_history.
+        - bulk_fetcher (callable): optional. bulk_fetcher(tickers, start, end) returns a dict of ticker to bars for
+          several tickers in one upstream request, e.g. a market data backend's get_histories.
+        - directory (str): where the per-ticker arrays are written. """
+
+        self.fetcher = fetcher
+        self.bulk_fetcher = bulk_fetcher
+        self.directory = directory
+        self.locks = defaultdict(threading.RLock) # One lock per ticker, so different tickers can be filled in parallel
+        self.locks_lock = threading.Lock()
+
+        self.upstream_requests = 0
+        self.days_fetched = 0
+
+    def ticker_lock(self, ticker: str) -> threading.RLock:
+        with self.locks_lock:
+            return self.locks[ticker]
+
+    def ticker_directory(self, ticker: str) -> str:
+        if not is_valid_ticker(ticker): # get_range/get_ranges check first, this is the last line of defence
+            raise ValueError(f"Invalid ticker '{ticker}'")
+        return os.path.join(self.directory, ticker)
+
+    def load(self, ticker: str):
+        """ Loads a ticker's arrays (memory-mapped) and coverage. Returns empty arrays if nothing is stored yet. """
+        ticker_directory = self.ticker_directory(ticker)
+        coverage_path = os.path.join(ticker_directory, "coverage.json")
+        if not os.path.exists(coverage_path):
+            return np.empty(0, dtype=np.int64), np.empty((0, len(COLUMNS)), dtype=np.float64), []
+
+        dates = np.load(os.path.join(ticker_directory, "dates.npy"), mmap_mode="r")
+        ohlcv = np.load(os.path.join(ticker_directory, "ohlcv.npy"), mmap_mode="r")
+        with open(coverage_path, "r") as coverage_file:
+            coverage = json.load(coverage_file)
+        return dates, ohlcv, coverage
+
+    def save(self, ticker: str, dates: np.ndarray, ohlcv: np.ndarray, coverage: list):
+        """ Writes a ticker's arrays and coverage. Each file is written to a temporary path and then swapped in, so
+        readers never see a half-written file. """
+        ticker_directory = self.ticker_directory(ticker)
+        os.makedirs(ticker_directory, exist_ok=True)
+
+        for name, array in (("dates.npy", dates), ("ohlcv.npy", ohlcv)):
+            temporary_path = os.path.join(ticker_directory, f".{name}.tmp")
+            with open(temporary_path, "wb") as array_file:
+                np.save(array_file, array)
+            os.replace(temporary_path, os.path.join(ticker_directory, name))
+
+        # Coverage is written last, so it never claims a range that isn't in the arrays yet
+        temporary_path = os.path.join(ticker_directory, ".coverage.json.tmp")
+        with open(temporary_path, "w") as coverage_file:
+            json.dump(coverage, coverage_file)
+        os.replace(temporary_path, os.path.join(ticker_directory, "coverage.json"))
+
+    def fetch(self, ticker: str, start: int, end: int):
+        """ Fetches [start, end) from upstream and returns it as (dates, ohlcv) arrays. """
+        bars = self.fetcher(ticker, from_day(start), from_day(end))
+        self.upstream_requests += 1
+        self.days_fetched += end - start
+        return self.to_arrays(bars)
+
+    def bulk_fetch(self, tickers: list, start: int, end: int) -> dict:
+        """ Fetches [start, end) for several tickers, in one upstream request if we have a bulk fetcher. Returns a dict
+        of ticker to (dates, ohlcv) arrays. """
+        if self.bulk_fetcher is None:
+            return {ticker: self.fetch(ticker, start, end) for ticker in tickers}
+
+        bars_by_ticker = self.bulk_fetcher(tickers, from_day(start), from_day(end))
+        self.upstream_requests += 1
+        self.days_fetched += (end - start) * len(tickers)
+        return {ticker: self.to_arrays(bars_by_ticker.get(ticker, [])) for ticker in tickers}
+
+    def settled(self, fetched_dates: np.ndarray, gap_start: int, gap_end: int) -> bool:
+        """ Whether a fetch answered [gap_start, gap_end) for good, so it can be recorded as covered: it returned bars
+        for the gap, or the gap is only weekends, or the fetch returned bars elsewhere (so it didn't fail) and the gap
+        is old enough that no bars means there were none. An empty fetch is never recorded, so it's retried next time. """
+        if ((fetched_dates >= gap_start) & (fetched_dates < gap_end)).any():
+            return True
+        gap_days = np.arange(gap_start, gap_end).astype("datetime64[D]")
+        if not np.is_busday(gap_days).any():
+            return True
+        today = to_day(date.today().isoformat())
+        return len(fetched_dates) > 0 and gap_end <= today - SETTLED_AFTER_DAYS
+
+    def merge(self, ticker: str, fetched_dates: np.ndarray, fetched_ohlcv: np.ndarray, start: int, end: int):
+        """ Merges bars fetched for [start, end) into a ticker's stored arrays. Only the parts of the range that aren't
+        covered yet are added, so it's safe if another request filled some of it in the meantime. Gaps the fetch
+        didn't settle (see settled()) are left uncovered. """
+        with self.ticker_lock(ticker):
+            dates, ohlcv, coverage = self.load(ticker)
+            gaps = [gap for gap in missing_ranges(coverage, start, end) if self.settled(fetched_dates, *gap)]
+            if not gaps:
+                return
+
+            in_gaps = np.zeros(len(fetched_dates), dtype=bool)
+            for gap_start, gap_end in gaps:
+                in_gaps |= (fetched_dates >= gap_start) & (fetched_dates < gap_end)
+
+            dates = np.concatenate([np.asarray(dates), fetched_dates[in_gaps]])
+            ohlcv = np.concatenate([np.asarray(ohlcv), fetched_ohlcv[in_gaps]])
+            order = np.argsort(dates, kind="stable")
+            self.save(ticker, dates[order], ohlcv[order], merge_ranges(coverage + gaps))
+
+    def read(self, ticker: str, start: int, end: int) -> list:
+        """ Reads the stored bars for [start, end). """
+        with self.ticker_lock(ticker):
+            dates, ohlcv, _ = self.load(ticker)
+            first, last = np.searchsorted(dates, [start, end])
+            return self.to_bars(dates[first:last], ohlcv[first:last])
+
+    def get_range(self, ticker: str, start: str, end: str) -> list:
+        """ Retrieves daily bars for [start, end), fetching only the dates we don't already have.
+
+        Parameters:
+        - ticker (str): the stock ticker.
+        - start (str), end (str): YYYY-MM-DD dates. end is exclusive, as with yfinance.
+
+        Returns:
+        - (list) {date, open, high, low, close, volume} dicts, oldest first.
+
+        Raises:
+        - ValueError if the ticker isn't a valid ticker symbol. """
+
+        ticker = ticker.upper()
+        if not is_valid_ticker(ticker):
+            raise ValueError(f"Invalid ticker '{ticker}'")
+        start_day, end_day = to_day(start), to_day(end)
+        today = to_day(date.today().isoformat())
+        stored_end = min(end_day, today) # Only complete days are stored
+
+        # The lock is held while fetching so concurrent requests for the same ticker don't fetch the same gap twice
+        with self.ticker_lock(ticker):
+            _, _, coverage = self.load(ticker)
+            gaps = missing_ranges(coverage, start_day, stored_end) if start_day < stored_end else []
+            for gap_start, gap_end in gaps:
+                gap_dates, gap_ohlcv = self.fetch(ticker, gap_start, gap_end)
+                self.merge(ticker, gap_dates, gap_ohlcv, gap_start, gap_end)
+
+            bars = self.read(ticker, start_day, stored_end)
+
+        # Today onwards always comes straight from upstream
+        if end_day > today:
+            live_dates, live_ohlcv = self.fetch(ticker, max(start_day, today), end_day)
+            bars.extend(self.to_bars(live_dates, live_ohlcv))
+        return bars
+
+    def get_ranges(self, tickers: list, start: str, end: str) -> dict:
+        """ Retrieves daily bars for [start, end) for several tickers. Any tickers with missing dates are filled in with
+        a single bulk request covering all of their gaps. Coverage is settled per ticker (see settled()), so one ticker
+        dropped from the bulk answer doesn't mark its range as covered.
+
+        Returns:
+        - (dict) ticker to a list of bars, as returned by get_range. Invalid tickers get no bars. """
+
+        tickers = [ticker.upper() for ticker in tickers]
+        invalid = [ticker for ticker in tickers if not is_valid_ticker(ticker)]
+        if invalid:
+            print(f"Ignoring invalid tickers: {invalid}")
+            tickers = [ticker for ticker in tickers if ticker not in invalid]
+        start_day, end_day = to_day(start), to_day(end)
+        today = to_day(date.today().isoformat())
+        stored_end = min(end_day, today)
+
+        gaps_by_ticker = {}
+        if start_day < stored_end:
+            for ticker in tickers:
+                with self.ticker_lock(ticker):
+                    _, _, coverage = self.load(ticker)
+                gaps = missing_ranges(coverage, start_day, stored_end)
+                if gaps:
+                    gaps_by_ticker[ticker] = gaps
+
+        if gaps_by_ticker:
+            # One request spanning every ticker's gaps, merge() only keeps the parts each ticker was missing. A ticker
+            # missing from the bulk answer comes back with no bars, and merge() won't record coverage for it, so its
+            # gaps are requested again next time rather than marked covered for the whole span
+            span_start = min(gaps[0][0] for gaps in gaps_by_ticker.values())
+            span_end = max(gaps[-1][1] for gaps in gaps_by_ticker.values())
+            fetched = self.bulk_fetch(list(gaps_by_ticker), span_start, span_end)
+            for ticker, (fetched_dates, fetched_ohlcv) in fetched.items():
+                self.merge(ticker, fetched_dates, fetched_ohlcv, span_start, span_end)
+
+        bars_by_ticker = {ticker: self.read(ticker, start_day, stored_end) for ticker in tickers}
+        bars_by_ticker.update({ticker: [] for ticker in invalid})
+
+        if end_day > today:
+            live = self.bulk_fetch(tickers, max(start_day, today), end_day)
+            for ticker, (live_dates, live_ohlcv) in live.items():
+                bars_by_ticker[ticker].extend(self.to_bars(live_dates, live_ohlcv))
+        return bars_by_ticker
+
+    def to_arrays(self, bars: list):
+        dates = np.array([to_day(bar["date"]) for bar in bars], dtype=np.int64)
+        ohlcv = np.array([[bar[column] for column in COLUMNS] for bar in bars], dtype=np.float64).reshape(-1, len(COLUMNS))
+        return dates, ohlcv
+
+    def to_bars(self, dates: np.ndarray, ohlcv: np.ndarray) -> list:
+        return [
+            {"date": from_day(day), **dict(zip(COLUMNS, (float(value) for value in row)))}
+            for day, row in zip(dates, ohlcv)
+        ]
+
+    def stats(self) -> dict:
+        return {"upstream_requests": self.upstream_requests, "days_fetched": self.days_fetched}
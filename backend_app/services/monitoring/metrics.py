@@ -0,0 +1,255 @@
+""" Prometheus metrics for the chat hot path, exposed on /metrics (see app.py) for the k8s scrape.
+
+Latencies and token counts are recorded where they happen (the /chat stream, the LLM gateway, the ToolExecutor, the
+AgentOrchestrator, retrieve_filings and the NewsService). Cache hit rates and queue depths are read from the stats() of
+each component when /metrics is scraped, so they cost nothing on the request path.
+
+Tokens used by a single /chat request are totalled through request_usage, a context variable set by the /chat endpoint.
+Tool and agent tasks are started from within the request, so their LLM calls are counted towards it too.
+
+When a client goes away its answer is cancelled (see chatbot/chat_stream.py). What that saved is estimated from running
+averages of how long chat streams, tools and LLM calls take (and how many tokens the calls generate) when they finish. """
+
+from prometheus_client import Counter, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from contextlib import contextmanager
+from contextvars import ContextVar
+import asyncio
+import functools
+import time
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+CHAT_REQUESTS = Counter("finllm_chat_requests_total", "Chat requests, by outcome.", ["status"])
+TIME_TO_FIRST_TOKEN = Histogram("finllm_chat_time_to_first_token_seconds", "Time from the chat request to the first chunk sent to the client.", buckets=LATENCY_BUCKETS)
+STREAM_DURATION = Histogram("finllm_chat_stream_duration_seconds", "Time from the chat request to the end of its stream.", buckets=LATENCY_BUCKETS)
+CHAT_ADMISSIONS = Counter("finllm_chat_admissions_total", "Chat requests through admission control, by priority and result (admitted, rejected when the queue is full or the wait would miss the deadline, timed_out in the queue, or shed for a higher priority request).", ["priority", "result"])
+CHAT_ADMISSION_WAIT = Histogram("finllm_chat_admission_wait_seconds", "Time admitted chat requests waited for a stream slot.", ["priority"], buckets=(0.0, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 15.0))
+REQUEST_TOKENS = Histogram("finllm_chat_request_tokens", "LLM tokens used by a single chat request, across every call it made.", ["kind"], buckets=TOKEN_BUCKETS)
+
+LLM_CALL_DURATION = Histogram("finllm_llm_call_duration_seconds", "LLM call duration, including streaming.", ["caller", "model"], buckets=LATENCY_BUCKETS)
+LLM_TOKENS = Counter("finllm_llm_tokens_total", "LLM tokens used.", ["caller", "model", "kind"])
+LLM_ERRORS = Counter("finllm_llm_errors_total", "LLM calls that failed after any retries.", ["caller", "model"])
+LLM_RETRIES = Counter("finllm_llm_retries_total", "LLM calls retried.", ["caller", "model"])
+
+TOOL_DURATION = Histogram("finllm_tool_duration_seconds", "Tool call duration.", ["tool"], buckets=LATENCY_BUCKETS)
+TOOL_CALLS = Counter("finllm_tool_calls_total", "Tool calls, by outcome (ok, error, timeout or cancelled).", ["tool", "status"])
+
+AGENT_DURATION = Histogram("finllm_agent_duration_seconds", "Agent run duration within an orchestration, excluding time waiting on other agents.", ["agent"], buckets=LATENCY_BUCKETS)
+AGENT_RUNS = Counter("finllm_agent_runs_total", "Agent runs, by outcome (ok, error, timeout or cancelled).", ["agent", "status"])
+
+EVENT_LOOP_LAG = Histogram("finllm_event_loop_lag_seconds", "How late the event loop runs a timer, i.e. how long it was blocked.", buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+SSE_EVENTS = Counter("finllm_sse_events_total", "SSE events written to chat streams, by type (token, ui, usage, error, done or heartbeat).", ["event"])
+SSE_BYTES = Counter("finllm_sse_bytes_total", "Bytes written to chat streams.")
+SSE_TEXT_CHUNKS = Counter("finllm_sse_text_chunks_total", "Model text chunks received by chat streams, before they're coalesced into token events.")
+SSE_STREAM_WRITES = Histogram("finllm_sse_stream_writes", "SSE events written by a single chat stream.", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+SSE_STREAM_THROUGHPUT = Histogram("finllm_sse_stream_bytes_per_second", "Bytes per second written by a single chat stream, over its whole duration.", buckets=(100, 250, 500, 1000, 2500, 5000, 10000, 25000, 100000))
+
+CANCELLATIONS = Counter("finllm_cancellations_total", "Work stopped before it finished because nobody was waiting for it any more, by kind (chat, tool or llm) and name.", ["kind", "name"])
+CANCELLATION_SECONDS_SAVED = Counter("finllm_cancellation_seconds_saved_total", "Estimated time cancelled work would still have taken, from how long the same work usually takes. Kinds overlap, a chat stream's saving includes its tools' and LLM calls'.", ["kind", "name"])
+CANCELLATION_TOKENS_SAVED = Counter("finllm_cancellation_tokens_saved_total", "Estimated completion tokens cancelled LLM calls would still have generated.", ["caller", "model"])
+
+STAGE_DURATION = Histogram("finllm_stage_duration_seconds", "Duration of individual stages, e.g. orchestration, retrieval and news fetches.", ["stage"], buckets=LATENCY_BUCKETS)
+
+request_usage = ContextVar("request_usage", default=None)
+
+class RunningAverages:
+    """ Exponentially weighted averages, by key, of how long work takes to finish and how many tokens it generates.
+    Used to estimate what cancelled work would still have cost. """
+
+    def __init__(self, weight: float = 0.1):
+        self.weight = weight
+        self.averages = {}
+
+    def observe(self, key, value: float):
+        average = self.averages.get(key)
+        self.averages[key] = value if average is None else average + self.weight * (value - average)
+
+    def remaining(self, key, so_far: float) -> float:
+        """ How much more is usually needed after so_far. 0 until something has been observed for the key. """
+        average = self.averages.get(key)
+        return max(average - so_far, 0.0) if average is not None else 0.0
+
+expected_costs = RunningAverages()
+
+@contextmanager
+def time_stage(stage: str):
+    """ Records how long the block takes in finllm_stage_duration_seconds. """
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.labels(stage).observe(time.perf_counter() - started_at)
+
+def timed_stage(stage: str):
+    """ Decorator version of time_stage() for async functions. """
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with time_stage(stage):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+async def monitor_event_loop_lag(interval_seconds: float = 0.1):
+    """ Runs for the life of the app, measuring how late each sleep wakes up. Anything blocking the event loop (sync IO,
+    heavy CPU work) shows up here, as it delays every stream on the pod. """
+    while True:
+        started_at = time.perf_counter()
+        await asyncio.sleep(interval_seconds)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - started_at - interval_seconds))
+
+def start_request_usage() -> dict:
+    """ Starts totalling LLM tokens for the current request. Returns the dict the totals are added to. """
+    usage = {"prompt_tokens": 0, "completion_tokens": 0}
+    request_usage.set(usage)
+    return usage
+
+def record_finished(kind: str, name: str, seconds: float, completion_tokens: int = None, model: str = None):
+    """ Records what a piece of work that ran to the end cost, for estimating the saving when the same work is cancelled. """
+    expected_costs.observe((kind, name, model, "seconds"), seconds)
+    if completion_tokens is not None:
+        expected_costs.observe((kind, name, model, "tokens"), completion_tokens)
+
+def expected_seconds(kind: str, name: str, model: str = None) -> float:
+    """ How long the work usually takes when it runs to the end, or None if none has finished yet. """
+    return expected_costs.averages.get((kind, name, model, "seconds"))
+
+def record_cancelled(kind: str, name: str, seconds: float, completion_tokens: int = None, model: str = None) -> tuple:
+    """ Records a piece of work being cancelled after running for seconds (and generating completion_tokens, for LLM
+    calls).
+
+    Returns:
+    - (tuple) the estimated seconds and completion tokens the cancellation saved. """
+
+    seconds_saved = expected_costs.remaining((kind, name, model, "seconds"), seconds)
+    CANCELLATIONS.labels(kind, name).inc()
+    CANCELLATION_SECONDS_SAVED.labels(kind, name).inc(seconds_saved)
+    tokens_saved = 0.0
+    if completion_tokens is not None:
+        tokens_saved = expected_costs.remaining((kind, name, model, "tokens"), completion_tokens)
+        CANCELLATION_TOKENS_SAVED.labels(name, model).inc(tokens_saved)
+    return seconds_saved, tokens_saved
+
+def record_llm_call(caller: str, model: str, seconds: float, prompt_tokens: int = 0, completion_tokens: int = 0, error: bool = False,
+                    cancelled: bool = False):
+    if cancelled: # Kept out of the duration histogram, which is for calls that ran to the end
+        record_cancelled("llm", caller, seconds, completion_tokens, model)
+    else:
+        LLM_CALL_DURATION.labels(caller, model).observe(seconds)
+        if error:
+            LLM_ERRORS.labels(caller, model).inc()
+        else:
+            record_finished("llm", caller, seconds, completion_tokens, model)
+    LLM_TOKENS.labels(caller, model, "prompt").inc(prompt_tokens)
+    LLM_TOKENS.labels(caller, model, "completion").inc(completion_tokens)
+
+    usage = request_usage.get()
+    if usage is not None:
+        usage["prompt_tokens"] += prompt_tokens
+        usage["completion_tokens"] += completion_tokens
+
+def record_request_usage(usage: dict):
+    REQUEST_TOKENS.labels("prompt").observe(usage["prompt_tokens"])
+    REQUEST_TOKENS.labels("completion").observe(usage["completion_tokens"])
+
+class ComponentStatsCollector:
+    """ Reads the caches', scheduler's and gateway's own stats() at scrape time. """
+
+    def describe(self):
+        # Stops the registry calling collect() when this is registered, which would import every service up front
+        return []
+
+    def collect(self):
+        # Imported here so importing the metrics module doesn't pull in (and initialise) every service
+        from backend_app.services.market_data.market_data_cache import market_data_cache
+        from backend_app.services.document_retrieval.embedding_service import embedding_service
+        from backend_app.services.document_retrieval.context_packer import context_packer
+        from backend_app.services.news.news_service import news_service
+        from backend_app.services.upstream.upstream_scheduler import upstream_scheduler
+        from backend_app.services.llm.llm_gateway import llm_gateway
+        from backend_app.services.chatbot.response_cache import response_cache
+        from backend_app.services.data_access_layer.api_connectors.financialmodelingprep_api_connector import fmp_connector
+        from backend_app.services.auth.user_cache import user_cache
+        from backend_app.services.chatbot.admission_control import admission_controller
+
+        hit_rate = GaugeMetricFamily("finllm_cache_hit_rate", "Cache hit rate since startup.", labels=["cache"])
+        entries = GaugeMetricFamily("finllm_cache_entries", "Entries held in the cache.", labels=["cache"])
+        lookups = CounterMetricFamily("finllm_cache_lookups", "Cache lookups, by result.", labels=["cache", "result"])
+
+        market_data = market_data_cache.stats()
+        hit_rate.add_metric(["market_data"], market_data["hit_rate"])
+        entries.add_metric(["market_data"], market_data["entries"])
+        for result in ("hits", "stale_hits", "misses", "coalesced", "fallbacks"):
+            lookups.add_metric(["market_data", result], market_data[result])
+
+        embeddings = embedding_service.stats()
+        hit_rate.add_metric(["query_embeddings"], embeddings["cache_hit_rate"])
+        entries.add_metric(["query_embeddings"], len(embedding_service.cache))
+        lookups.add_metric(["query_embeddings", "hits"], embeddings["cache_hits"])
+        lookups.add_metric(["query_embeddings", "misses"], embeddings["cache_misses"])
+
+        try:
+            summaries = news_service.summary_cache.stats()
+            hit_rate.add_metric(["news_summaries"], summaries["hit_rate"])
+            entries.add_metric(["news_summaries"], summaries["entries"])
+            lookups.add_metric(["news_summaries", "hits"], summaries["hits"])
+            lookups.add_metric(["news_summaries", "misses"], summaries["misses"])
+        except Exception as e:
+            print(f"Error reading news summary cache stats: {e}")
+
+        fundamentals = fmp_connector.stats()
+        hit_rate.add_metric(["fmp"], fundamentals["hit_rate"])
+        for result in ("cache_hits", "cache_misses", "stale_fallbacks"):
+            lookups.add_metric(["fmp", result.replace("cache_", "")], fundamentals[result])
+
+        users = user_cache.stats()
+        hit_rate.add_metric(["users"], users["hit_rate"])
+        entries.add_metric(["users"], users["entries"])
+        for result in ("hits", "misses", "invalidations"):
+            lookups.add_metric(["users", result], users[result])
+
+        if response_cache.enabled:
+            responses = response_cache.stats()
+            hit_rate.add_metric(["responses"], responses["hit_rate"])
+            entries.add_metric(["responses"], responses["entries"])
+            for result in ("hits", "misses", "stores", "evictions"):
+                lookups.add_metric(["responses", result], responses[result])
+
+        yield hit_rate
+        yield entries
+        yield lookups
+
+        packing = context_packer.stats()
+        yield CounterMetricFamily("finllm_filings_context_tokens_saved", "Tokens removed from retrieved filings context by packing.", value=packing["tokens_saved"])
+
+        queue_depth = GaugeMetricFamily("finllm_upstream_queue_depth", "Requests waiting for an upstream provider's rate limit.", labels=["provider"])
+        upstream_requests = CounterMetricFamily("finllm_upstream_requests", "Upstream requests, by outcome.", labels=["provider", "result"])
+        for provider, provider_stats in upstream_scheduler.stats().items():
+            queue_depth.add_metric([provider], provider_stats["queue_depth"])
+            for result in ("granted", "queued", "rejected", "throttled"):
+                upstream_requests.add_metric([provider, result], provider_stats[result])
+        yield queue_depth
+        yield upstream_requests
+
+        admission = admission_controller.stats()
+        yield GaugeMetricFamily("finllm_chat_active_streams", "Chat streams being answered by this worker.", value=admission["active"])
+        yield GaugeMetricFamily("finllm_chat_stream_capacity", "Chat streams this worker answers at once (CHAT_MAX_ACTIVE_STREAMS).", value=admission["max_active"])
+        chat_queue_depth = GaugeMetricFamily("finllm_chat_queue_depth", "Chat requests waiting for a stream slot, by priority.", labels=["priority"])
+        for priority, depth in admission["queue_depth"].items():
+            chat_queue_depth.add_metric([priority], depth)
+        yield chat_queue_depth
+        yield GaugeMetricFamily("finllm_chat_queue_oldest_wait_seconds", "How long the longest waiting chat request has been queued.", value=admission["oldest_wait_seconds"])
+        yield GaugeMetricFamily("finllm_chat_saturation", "Active plus queued chat streams over capacity. Above 1 means requests are queueing, the autoscaling target.", value=admission["saturation"])
+
+        gateway = llm_gateway.stats()
+        yield GaugeMetricFamily("finllm_llm_in_flight", "LLM calls in flight.", value=gateway["in_flight"])
+        yield GaugeMetricFamily("finllm_llm_waiting", "LLM calls waiting for a concurrency slot.", value=gateway["waiting"])
+
+REGISTRY.register(ComponentStatsCollector())
+
+def render_metrics() -> tuple:
+    """ Returns the metrics in the Prometheus text format, with its content type. """
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -1,69 +1,145 @@
 import os
-from typing import List, Dict, Optional
-import requests
-import openai
+from typing import AsyncIterator, List, Dict, Optional
+import httpx
 import asyncio
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
+from backend_app.services.news.summary_cache import SummaryCache, article_key
+from backend_app.services.llm.llm_gateway import llm_gateway
+from backend_app.services.monitoring.metrics import timed_stage
+from backend_app.services.upstream.upstream_scheduler import upstream_scheduler, UpstreamBudgetExceeded, UpstreamThrottled
+from collections import OrderedDict
+import time
+
+MAX_ARTICLES = 3 # Limit to 3 articles for faster response
+SUMMARY_CONCURRENCY = int(os.getenv("NEWS_SUMMARY_CONCURRENCY", 3)) # Summaries in flight at once, across all requests
+SUMMARY_TIMEOUT_SECONDS = float(os.getenv("NEWS_SUMMARY_TIMEOUT_SECONDS", 15))
+FETCH_TIMEOUT_SECONDS = float(os.getenv("NEWS_FETCH_TIMEOUT_SECONDS", 10))
+FEED_TTL_SECONDS = float(os.getenv("NEWS_FEED_TTL_SECONDS", 300)) # News doesn't move fast enough to need every request to go upstream
+MAX_CACHED_FEEDS = 256
+PROMPT_VERSION = "v2" # Bump whenever the summary prompt or model changes, so old cached summaries aren't reused
 
 class NewsService:
     def __init__(self):
-        self.alpha_vantage_key = None
-        self.base_url = "https://www.alphavantage.co/query"
-        self.client = openai.AsyncOpenAI()
+        self.alpha_vantage_key = os.getenv("ALPHA_VANTAGE_API_KEY")
+        self.base_url = os.getenv("ALPHA_VANTAGE_BASE_URL", "https://www.alphavantage.co/query")
+        self.http_client = None # Created on first use, so it's bound to the running event loop
+        self.summary_semaphore = None
+        self.summary_cache = SummaryCache()
+        self.in_flight = {} # Cache key to the task summarising that article, so concurrent requests share one LLM call
+        self.summary_waiters = {} # Cache key to the number of requests waiting on its summary
+        self.background_summaries = set() # Keys of summaries left to finish for the cache after a request timed out on them
+        self.feed_cache = OrderedDict() # (tickers, topics) to (fetched_at, articles), least recently used first
+
+    def get_http_client(self) -> httpx.AsyncClient:
+        """ Returns the shared HTTP client. Connections to Alpha Vantage are kept alive between requests, so we don't
+        pay for a new TCP + TLS handshake on every news lookup. """
+        if self.http_client is None or self.http_client.is_closed:
+            self.http_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(FETCH_TIMEOUT_SECONDS),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=30),
+            )
+        return self.http_client
 
-    async def summarize_article(self, article: Dict, user_message: str) -> Dict:
-        """Summarize a single article asynchronously, including the article link if available."""
+    def get_summary_semaphore(self) -> asyncio.Semaphore:
+        if self.summary_semaphore is None:
+            self.summary_semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+        return self.summary_semaphore
+
+    async def close(self):
+        """ Closes the pooled HTTP client. Called on app shutdown. """
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+
+    def build_summary(self, article: Dict, summary: str) -> Dict:
+        return {
+            "title": article.get("title", "Unknown Title"),
+            "summary": summary,
+            "timestamp": article.get("time_published", "Unknown Timestamp"),
+            "source": article.get("source", "Unknown Source"),
+            "url": article.get("url", "URL not provided"),  # Include the article link in the response
+            "relevance": {
+                "topics": [],
+                "tickers": []
+            }
+        }
+
+    @timed_stage("news_summary")
+    async def summarize_article(self, article: Dict) -> Dict:
+        """Summarize a single article asynchronously, including the article link if available.
+
+        The summary doesn't depend on the user's message, so it's cached and reused for everyone who asks about the
+        same article. The user's question is applied afterwards, when the chat model answers using these summaries."""
         print(f"Starting to summarize article: {article['title']}")
-        # Check if the URL is available in the article data
-        article_url = article.get("url", "URL not provided")
-        
+
         try:
             prompt = f"""
-            Given the context of this chat message: "{user_message}"
             Provide a concise 2-3 sentence summary of this financial news article:
             Title: {article['title']}
             Content: {article['summary']}
             """
-            
-            summary = await self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.7,
-                max_tokens=500
-            )
-            
+
+            async with self.get_summary_semaphore():
+                summary = await llm_gateway.create_chat(
+                    "news_summary",
+                    model="gpt-3.5-turbo",
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=0.7,
+                    max_tokens=500
+                )
+
+            summary_text = summary.choices[0].message.content.strip()
             print(f"Finished summarizing article: {article['title']}")
-            return {
-                "title": article["title"],
-                "summary": summary.choices[0].message.content.strip(),
-                "timestamp": article["time_published"],
-                "source": article["source"],
-                "url": article_url,  # Include the article link in the response
-                "relevance": {
-                    "topics": [],
-                    "tickers": []
-                }
-            }
         except Exception as e:
             print(f"Error summarizing article: {e}")
-            return {
-                "title": article.get("title", "Unknown Title"),
-                "summary": "Error generating summary.",
-                "timestamp": article.get("time_published", "Unknown Timestamp"),
-                "source": article.get("source", "Unknown Source"),
-                "url": article_url,  # Include the article link even in case of errors
-                "relevance": {
-                    "topics": [],
-                    "tickers": []
-                }
-            }
+            return self.build_summary(article, "Error generating summary.")
 
-    async def get_news_summaries(self, chat_context: Dict) -> List[Dict]:
-        print("Starting news retrieval")
+        try:
+            await asyncio.to_thread(self.summary_cache.set, article_key(article, PROMPT_VERSION), summary_text, article.get("url"))
+        except Exception as e:
+            print(f"Error writing to the summary cache: {e}")
+        return self.build_summary(article, summary_text)
+
+    def get_summary_task(self, article: Dict, key: str) -> asyncio.Task:
+        """ Returns the running summary for an article, starting one if nobody else is already summarising it. """
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self.summarize_article(article))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.finish_summary(key))
+        return task
+
+    def finish_summary(self, key: str):
+        self.in_flight.pop(key, None)
+        self.background_summaries.discard(key)
+
+    async def summarize_article_with_timeout(self, article: Dict, key: str) -> Dict:
+        """ Waits for an article's summary, falling back to Alpha Vantage's own summary if the model takes too long.
+        The summary itself carries on in the background so it still ends up in the cache.
+
+        If every request waiting on a summary is cancelled (their clients have gone away) it's cancelled too, rather than
+        paying for a summary nobody asked to keep. """
+        task = self.get_summary_task(article, key)
+        self.summary_waiters[key] = self.summary_waiters.get(key, 0) + 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout=SUMMARY_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            print(f"Summary timed out after {SUMMARY_TIMEOUT_SECONDS}s, using the source summary: {article.get('title')}")
+            if not task.done():
+                self.background_summaries.add(key)
+            return self.build_summary(article, article.get("summary") or "Summary not available.")
+        finally:
+            waiters = self.summary_waiters.pop(key) - 1
+            if waiters:
+                self.summary_waiters[key] = waiters
+            elif not task.done() and key not in self.background_summaries:
+                task.cancel()
+
+    @timed_stage("news_fetch")
+    async def fetch_articles(self, chat_context: Dict) -> List[Dict]:
         topics = chat_context.get('topics', [])
         tickers = chat_context.get('extracted_tickers', [])
-        user_message = chat_context.get('message', '')
 
         # might want to add some parameter here to refine when the news is extracted (i.e. within last day, week, etc.)
         # additionally lots of parameters are available which we can choose to pass into the api call
@@ -78,33 +154,88 @@ class NewsService:
         if topics:
             params["topics"] = ",".join(topics)
 
+        feed_key = (tuple(sorted(tickers)), tuple(sorted(topics)))
+        cached = self.feed_cache.get(feed_key)
+        if cached and time.monotonic() - cached[0] < FEED_TTL_SECONDS:
+            return cached[1]
+
         try:
+            await upstream_scheduler.acquire_async("alpha_vantage")
             print("Fetching news from Alpha Vantage")
-            response = requests.get(self.base_url, params=params)
+            response = await self.get_http_client().get(self.base_url, params=params)
             response.raise_for_status()
             news_data = response.json()
 
-            if "feed" not in news_data:
-                print("No news feed found in response")
-                return []
+            # Alpha Vantage returns 200 with a "Note" or "Information" message instead of a feed once we're over quota
+            if "feed" not in news_data and ("Note" in news_data or "Information" in news_data):
+                upstream_scheduler.report_throttled("alpha_vantage")
+                raise UpstreamThrottled(news_data.get("Note") or news_data.get("Information"))
+        except (UpstreamBudgetExceeded, UpstreamThrottled) as e:
+            # Out of budget, so serve the last feed we had for this search however old it is
+            if cached:
+                print(f"Alpha Vantage budget exhausted ({e}), serving cached news")
+                return cached[1]
+            raise
 
-            articles = news_data["feed"][:5]
-            print(f"Processing {len(articles)} articles")
+        if "feed" not in news_data:
+            print("No news feed found in response")
+            return []
+
+        articles = news_data["feed"][:MAX_ARTICLES]
+        self.feed_cache[feed_key] = (time.monotonic(), articles)
+        self.feed_cache.move_to_end(feed_key)
+        while len(self.feed_cache) > MAX_CACHED_FEEDS:
+            self.feed_cache.popitem(last=False)
+        return articles
+
+    async def stream_news_summaries(self, chat_context: Dict) -> AsyncIterator[Dict]:
+        """ Fetches the news and summarises the articles concurrently, yielding each summary as soon as it's ready
+        rather than waiting for the slowest one.
 
-            summaries = []
-            for article in articles:
-                summary = await self.summarize_article(article, user_message)
-                if summary:
-                    summaries.append(summary)
-                if len(summaries) >= 3:  # Limit to 3 articles for faster response
-                    break
+        Parameters:
+        - chat_context (dict): the 'message', 'extracted_tickers' and 'topics' to search for.
 
-            print(f"Successfully processed {len(summaries)} summaries")
-            return summaries
+        Returns:
+        - (AsyncIterator[dict]) article summaries, in the order they finish. """
+
+        print("Starting news retrieval")
 
+        try:
+            articles = await self.fetch_articles(chat_context)
         except Exception as e:
+            # Raised rather than treated as an empty feed, so the model doesn't tell the user there's no news
             print(f"Error fetching news: {str(e)}")
-            return []
+            raise
+
+        keys = [article_key(article, PROMPT_VERSION) for article in articles]
+        try:
+            cached = await asyncio.to_thread(self.summary_cache.get_many, keys)
+        except Exception as e:
+            print(f"Error reading the summary cache: {e}")
+            cached = {}
+
+        print(f"Processing {len(articles)} articles ({len(cached)} already summarised)")
+        for article, key in zip(articles, keys):
+            if key in cached:
+                yield self.build_summary(article, cached[key])
+
+        tasks = [
+            asyncio.create_task(self.summarize_article_with_timeout(article, key))
+            for article, key in zip(articles, keys) if key not in cached
+        ]
+        try:
+            for next_summary in asyncio.as_completed(tasks):
+                yield await next_summary
+        finally:
+            # The caller stopped early (or was cancelled). Summaries other requests are waiting on (or that timed out)
+            # still finish and are cached, see summarize_article_with_timeout
+            for task in tasks:
+                task.cancel()
+
+    async def get_news_summaries(self, chat_context: Dict) -> List[Dict]:
+        summaries = [summary async for summary in self.stream_news_summaries(chat_context)]
+        print(f"Successfully processed {len(summaries)} summaries")
+        return summaries
 
 # Initialize service
-news_service = NewsService()
\ No newline at end of file
+news_service = NewsService()
@@ -0,0 +1,128 @@
+""" Persistent cache of article summaries, shared by every user.
+
+Summaries are keyed by the article (its URL, or a hash of its title and content if there's no URL) plus the version of
+the summary prompt, so changing the prompt naturally misses the old entries. The summaries themselves don't depend on
+the user's message, which means the same Alpha Vantage article is only ever summarised once, however many people ask
+about that ticker.
+
+Stored in SQLite next to the app. Once the cache holds more than max_entries, the least recently used entries are
+evicted. """
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_PATH = os.getenv("NEWS_SUMMARY_CACHE_PATH", "./news_cache/summaries.sqlite3")
+MAX_ENTRIES = int(os.getenv("NEWS_SUMMARY_CACHE_MAX_ENTRIES", 5000))
+
+def article_key(article: dict, prompt_version: str) -> str:
+    """ Returns the cache key for an article.
+
+    Parameters:
+    - article (dict): the article from the Alpha Vantage feed.
+    - prompt_version (str): the version of the summary prompt.
+
+    Returns:
+    - (str) a sha256 hex digest. """
+
+    url = article.get("url")
+    identity = f"url:{url}" if url else f"content:{article.get('title', '')}\n{article.get('summary', '')}"
+    return hashlib.sha256(f"{prompt_version}\n{identity}".encode("utf-8")).hexdigest()
+
+class SummaryCache:
+    def __init__(self, path: str = CACHE_PATH, max_entries: int = MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def connect(self) -> sqlite3.Connection:
+        """ Opens the database on first use, creating the table if needed. Call with the lock held. """
+        if self.connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS summaries (
+                    key TEXT PRIMARY KEY,
+                    url TEXT,
+                    summary TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS summaries_last_used_at ON summaries (last_used_at)")
+            connection.commit()
+            self.connection = connection
+        return self.connection
+
+    def get_many(self, keys: list) -> dict:
+        """ Looks up several articles at once, marking any hits as recently used.
+
+        Returns:
+        - (dict) key to summary, for the keys that were found. """
+
+        if not keys:
+            return {}
+
+        with self.lock:
+            connection = self.connect()
+            placeholders = ",".join("?" * len(keys))
+            rows = connection.execute(f"SELECT key, summary FROM summaries WHERE key IN ({placeholders})", keys).fetchall()
+            found = dict(rows)
+            if found:
+                now = time.time()
+                connection.executemany("UPDATE summaries SET last_used_at = ? WHERE key = ?", [(now, key) for key in found])
+                connection.commit()
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key: str, summary: str, url: str = None):
+        with self.lock:
+            connection = self.connect()
+            now = time.time()
+            connection.execute(
+                "INSERT OR REPLACE INTO summaries (key, url, summary, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)",
+                (key, url, summary, now, now)
+            )
+            self.evict()
+            connection.commit()
+
+    def evict(self):
+        """ Drops the least recently used entries once the cache is over its size limit. Call with the lock held. """
+        count = self.connection.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                "DELETE FROM summaries WHERE key IN (SELECT key FROM summaries ORDER BY last_used_at LIMIT ?)", (excess,)
+            )
+            self.evictions += excess
+
+    def clear(self):
+        with self.lock:
+            connection = self.connect()
+            connection.execute("DELETE FROM summaries")
+            connection.commit()
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self.connect().execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+            }
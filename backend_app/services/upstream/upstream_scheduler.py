@@ -0,0 +1,253 @@
+""" Shared scheduler for requests to rate limited upstream providers (Alpha Vantage, Yahoo Finance, Financial Modeling Prep).
+
+Every upstream call first takes a token from its provider's buckets (e.g. Alpha Vantage's per-minute and per-day
+quotas), so bursts are paced out rather than tripping the provider's own throttling. Requests that can't go straight
+away queue in priority order, so interactive chat requests go ahead of background work (cache refreshes, ingestion).
+Each request has a deadline. If it can't be sent before the deadline (including when the daily quota has run out),
+UpstreamBudgetExceeded is raised straight away rather than making the user wait, and callers fall back to cached data.
+
+When a provider tells us we've been throttled anyway (Alpha Vantage's "Note"/"Information" payloads, Yahoo's 429s),
+report_throttled() pauses that provider for a cool-down period.
+
+Works from both threads (the market data tools run on the tool thread pool) and the event loop (NewsService). """
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# The priority of upstream requests made from the current thread/task, so background jobs don't have to pass it down
+# through every call. See background_priority()
+request_priority = ContextVar("request_priority", default=INTERACTIVE)
+
+POLL_INTERVAL_SECONDS = 0.05 # How often queued requests check whether it's their turn yet
+DEFAULT_THROTTLE_COOLDOWN_SECONDS = 60
+
+class UpstreamBudgetExceeded(Exception):
+    """ Raised when a request can't be sent to the provider before its deadline. """
+
+class UpstreamThrottled(Exception):
+    """ Raised when the provider tells us we've been rate limited. """
+
+@contextmanager
+def background_priority():
+    """ Runs any upstream requests made inside the block at background priority. """
+    token = request_priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    def seconds_until_available(self, now: float) -> float:
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate_per_second
+
+    def take(self):
+        self.tokens -= 1
+
+class Provider:
+    """ The buckets, queue and counters for one upstream provider. """
+
+    def __init__(self, name: str, buckets: list, interactive_deadline: float, background_deadline: float):
+        self.name = name
+        self.buckets = buckets
+        self.deadlines = {INTERACTIVE: interactive_deadline, BACKGROUND: background_deadline}
+        self.queue = [] # Heap of (priority, sequence number) for the requests waiting on this provider
+        self.blocked_until = 0.0 # Set when the provider throttles us
+
+        self.granted = 0
+        self.queued = 0 # Requests that had to wait for a token
+        self.rejected = 0
+        self.throttled = 0
+        self.total_wait_seconds = 0.0
+        self.max_queue_depth = 0
+
+    def seconds_until_available(self, now: float) -> float:
+        wait = max(0.0, self.blocked_until - now)
+        for bucket in self.buckets:
+            wait = max(wait, bucket.seconds_until_available(now))
+        return wait
+
+class UpstreamScheduler:
+    def __init__(self):
+        self.providers = {}
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+
+    def add_provider(self, name: str, buckets: list, interactive_deadline: float = 5.0, background_deadline: float = 60.0):
+        """ Registers a provider.
+
+        Parameters:
+        - name (str): the provider name used in acquire(), e.g. 'alpha_vantage'.
+        - buckets (list): TokenBuckets that must all have a token for a request to go, e.g. per minute and per day.
+        - interactive_deadline (float): how long an interactive request will wait for a token, in seconds.
+        - background_deadline (float): how long a background request will wait for a token, in seconds. """
+        self.providers[name] = Provider(name, buckets, interactive_deadline, background_deadline)
+
+    def try_acquire(self, provider: Provider, ticket: tuple, deadline: float) -> float:
+        """ Takes a token for the request if it's at the front of the queue and one is available.
+
+        Returns:
+        - (float) 0 if the request can go now, otherwise how long to wait before trying again. """
+
+        now = time.monotonic()
+        with self.lock:
+            wait = provider.seconds_until_available(now)
+            is_next = provider.queue[0] == ticket
+
+            if is_next and wait == 0:
+                heapq.heappop(provider.queue)
+                for bucket in provider.buckets:
+                    bucket.take()
+                provider.granted += 1
+                return 0.0
+
+            # No point queueing if the token won't be there in time (e.g. the daily quota has gone)
+            if now + (wait if is_next else 0) > deadline:
+                provider.queue.remove(ticket)
+                heapq.heapify(provider.queue)
+                provider.rejected += 1
+                raise UpstreamBudgetExceeded(f"No {provider.name} request budget available before the deadline")
+
+        return min(wait, POLL_INTERVAL_SECONDS) if wait else POLL_INTERVAL_SECONDS
+
+    def enqueue(self, name: str, priority: int = None, deadline_seconds: float = None):
+        provider = self.providers[name]
+        priority = request_priority.get() if priority is None else priority
+        deadline_seconds = provider.deadlines[priority] if deadline_seconds is None else deadline_seconds
+
+        ticket = (priority, next(self.sequence))
+        with self.lock:
+            heapq.heappush(provider.queue, ticket)
+            provider.max_queue_depth = max(provider.max_queue_depth, len(provider.queue))
+        return provider, ticket, time.monotonic() + deadline_seconds
+
+    def record_wait(self, provider: Provider, started_at: float):
+        waited = time.monotonic() - started_at
+        if waited > POLL_INTERVAL_SECONDS / 2:
+            with self.lock:
+                provider.queued += 1
+                provider.total_wait_seconds += waited
+
+    def acquire(self, name: str, priority: int = None, deadline_seconds: float = None):
+        """ Blocks until a request to the provider can be sent.
+
+        Parameters:
+        - name (str): the provider name.
+        - priority (int): INTERACTIVE or BACKGROUND. Defaults to the priority of the current context.
+        - deadline_seconds (float): the longest to wait. Defaults to the provider's deadline for the priority.
+
+        Raises:
+        - UpstreamBudgetExceeded if the request can't be sent before the deadline. """
+
+        if name not in self.providers:
+            return
+        started_at = time.monotonic()
+        provider, ticket, deadline = self.enqueue(name, priority, deadline_seconds)
+        while True:
+            wait = self.try_acquire(provider, ticket, deadline)
+            if wait == 0:
+                self.record_wait(provider, started_at)
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, name: str, priority: int = None, deadline_seconds: float = None):
+        """ The same as acquire(), but waits without blocking the event loop. """
+        if name not in self.providers:
+            return
+        started_at = time.monotonic()
+        provider, ticket, deadline = self.enqueue(name, priority, deadline_seconds)
+        try:
+            while True:
+                wait = self.try_acquire(provider, ticket, deadline)
+                if wait == 0:
+                    self.record_wait(provider, started_at)
+                    return
+                await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            with self.lock:
+                if ticket in provider.queue:
+                    provider.queue.remove(ticket)
+                    heapq.heapify(provider.queue)
+            raise
+
+    def report_throttled(self, name: str, cooldown_seconds: float = DEFAULT_THROTTLE_COOLDOWN_SECONDS):
+        """ Pauses a provider after it has told us we're over its limit. """
+        provider = self.providers.get(name)
+        if provider is None:
+            return
+        print(f"Upstream provider {name} throttled us, pausing requests for {cooldown_seconds}s")
+        with self.lock:
+            provider.throttled += 1
+            provider.blocked_until = max(provider.blocked_until, time.monotonic() + cooldown_seconds)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            return {
+                name: {
+                    "queue_depth": len(provider.queue),
+                    "max_queue_depth": provider.max_queue_depth,
+                    "granted": provider.granted,
+                    "queued": provider.queued,
+                    "rejected": provider.rejected,
+                    "throttled": provider.throttled,
+                    "average_wait_seconds": provider.total_wait_seconds / provider.queued if provider.queued else 0.0,
+                    "blocked_for_seconds": max(0.0, provider.blocked_until - now),
+                }
+                for name, provider in self.providers.items()
+            }
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """ Whether an exception from yfinance looks like Yahoo rate limiting us. yfinance doesn't give a consistent
+    exception type for this across versions, so we go on the name and message. """
+    text = f"{type(error).__name__} {error}".lower()
+    return "ratelimit" in text or "rate limit" in text or "too many requests" in text or "429" in text
+
+def create_upstream_scheduler() -> UpstreamScheduler:
+    scheduler = UpstreamScheduler()
+
+    # The free Alpha Vantage tier allows 5 requests a minute and 25 a day
+    per_minute = float(os.getenv("ALPHA_VANTAGE_REQUESTS_PER_MINUTE", 5))
+    per_day = float(os.getenv("ALPHA_VANTAGE_REQUESTS_PER_DAY", 25))
+    scheduler.add_provider("alpha_vantage", [
+        TokenBucket(per_minute / 60, per_minute),
+        TokenBucket(per_day / 86400, per_day),
+    ], interactive_deadline=float(os.getenv("ALPHA_VANTAGE_QUEUE_DEADLINE_SECONDS", 5)))
+
+    # Yahoo doesn't publish limits, this keeps bursts at a level it tolerates
+    per_second = float(os.getenv("YAHOO_REQUESTS_PER_SECOND", 2))
+    burst = float(os.getenv("YAHOO_BURST", 10))
+    scheduler.add_provider("yahoo", [TokenBucket(per_second, burst)],
+                           interactive_deadline=float(os.getenv("YAHOO_QUEUE_DEADLINE_SECONDS", 5)))
+
+    # Financial Modeling Prep's free tier allows 250 requests a day, paid plans allow 300 a minute
+    per_minute = float(os.getenv("FMP_REQUESTS_PER_MINUTE", 300))
+    per_day = float(os.getenv("FMP_REQUESTS_PER_DAY", 250))
+    scheduler.add_provider("fmp", [
+        TokenBucket(per_minute / 60, per_minute),
+        TokenBucket(per_day / 86400, per_day),
+    ], interactive_deadline=float(os.getenv("FMP_QUEUE_DEADLINE_SECONDS", 5)))
+    return scheduler
+
+upstream_scheduler = create_upstream_scheduler()
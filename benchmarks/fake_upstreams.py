@@ -0,0 +1,39 @@
+""" Fake upstream services for the /chat benchmark, served from one local process:
+
+- /openai/v1/...: the OpenAI-compatible stand-in from backend_app/services/llm/fake_openai_server.py.
+- /alphavantage/query: a NEWS_SENTIMENT feed with deterministic articles for the requested tickers.
+- /fmp/api/v3/...: the Financial Modeling Prep fixture server from
+  backend_app/services/data_access_layer/api_connectors/fmp_fixture_server.py.
+
+Run by run_chat_benchmark.py, but can be started on its own with:
+
+    uvicorn benchmarks.fake_upstreams:app --port 8001 """
+
+from fastapi import FastAPI, Request
+from backend_app.services.llm import fake_openai_server
+from backend_app.services.data_access_layer.api_connectors import fmp_fixture_server
+import asyncio
+import os
+
+ALPHA_VANTAGE_LATENCY_SECONDS = float(os.getenv("FAKE_ALPHA_VANTAGE_LATENCY_MS", 150)) / 1000
+ARTICLES_PER_FEED = 5
+
+app = FastAPI()
+app.mount("/openai", fake_openai_server.app)
+app.mount("/fmp", fmp_fixture_server.app)
+
+@app.get("/alphavantage/query")
+async def alpha_vantage_query(request: Request):
+    await asyncio.sleep(ALPHA_VANTAGE_LATENCY_SECONDS)
+    tickers = request.query_params.get("tickers") or "MARKET"
+    feed = []
+    for ticker in tickers.split(","):
+        for index in range(ARTICLES_PER_FEED):
+            feed.append({
+                "title": f"{ticker} article {index}",
+                "url": f"https://news.example.com/{ticker.lower()}/{index}",
+                "time_published": "20240102T150000",
+                "source": "Benchmark Wire",
+                "summary": f"{ticker} shares moved after the company updated its guidance. " * 4,
+            })
+    return {"items": str(len(feed)), "feed": feed}
@@ -0,0 +1,419 @@
+""" Load test for the /chat streaming path. Run from the repository root with:
+
+    python -m benchmarks.run_chat_benchmark --conversations 100 --concurrency 50
+
+This starts the fake upstreams (fake_upstreams.py: an OpenAI-compatible streaming server driven by tool_script.json,
+and an Alpha Vantage news feed) and then backend_app.app with the fake market data and vectorstore backends, so no
+API keys or network access are needed. It drives N concurrent multi-turn conversations through /chat and reports:
+
+- time to first token (p50/p95/p99) and total stream time, as seen by the client,
+- tokens/s, per stream and across the whole run,
+- token events per turn, i.e. how far the answer's text was coalesced into fewer writes,
+- event loop lag in the backend (from its /metrics),
+- backend memory before and after the run,
+- how many requests admission control turned away (HTTP 503), and how long admitted ones waited for a stream slot.
+  Set CHAT_MAX_ACTIVE_STREAMS below the concurrency to see it queueing and shedding.
+
+With --regenerate-rate, that fraction of turns is dropped after its first token and sent again, like a user hitting
+regenerate, and the report includes what the backend cancelled as a result (and its estimate of what that saved).
+
+Each run is saved to benchmarks/results/<timestamp>_<commit>.json and compared with the most recent run from a
+different commit that used the same settings, so regressions show up as a diff. """
+
+from backend_app.services.chatbot.token_utils import estimate_tokens
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import httpx
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIRECTORY = os.path.join(REPOSITORY_ROOT, "benchmarks", "results")
+TOOL_SCRIPT_PATH = os.path.join(REPOSITORY_ROOT, "benchmarks", "tool_script.json")
+
+# Cycled through by the conversations. Each matches a rule in tool_script.json, so the mix covers plain answers, quotes,
+# history charts, batched tools, news, filings retrieval and the agent orchestrator
+PROMPTS = [
+    "What is the price of AAPL right now?",
+    "Show me the history of MSFT this year.",
+    "Compare NVDA and AMD for me.",
+    "Any news about TSLA today?",
+    "Summarise the latest filings for TSLA.",
+    "Break down the fundamentals of AAPL and MSFT.",
+    "How should I think about duration risk in a bond portfolio?",
+]
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values: list, fraction: float) -> float:
+    """ Nearest-rank percentile. """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+def summarise(values: list, scale: float = 1.0) -> dict:
+    return {
+        "p50": round(percentile(values, 0.50) * scale, 2),
+        "p95": round(percentile(values, 0.95) * scale, 2),
+        "p99": round(percentile(values, 0.99) * scale, 2),
+        "mean": round(sum(values) / len(values) * scale, 2) if values else 0.0,
+        "max": round(max(values) * scale, 2) if values else 0.0,
+    }
+
+def current_commit() -> str:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY_ROOT, text=True).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPOSITORY_ROOT, text=True).strip()
+        return f"{commit}-dirty" if dirty else commit
+    except Exception:
+        return "unknown"
+
+def start_process(module_app: str, port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module_app, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=REPOSITORY_ROOT, env={**os.environ, **env},
+    )
+
+async def wait_until_ready(url: str, process: subprocess.Popen, timeout_seconds: float = 60):
+    deadline = time.monotonic() + timeout_seconds
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"Process for {url} exited with code {process.returncode}")
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+async def scrape_metrics(client: httpx.AsyncClient, base_url: str) -> dict:
+    """ Reads the backend's memory, event loop lag and admission wait histograms, and cancellation counts from /metrics. """
+    from prometheus_client.parser import text_string_to_metric_families
+
+    response = await client.get(f"{base_url}/metrics")
+    scraped = {"memory_bytes": None, "lag_buckets": {}, "cancellations": {}, "seconds_saved": {}, "tokens_saved": 0.0, "admission_wait_buckets": {}}
+    for family in text_string_to_metric_families(response.text):
+        for sample in family.samples:
+            if sample.name == "process_resident_memory_bytes":
+                scraped["memory_bytes"] = sample.value
+            elif sample.name == "finllm_event_loop_lag_seconds_bucket":
+                scraped["lag_buckets"][float(sample.labels["le"])] = sample.value
+            elif sample.name == "finllm_cancellations_total":
+                kind = sample.labels["kind"]
+                scraped["cancellations"][kind] = scraped["cancellations"].get(kind, 0) + sample.value
+            elif sample.name == "finllm_cancellation_seconds_saved_total":
+                kind = sample.labels["kind"]
+                scraped["seconds_saved"][kind] = scraped["seconds_saved"].get(kind, 0) + sample.value
+            elif sample.name == "finllm_cancellation_tokens_saved_total":
+                scraped["tokens_saved"] += sample.value
+            elif sample.name == "finllm_chat_admission_wait_seconds_bucket": # Summed over priorities
+                bound = float(sample.labels["le"])
+                scraped["admission_wait_buckets"][bound] = scraped["admission_wait_buckets"].get(bound, 0) + sample.value
+    return scraped
+
+def histogram_quantile(before: dict, after: dict, fraction: float) -> float:
+    """ Estimates a quantile from the change in a cumulative histogram over the run, as the upper bound of the bucket
+    it falls in (like Prometheus' histogram_quantile, without interpolation). """
+    bounds = sorted(after)
+    counts = [after[bound] - before.get(bound, 0) for bound in bounds]
+    if not counts or counts[-1] <= 0:
+        return 0.0
+    target = fraction * counts[-1]
+    for bound, count in zip(bounds, counts):
+        if count >= target:
+            return bound if bound != float("inf") else bounds[-2]
+    return bounds[-2]
+
+def parse_event(raw_event: str):
+    """ Splits one server-sent event into its type and JSON body. """
+    event_type, data = "message", ""
+    for line in raw_event.split("\n"):
+        if line.startswith("event:"):
+            event_type = line[6:].strip()
+        elif line.startswith("data:"):
+            data += line[5:].strip()
+    return event_type, json.loads(data) if data else None
+
+async def run_turn(client: httpx.AsyncClient, base_url: str, conversation_id: str, messages: list, abandon: bool = False) -> dict:
+    started_at = time.perf_counter()
+    first_token_at = None
+    text = []
+    ui_payloads = 0
+    token_events = 0
+    status = None
+    buffer = ""
+
+    async with client.stream("POST", f"{base_url}/chat", json={"conversation_id": conversation_id, "message": messages}) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return {"error": f"HTTP {response.status_code}"}
+        async for chunk in response.aiter_text():
+            buffer += chunk
+            *raw_events, buffer = buffer.split("\n\n") # The last piece is an incomplete event, if any
+            for raw_event in raw_events:
+                event_type, payload = parse_event(raw_event)
+                if event_type == "token":
+                    if abandon: # Closing the response drops the connection, as a browser does when the request is aborted
+                        return {"abandoned": True}
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter() # UI payloads from tools don't count, this is the first answer token
+                    token_events += 1
+                    text.append(payload["text"])
+                elif event_type == "ui":
+                    ui_payloads += 1
+                elif event_type == "error":
+                    return {"error": f"error event: {payload['message']}"}
+                elif event_type == "done":
+                    status = payload["status"]
+
+    if status is None:
+        return {"error": "stream ended without a done event"}
+    finished_at = time.perf_counter()
+    answer = "".join(text)
+    tokens = estimate_tokens(answer)
+    streaming_seconds = finished_at - (first_token_at or finished_at)
+    return {
+        "ttft": (first_token_at or finished_at) - started_at,
+        "duration": finished_at - started_at,
+        "tokens": tokens,
+        "tokens_per_second": tokens / streaming_seconds if streaming_seconds > 0 else None,
+        "token_events": token_events,
+        "ui_payloads": ui_payloads,
+        "answer": answer,
+    }
+
+async def run_conversation(client: httpx.AsyncClient, base_url: str, index: int, turns: int, semaphore: asyncio.Semaphore,
+                           regenerate_rate: float = 0.0) -> list:
+    conversation_id = str(uuid.uuid4())
+    messages = []
+    results = []
+    regenerate = random.Random(index) # Seeded, so runs with the same settings regenerate the same turns
+    async with semaphore:
+        for turn in range(turns):
+            messages.append({"role": "user", "content": PROMPTS[(index + turn) % len(PROMPTS)]})
+            try:
+                regenerated = regenerate.random() < regenerate_rate
+                if regenerated:
+                    await run_turn(client, base_url, conversation_id, messages, abandon=True)
+                result = await run_turn(client, base_url, conversation_id, messages)
+                result["regenerated"] = regenerated
+            except Exception as e:
+                result = {"error": f"{type(e).__name__}: {e}"}
+            results.append(result)
+            if "error" in result:
+                break
+            messages.append({"role": "assistant", "content": result.pop("answer")})
+    return results
+
+async def run_load(base_url: str, conversations: int, concurrency: int, turns: int, regenerate_rate: float = 0.0) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(120.0), limits=limits) as client:
+        before = await scrape_metrics(client, base_url)
+        started_at = time.perf_counter()
+        conversation_results = await asyncio.gather(*[
+            run_conversation(client, base_url, index, turns, semaphore, regenerate_rate) for index in range(conversations)
+        ])
+        wall_seconds = time.perf_counter() - started_at
+        await asyncio.sleep(0.5) # Let the lag monitor record the tail of the run
+        after = await scrape_metrics(client, base_url)
+
+    turn_results = [result for results in conversation_results for result in results]
+    succeeded = [result for result in turn_results if "error" not in result]
+    errors = [result["error"] for result in turn_results if "error" in result]
+    total_tokens = sum(result["tokens"] for result in succeeded)
+    memory_before = before["memory_bytes"] or 0
+    memory_after = after["memory_bytes"] or 0
+
+    return {
+        "requests": len(turn_results),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "rejected": sum(1 for error in errors if error == "HTTP 503"),
+        "admission_wait_ms": {
+            "p95": round(histogram_quantile(before["admission_wait_buckets"], after["admission_wait_buckets"], 0.95) * 1000, 2),
+        },
+        "wall_seconds": round(wall_seconds, 2),
+        "requests_per_second": round(len(succeeded) / wall_seconds, 2) if wall_seconds else 0.0,
+        "ttft_ms": summarise([result["ttft"] for result in succeeded], 1000),
+        "duration_ms": summarise([result["duration"] for result in succeeded], 1000),
+        "tokens_per_second": {
+            "per_stream": summarise([result["tokens_per_second"] for result in succeeded if result["tokens_per_second"]]),
+            "aggregate": round(total_tokens / wall_seconds, 1) if wall_seconds else 0.0,
+        },
+        "token_events_per_turn": summarise([result["token_events"] for result in succeeded]),
+        "event_loop_lag_ms": {
+            "p50": round(histogram_quantile(before["lag_buckets"], after["lag_buckets"], 0.50) * 1000, 2),
+            "p95": round(histogram_quantile(before["lag_buckets"], after["lag_buckets"], 0.95) * 1000, 2),
+            "p99": round(histogram_quantile(before["lag_buckets"], after["lag_buckets"], 0.99) * 1000, 2),
+        },
+        "memory_mb": {
+            "before": round(memory_before / 2 ** 20, 1),
+            "after": round(memory_after / 2 ** 20, 1),
+            "growth": round((memory_after - memory_before) / 2 ** 20, 1),
+        },
+        "regenerated_turns": sum(1 for result in succeeded if result.get("regenerated")),
+        "cancellations": {kind: round(after["cancellations"].get(kind, 0) - before["cancellations"].get(kind, 0)) for kind in ("chat", "tool", "llm")},
+        "seconds_saved": {kind: round(after["seconds_saved"].get(kind, 0) - before["seconds_saved"].get(kind, 0), 2) for kind in ("chat", "tool", "llm")},
+        "tokens_saved": round(after["tokens_saved"] - before["tokens_saved"]),
+    }
+
+def config_key(config: dict) -> str:
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+
+def previous_result(config: dict, commit: str):
+    """ The most recent saved run with the same settings from a different commit. """
+    if not os.path.isdir(RESULTS_DIRECTORY):
+        return None
+    for filename in sorted(os.listdir(RESULTS_DIRECTORY), reverse=True):
+        if not filename.endswith(".json"):
+            continue
+        with open(os.path.join(RESULTS_DIRECTORY, filename), "r") as result_file:
+            result = json.load(result_file)
+        if result.get("config_key") == config_key(config) and result.get("commit") != commit:
+            return result
+    return None
+
+def print_report(result: dict, baseline: dict = None):
+    rows = [
+        ("TTFT p50 (ms)", ("ttft_ms", "p50")),
+        ("TTFT p95 (ms)", ("ttft_ms", "p95")),
+        ("TTFT p99 (ms)", ("ttft_ms", "p99")),
+        ("Stream p95 (ms)", ("duration_ms", "p95")),
+        ("Tokens/s per stream (p50)", ("tokens_per_second", "per_stream", "p50")),
+        ("Tokens/s aggregate", ("tokens_per_second", "aggregate")),
+        ("Token events/turn (p50)", ("token_events_per_turn", "p50")),
+        ("Event loop lag p99 (ms)", ("event_loop_lag_ms", "p99")),
+        ("Memory growth (MB)", ("memory_mb", "growth")),
+        ("Requests/s", ("requests_per_second",)),
+        ("Regenerated turns", ("regenerated_turns",)),
+        ("Chat streams cancelled", ("cancellations", "chat")),
+        ("LLM calls cancelled", ("cancellations", "llm")),
+        ("Tokens saved (estimated)", ("tokens_saved",)),
+        ("Admission wait p95 (ms)", ("admission_wait_ms", "p95")),
+        ("Rejected (HTTP 503)", ("rejected",)),
+        ("Errors", ("errors",)),
+    ]
+
+    def lookup(data, path):
+        for key in path:
+            if not isinstance(data, dict) or key not in data:
+                return None # Not recorded by older runs
+            data = data[key]
+        return data
+
+    print(f"\nBenchmark at {result['commit']} ({result['config']['conversations']} conversations, concurrency {result['config']['concurrency']})")
+    if baseline:
+        print(f"Compared with {baseline['commit']} ({baseline['timestamp']})")
+    for label, path in rows:
+        value = lookup(result["results"], path)
+        line = f"  {label:<28}{value:>10}"
+        if baseline:
+            previous = lookup(baseline["results"], path)
+            change = f"{(value - previous) / previous * 100:+.1f}%" if previous else "n/a"
+            line += f"{previous if previous is not None else 'n/a':>10}  {change}"
+        print(line)
+
+async def main_async(args):
+    upstream_port, backend_port = free_port(), free_port()
+    config = {
+        "conversations": args.conversations,
+        "concurrency": args.concurrency,
+        "turns": args.turns,
+        "ttft_ms": args.ttft_ms,
+        "token_delay_ms": args.token_delay_ms,
+        "response_tokens": args.response_tokens,
+        "tool_script": os.path.relpath(args.tool_script, REPOSITORY_ROOT),
+    }
+    if args.regenerate_rate:
+        config["regenerate_rate"] = args.regenerate_rate # Only when set, so earlier runs still match as baselines
+
+    upstream_env = {
+        "FAKE_OPENAI_TTFT_MS": str(args.ttft_ms),
+        "FAKE_OPENAI_TOKEN_DELAY_MS": str(args.token_delay_ms),
+        "FAKE_OPENAI_RESPONSE_TOKENS": str(args.response_tokens),
+        "FAKE_OPENAI_TOOL_SCRIPT": args.tool_script,
+    }
+    scratch_directory = tempfile.mkdtemp(prefix="finllm-benchmark-")
+    backend_env = {
+        "LLM_BACKEND": "fake",
+        "FAKE_OPENAI_BASE_URL": f"http://127.0.0.1:{upstream_port}/openai/v1",
+        "OPENAI_API_KEY": "fake",
+        "MARKET_DATA_BACKEND": "fake",
+        "MARKET_DATA_STORE_DIRECTORY": os.path.join(scratch_directory, "market_data_store"),
+        "VECTORSTORE_BACKEND": "fake",
+        "EMBEDDING_WARM_START": "false",
+        "ALPHA_VANTAGE_BASE_URL": f"http://127.0.0.1:{upstream_port}/alphavantage/query",
+        "ALPHA_VANTAGE_API_KEY": "fake",
+        "ALPHA_VANTAGE_REQUESTS_PER_MINUTE": "100000", # The fake feed has no quota
+        "ALPHA_VANTAGE_REQUESTS_PER_DAY": "100000000",
+        "NEWS_SUMMARY_CACHE_PATH": os.path.join(scratch_directory, "summaries.sqlite3"),
+        "FMP_BASE_URL": f"http://127.0.0.1:{upstream_port}/fmp/api/v3",
+        "FMP_API_KEY": "fake",
+        "FMP_CACHE_DIR": os.path.join(scratch_directory, "fmp_cache"),
+        "FMP_REQUESTS_PER_DAY": "100000000",
+        "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(scratch_directory, 'goose.sqlite3')}", # Conversations are saved after each turn
+    }
+
+    upstream = start_process("benchmarks.fake_upstreams:app", upstream_port, upstream_env)
+    backend = start_process("backend_app.app:app", backend_port, backend_env)
+    base_url = f"http://127.0.0.1:{backend_port}"
+    try:
+        await wait_until_ready(f"http://127.0.0.1:{upstream_port}/openai/docs", upstream)
+        await wait_until_ready(f"{base_url}/health", backend)
+        results = await run_load(base_url, args.conversations, args.concurrency, args.turns, args.regenerate_rate)
+    finally:
+        for process in (backend, upstream):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    commit = current_commit()
+    result = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": config,
+        "config_key": config_key(config),
+        "results": results,
+    }
+    baseline = previous_result(config, commit)
+
+    os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+    result_path = os.path.join(RESULTS_DIRECTORY, f"{time.strftime('%Y%m%d-%H%M%S')}_{commit}.json")
+    with open(result_path, "w") as result_file:
+        json.dump(result, result_file, indent=2)
+
+    print_report(result, baseline)
+    print(f"\nSaved to {os.path.relpath(result_path, REPOSITORY_ROOT)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the /chat streaming path against fake upstreams.")
+    parser.add_argument("--conversations", type=int, default=50, help="Number of conversations to run.")
+    parser.add_argument("--concurrency", type=int, default=25, help="Conversations in flight at once.")
+    parser.add_argument("--turns", type=int, default=2, help="User messages per conversation.")
+    parser.add_argument("--ttft-ms", type=float, default=200, help="Fake model delay before its first token.")
+    parser.add_argument("--token-delay-ms", type=float, default=10, help="Fake model delay between tokens.")
+    parser.add_argument("--response-tokens", type=int, default=60, help="Tokens in each fake text answer.")
+    parser.add_argument("--regenerate-rate", type=float, default=0.0, help="Fraction of turns dropped after the first token and sent again.")
+    parser.add_argument("--tool-script", default=TOOL_SCRIPT_PATH, help="Fake model tool call script (see fake_openai_server.py).")
+    asyncio.run(main_async(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
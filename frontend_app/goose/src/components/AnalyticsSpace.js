@@ -26,6 +26,7 @@ import React, { useState, useEffect } from 'react';
 import { Tabs, Tab, Button } from 'react-bootstrap';
 import TickerComponent from './analytics_components/TickerComponent';
 import HistoricalChartComponent from './analytics_components/HistoricalChartComponent';
+import PortfolioComponent from './analytics_components/PortfolioComponent';
 
 function AnalyticsSpace({ activeUIElement }) {
   const [activeTabs, setActiveTabs] = useState([]); // State to manage open tabs
@@ -96,6 +97,7 @@ function AnalyticsSpace({ activeUIElement }) {
             <div>
               {tab.ui_type === 'ticker' && <TickerComponent uiElement={tab} />}
               {tab.ui_type === 'line_chart' && <HistoricalChartComponent uiElement={tab} />}
+              {tab.ui_type === 'portfolio' && <PortfolioComponent uiElement={tab} />}
               {/* Add more conditions for other component types */}
             </div>
           </Tab>
@@ -16,6 +16,8 @@ function ChatContainer( { setActiveUIElement, setNewsData }) {
   const [input, setInput] = useState('');
   const [messages, setMessages] = useState([]); // state variable 'messages', set by 'setMessages'
   const chatWindowRef = useRef(null);
+  const conversationIdRef = useRef(crypto.randomUUID()); // Identifies this conversation to the backend, which keeps the history for each conversation separately
+  const streamControllerRef = useRef(null); // Aborts the answer that's streaming, so the backend stops generating it
   const maxHistoryLength = 5;
 
   // handleSendMessage called when 'Send' is clicked or the enter key is pressed in the prompt entry textbox
@@ -53,81 +55,104 @@ function ChatContainer( { setActiveUIElement, setNewsData }) {
 
     const apiUrl = process.env.REACT_APP_API_URL; // add REACT_APP_API_URL=http://127.0.0.1:8000 to .env for local to work, within goosedlegs
     console.log("API URL:", process.env.REACT_APP_API_URL);
+
+    // A new message replaces any answer still streaming. Aborting closes the connection, which cancels it on the backend
+    if (streamControllerRef.current) streamControllerRef.current.abort();
+    const controller = new AbortController();
+    streamControllerRef.current = controller;
+
     fetch(`${apiUrl}/chat`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ message: context })
+      body: JSON.stringify({ conversation_id: conversationIdRef.current, message: context }),
+      signal: controller.signal
     })
       .then(response => {
+        // The backend turns requests away when it's too busy, saying when to try again
+        if (response.status === 503) {
+          const retryAfter = response.headers.get('Retry-After') || 'a few';
+          setMessages(prevMessages => [...prevMessages, { sender: 'bot', text: `The assistant is busy right now, please try again in ${retryAfter} seconds.` }]);
+          return;
+        }
+        if (!response.ok) throw new Error(`Chat request failed with HTTP ${response.status}`);
         if (!response.body) throw new Error('ReadableStream not supported');
         const reader = response.body.getReader();
         const decoder = new TextDecoder('utf-8');
         let accumulatedText = '';
         let isFirstChunk = true;
+        let buffer = ''; // Received text that doesn't yet make up a whole event
+
+        // Shows the answer so far, formatted for Markdown on the go
+        // If it's the first text of the response, create a new entry in 'messages' with the sender 'bot'
+        // Performs a check to see if the last message was a bot message, in which case append chunks to that instead of creating a new message (fixes duplication bug)
+        // Each time setMessages() is called, the state of 'messages' is changed and the component is re-rendered to show the next text
+        function showText() {
+          const formattedChunk = marked.parse(accumulatedText);
+          if (isFirstChunk) {
+            setMessages(prevMessages => {
+              const lastMessage = prevMessages[prevMessages.length - 1];
+              if (lastMessage && lastMessage.sender === 'bot') {
+                lastMessage.text = formattedChunk;
+                isFirstChunk = false;
+                return [...prevMessages];
+              } else {
+                const updatedMessages = [...prevMessages, { sender: 'bot', text: formattedChunk }];
+                isFirstChunk = false;
+                return updatedMessages;
+              }
+            });
+          } else {
+            setMessages(prevMessages => {
+              const updatedMessages = [...prevMessages];
+              updatedMessages[updatedMessages.length - 1].text = formattedChunk;
+              return updatedMessages;
+            });
+          }
+          chatWindowRef.current.scrollTop = chatWindowRef.current.scrollHeight;
+        }
+
+        // The backend sends server-sent events, each an 'event:' line naming the type and a 'data:' line of JSON:
+        // token (answer text), ui (a genUI object), usage (tokens used), error, and done (always last)
+        function handleEvent(rawEvent) {
+          let eventType = 'message';
+          let data = '';
+          for (const line of rawEvent.split('\n')) {
+            if (line.startsWith('event:')) eventType = line.slice(6).trim();
+            else if (line.startsWith('data:')) data += line.slice(5).trim();
+          }
+          if (!data) return;
+          const payload = JSON.parse(data);
+
+          if (eventType === 'token') {
+            accumulatedText += payload.text;
+            showText();
+          } else if (eventType === 'ui') {
+            if (payload.target === "news_space") {
+              setNewsData(payload);  // We need this prop from Workspace
+            } else {
+              setActiveUIElement(payload);
+            }
+          } else if (eventType === 'error') {
+            accumulatedText += `\n\n*${payload.message}*`;
+            showText();
+          } else if (eventType === 'usage') {
+            console.log('Tokens used:', payload.total_tokens);
+          }
+        }
 
         function readChunk() {
           reader.read().then(({ done, value }) => {
-            
-            // Check the value (chunk) contains data
-            if (value) {
 
-              // Initialises an instance of TextDecoder, taking value (chunk) and converting into text string
-              // stream:true allows decoder to handle streaming data
-              const chunk = decoder.decode(value, { stream: true });
-
-              // We use this to handle JSON objects passed through the stream (i.e., for our genUI objects)
-              // Try to parse each chunk as a JSON object, and if it contains a field 'ui_type', then generate a widget
-              // After handling the UI object, continue to read chunks
-              try {
-                const parsedJson = JSON.parse(chunk);
-                if (parsedJson.ui_type) {
-                    if (parsedJson.target === "news_space") {
-                        setNewsData(parsedJson);  // We need this prop from Workspace
-                    } else {
-                        setActiveUIElement(parsedJson);
-                    }
-                    readChunk();
-                    return;
-                } else {
-                    throw new Error();
-                }
-            } catch (e) {
-                // Not JSON, proceed with normal handling
+            // stream:true allows the decoder to handle characters split across chunks
+            if (value) {
+              buffer += decoder.decode(value, { stream: true });
+              // Events end with a blank line, anything after the last one is kept until the rest arrives
+              const events = buffer.split('\n\n');
+              buffer = events.pop();
+              events.forEach(handleEvent);
             }
 
-              // Decoded text is appended to an accumulator to build up the response
-              // Formatted for Markdown on the go 
-              accumulatedText += chunk;
-              const formattedChunk = marked.parse(accumulatedText);
-        
-              // If the first chunk of response, create a new entry in 'messages' with the sender 'bot' 
-              // Performs a check to see if the last message was a bot message, in which case append chunks to that instead of creating a new message (fixes duplication bug)
-              // Each time setMessages() is called, the state of 'messages' is changed and the component is re-rendered to show the next text
-              if (isFirstChunk) {
-                setMessages(prevMessages => {
-                  const lastMessage = prevMessages[prevMessages.length - 1];
-                  if (lastMessage && lastMessage.sender === 'bot') {
-                    lastMessage.text = formattedChunk;
-                    isFirstChunk = false;
-                    return [...prevMessages];
-                  } else {
-                    const updatedMessages = [...prevMessages, { sender: 'bot', text: formattedChunk }];
-                    isFirstChunk = false; 
-                    return updatedMessages;
-                  }
-                });
-              } else {
-                setMessages(prevMessages => {
-                  const updatedMessages = [...prevMessages];
-                  updatedMessages[updatedMessages.length - 1].text = formattedChunk; 
-                  return updatedMessages;
-                });
-              }
-        
-              chatWindowRef.current.scrollTop = chatWindowRef.current.scrollHeight;
-            }
-        
-            // Once the stream is done apply any final cleaning up (Markdown, trim whitespace) - we could probably remove this
+            // Once the stream is done apply any final cleaning up (Markdown, trim whitespace)
             if (done) {
               if (accumulatedText.trim()) {
                 setMessages(prevMessages => {
@@ -140,6 +165,7 @@ function ChatContainer( { setActiveUIElement, setNewsData }) {
             }
             readChunk();
           }).catch(error => {
+            if (error.name === 'AbortError') return; // Replaced by a newer message
             console.error('Stream read error:', error);
             setMessages(prevMessages => [...prevMessages, { sender: 'bot', text: 'An error occurred while streaming the response.' }]);
           });
@@ -147,6 +173,7 @@ function ChatContainer( { setActiveUIElement, setNewsData }) {
         readChunk();
       })
       .catch(error => {
+        if (error.name === 'AbortError') return;
         console.error('Fetch error:', error);
         setMessages(prevMessages => [...prevMessages, { sender: 'bot', text: 'An error occurred while fetching the response.' }]);
       });
@@ -165,7 +192,14 @@ function ChatContainer( { setActiveUIElement, setNewsData }) {
     }
   }, [messages]);
 
-  // Event listener for clicked links 
+  // Abort any answer still streaming when the chat is closed
+  useEffect(() => {
+    return () => {
+      if (streamControllerRef.current) streamControllerRef.current.abort();
+    };
+  }, []);
+
+  // Event listener for clicked links
   useEffect(() => {
     const handleLinkClick = (event) => {
       const target = event.target;
@@ -27,24 +27,33 @@ function HistoricalChartComponent({ uiElement }) {
     return <p>No data available for charting.</p>;
   }
 
+  // Single series charts are a list of {date, close} points. Multi-series charts (from the batch tools) are
+  // {labels: [dates], series: [{label, data: [closes]}]}, with every series lined up against the same dates
+  const isMultiSeries = !Array.isArray(uiElement.ui_content);
+
   // Extract data for the chart
-  const dates = uiElement.ui_content.map(dataPoint => dataPoint.date);
-  const prices = uiElement.ui_content.map(dataPoint => dataPoint.close);
+  const dates = isMultiSeries
+    ? uiElement.ui_content.labels
+    : uiElement.ui_content.map(dataPoint => dataPoint.date);
+  const series = isMultiSeries
+    ? uiElement.ui_content.series
+    : [{ label: uiElement.ui_title || 'Stock Price Over Time', data: uiElement.ui_content.map(dataPoint => dataPoint.close) }];
+
+  const lineColours = ['#FF5733', '#3366CC', '#109618', '#990099', '#FF9900', '#0099C6', '#DD4477', '#66AA00'];
 
   // Prepare chart data
   const data = {
     labels: dates,
-    datasets: [
-      {
-        label: uiElement.ui_title || 'Stock Price Over Time',
-        data: prices,
-        fill: false,
-        backgroundColor: '#FF5733', // Chart line color
-        borderColor: '#FF5733',
-        tension: 0.1,
-        pointRadius: 0,
-      },
-    ],
+    datasets: series.map((entry, index) => ({
+      label: entry.label,
+      data: entry.data,
+      fill: false,
+      backgroundColor: lineColours[index % lineColours.length], // Chart line color
+      borderColor: lineColours[index % lineColours.length],
+      tension: 0.1,
+      pointRadius: 0,
+      spanGaps: true, // Tickers can have missing days (e.g. different exchange holidays)
+    })),
   };
 
   // Chart options
@@ -0,0 +1,157 @@
+// PortfolioComponent.js
+import React from 'react';
+import { Table } from 'react-bootstrap';
+import { Line } from 'react-chartjs-2';
+import {
+    Chart as ChartJS,
+    CategoryScale,
+    LinearScale,
+    PointElement,
+    LineElement,
+    Title,
+    Tooltip,
+    Legend,
+  } from 'chart.js';
+
+  ChartJS.register(
+    CategoryScale,
+    LinearScale,
+    PointElement,
+    LineElement,
+    Title,
+    Tooltip,
+    Legend
+  );
+
+const formatMoney = (value, currency) =>
+  value === null || value === undefined ? 'n/a' : `${currency} ${value.toLocaleString(undefined, { maximumFractionDigits: 0 })}`;
+const formatPercent = (value) =>
+  value === null || value === undefined ? 'n/a' : `${(value * 100).toFixed(1)}%`;
+
+// Shades a correlation from white (0) to red (1), or blue for negative correlations
+const correlationColour = (value) => {
+  const strength = Math.round(255 * (1 - Math.min(Math.abs(value), 1)));
+  return value >= 0 ? `rgb(255, ${strength}, ${strength})` : `rgb(${strength}, ${strength}, 255)`;
+};
+
+function PortfolioComponent({ uiElement }) {
+  if (!uiElement || !uiElement.ui_content) {
+    return <p>No portfolio data available.</p>;
+  }
+
+  // ui_content is the full breakdown from the backend's portfolio analytics
+  const portfolio = uiElement.ui_content;
+  const currency = portfolio.base_currency;
+  const risk = portfolio.risk;
+
+  const performanceData = risk && {
+    labels: risk.performance.map(point => point.date),
+    datasets: [{
+      label: 'Portfolio value (rebased to 100)',
+      data: risk.performance.map(point => point.value),
+      fill: false,
+      backgroundColor: '#3366CC',
+      borderColor: '#3366CC',
+      tension: 0.1,
+      pointRadius: 0,
+    }],
+  };
+
+  return (
+    <div className="widget-container">
+      <h3>{uiElement.ui_title}</h3>
+      <p>
+        Value {formatMoney(portfolio.total_value, currency)}, unrealised P&L {formatMoney(portfolio.total_pnl, currency)} ({formatPercent(portfolio.total_pnl_percent)})
+      </p>
+
+      <Table striped bordered hover size="sm" responsive>
+        <thead>
+          <tr>
+            <th>Symbol</th>
+            <th>Name</th>
+            <th>Sector</th>
+            <th>Quantity</th>
+            <th>Price</th>
+            <th>Value</th>
+            <th>Weight</th>
+            <th>P&L</th>
+            <th>Volatility</th>
+            <th>Beta</th>
+            <th>Risk contribution</th>
+          </tr>
+        </thead>
+        <tbody>
+          {portfolio.positions.map(position => (
+            <tr key={position.symbol}>
+              <td>{position.symbol}</td>
+              <td>{position.name}</td>
+              <td>{position.sector}</td>
+              <td>{position.quantity}</td>
+              <td>{position.price === null ? 'n/a' : `${position.currency} ${position.price.toFixed(2)}`}</td>
+              <td>{formatMoney(position.market_value, currency)}</td>
+              <td>{formatPercent(position.weight)}</td>
+              <td>{formatPercent(position.pnl_percent)}</td>
+              <td>{formatPercent(position.volatility)}</td>
+              <td>{position.beta === undefined || position.beta === null ? 'n/a' : position.beta.toFixed(2)}</td>
+              <td>{formatPercent(position.risk_contribution)}</td>
+            </tr>
+          ))}
+        </tbody>
+      </Table>
+
+      <h5>Exposure</h5>
+      <Table bordered size="sm">
+        <tbody>
+          {Object.entries(portfolio.sector_exposure).map(([sector, weight]) => (
+            <tr key={`sector-${sector}`}><td>Sector</td><td>{sector}</td><td>{formatPercent(weight)}</td></tr>
+          ))}
+          {Object.entries(portfolio.currency_exposure).map(([code, weight]) => (
+            <tr key={`currency-${code}`}><td>Currency</td><td>{code}</td><td>{formatPercent(weight)}</td></tr>
+          ))}
+        </tbody>
+      </Table>
+
+      {risk ? (
+        <>
+          <h5>Risk ({risk.start_date} to {risk.end_date})</h5>
+          <Table bordered size="sm">
+            <tbody>
+              <tr><td>Annualised return</td><td>{formatPercent(risk.annualised_return)}</td></tr>
+              <tr><td>Annualised volatility</td><td>{formatPercent(risk.annualised_volatility)}</td></tr>
+              <tr><td>Max drawdown</td><td>{formatPercent(risk.max_drawdown)}</td></tr>
+              <tr><td>Beta vs {portfolio.benchmark}</td><td>{risk.beta === undefined ? 'n/a' : risk.beta.toFixed(2)}</td></tr>
+              <tr><td>1-day VaR (95% / 99%)</td><td>{formatMoney(risk.var_95, currency)} / {formatMoney(risk.var_99, currency)}</td></tr>
+              <tr><td>Expected shortfall (95% / 99%)</td><td>{formatMoney(risk.expected_shortfall_95, currency)} / {formatMoney(risk.expected_shortfall_99, currency)}</td></tr>
+            </tbody>
+          </Table>
+
+          <Line data={performanceData} options={{ responsive: true, plugins: { legend: { display: true, position: 'top' } } }} />
+
+          <h5>Correlation</h5>
+          <Table bordered size="sm" responsive>
+            <thead>
+              <tr>
+                <th></th>
+                {risk.correlation.symbols.map(symbol => <th key={symbol}>{symbol}</th>)}
+              </tr>
+            </thead>
+            <tbody>
+              {risk.correlation.matrix.map((row, rowIndex) => (
+                <tr key={risk.correlation.symbols[rowIndex]}>
+                  <th>{risk.correlation.symbols[rowIndex]}</th>
+                  {row.map((value, columnIndex) => (
+                    <td key={columnIndex} style={{ backgroundColor: correlationColour(value) }}>{value.toFixed(2)}</td>
+                  ))}
+                </tr>
+              ))}
+            </tbody>
+          </Table>
+        </>
+      ) : (
+        <p>Not enough price history to compute risk figures.</p>
+      )}
+    </div>
+  );
+}
+
+export default PortfolioComponent;
@@ -0,0 +1,107 @@
+""" Tests for the portfolio and conversation repositories, against an in-memory SQLite database (aiosqlite). Run from the
+repository root with:
+
+    python -m pytest -q tests """
+
+from backend_app.services.data_access_layer.models import Base
+from backend_app.services.data_access_layer.repositories import PortfolioRepository, ConversationRepository
+from backend_app.services.auth.models.user_model import UserTable
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture
+async def session_maker():
+    engine = create_async_engine("sqlite+aiosqlite://") # One shared in-memory connection, so every session sees the same tables
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def enable_foreign_keys(connection, _):
+        connection.execute("PRAGMA foreign_keys=ON")
+
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    async with session_maker() as session, session.begin():
+        session.add_all([UserTable(id=user_id, email=f"user{user_id}@example.com", hashed_password="x") for user_id in (1, 2)])
+    yield session_maker
+    await engine.dispose()
+
+async def test_upsert_positions_creates_then_updates_in_place(session_maker):
+    portfolios = PortfolioRepository(session_maker)
+    written = await portfolios.upsert_positions(1, [
+        {"symbol": "aapl", "quantity": 10, "purchase_price": 150.0},
+        {"symbol": "MSFT", "quantity": 5},
+    ], base_currency="usd")
+    assert written == 2
+    assert await portfolios.get_portfolio_version(1) == 1
+
+    await portfolios.upsert_positions(1, [{"symbol": "AAPL", "quantity": 12, "purchase_price": 155.0}])
+    portfolio = await portfolios.get_portfolio(1)
+    assert portfolio["version"] == 2
+    assert portfolio["currency"] == "USD"
+    positions = {position["symbol"]: position for position in portfolio["portfolio"]}
+    assert set(positions) == {"AAPL", "MSFT"}
+    assert positions["AAPL"]["quantity"] == 12
+    assert positions["AAPL"]["purchase_price"] == 155.0
+
+async def test_upsert_positions_replace_removes_positions_not_imported(session_maker):
+    portfolios = PortfolioRepository(session_maker)
+    await portfolios.upsert_positions(1, [{"symbol": "AAPL", "quantity": 1}, {"symbol": "MSFT", "quantity": 1}])
+    await portfolios.upsert_positions(1, [{"symbol": "NVDA", "quantity": 3}], replace=True)
+    portfolio = await portfolios.get_portfolio(1)
+    assert [position["symbol"] for position in portfolio["portfolio"]] == ["NVDA"]
+
+async def test_upsert_positions_rejects_a_position_without_a_quantity(session_maker):
+    portfolios = PortfolioRepository(session_maker)
+    with pytest.raises(ValueError):
+        await portfolios.upsert_positions(1, [{"symbol": "AAPL", "quantity": 1}, {"symbol": "MSFT"}])
+    assert await portfolios.get_portfolio(1) is None # Nothing is written
+
+async def test_add_messages_appends_and_counts(session_maker):
+    conversations = ConversationRepository(session_maker)
+    assert await conversations.get_message_count("c1") is None
+
+    stored_count = await conversations.add_messages("c1", [{"role": "user", "content": "What's AAPL at?"}, {"role": "assistant", "content": "About $190."}])
+    assert stored_count == 2
+    stored_count = await conversations.add_messages("c1", [
+        {"role": "user", "content": "And MSFT?"},
+        {"role": "function", "name": "get_stock_price", "content": "{\"price\": 410}"},
+        {"role": "assistant", "content": "About $410."},
+    ])
+    assert stored_count == 5
+    assert await conversations.get_message_count("c1") == 5
+
+    messages, stored_count = await conversations.get_recent_messages("c1", 2)
+    assert stored_count == 5
+    assert messages == [{"role": "function", "name": "get_stock_price", "content": "{\"price\": 410}"}, {"role": "assistant", "content": "About $410."}]
+
+async def test_get_history_pages_backwards_with_the_cursor(session_maker):
+    conversations = ConversationRepository(session_maker)
+    await conversations.add_messages("c1", [{"role": "user", "content": f"message {i}"} for i in range(5)])
+
+    first_page = await conversations.get_history("c1", limit=2)
+    assert [message["content"] for message in first_page["messages"]] == ["message 4", "message 3"]
+    second_page = await conversations.get_history("c1", before=first_page["next_cursor"], limit=2)
+    assert [message["content"] for message in second_page["messages"]] == ["message 2", "message 1"]
+    last_page = await conversations.get_history("c1", before=second_page["next_cursor"], limit=2)
+    assert [message["content"] for message in last_page["messages"]] == ["message 0"]
+    assert last_page["next_cursor"] is None
+
+async def test_get_owner_keeps_the_first_owner(session_maker):
+    conversations = ConversationRepository(session_maker)
+    assert await conversations.get_owner("missing") is None
+
+    await conversations.add_messages("signed-out", [{"role": "user", "content": "hi"}])
+    assert await conversations.get_owner("signed-out") is None
+
+    await conversations.add_messages("c1", [{"role": "user", "content": "hi"}], user_id=1)
+    await conversations.add_messages("c1", [{"role": "user", "content": "hi again"}], user_id=2) # Never changes hands
+    assert await conversations.get_owner("c1") == 1
+    assert [conversation["id"] for conversation in (await conversations.list_conversations(1))["conversations"]] == ["c1"]
+    assert (await conversations.list_conversations(2))["conversations"] == []
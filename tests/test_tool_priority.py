@@ -0,0 +1,30 @@
+""" Tests that blocking tools, which run on the tool thread pool, still see the request's priority, so a background
+answer's upstream calls queue behind interactive ones. Run from the repository root with:
+
+    python -m pytest -q tests """
+
+from backend_app.services.chatbot import functions
+from backend_app.services.upstream.upstream_scheduler import request_priority, INTERACTIVE, BACKGROUND
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture
+def priority_tool(monkeypatch):
+    def get_priority(arguments):
+        return {"priority": request_priority.get(), "user_id": functions.current_user_id.get()}
+    monkeypatch.setitem(functions.available_functions, "get_priority", get_priority)
+
+async def test_sync_tool_sees_background_priority(priority_tool):
+    request_priority.set(BACKGROUND)
+    functions.current_user_id.set(7)
+    results = await functions.execute_function_call("get_priority", "{}")
+    assert results == {"priority": BACKGROUND, "user_id": 7}
+
+async def test_sync_tool_defaults_to_interactive(priority_tool):
+    results = await functions.execute_function_call("get_priority", "{}")
+    assert results["priority"] == INTERACTIVE